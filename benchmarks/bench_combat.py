@@ -0,0 +1,103 @@
+"""
+Scaling benchmark for the ComBat harmonization backend
+
+Times ComBatHarmonizer.fit_transform on synthetic multi-site data over a grid of
+features x samples x batches and, when neuroCombat is installed, compares runtime
+and the maximum absolute difference of the harmonized values.
+
+Usage:
+    python benchmarks/bench_combat.py --features 300 1000 3000 --samples 40 200 --batches 2 4 8
+"""
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from combat_harmonization import ComBatHarmonizer
+
+def make_multisite_data(n_features, n_samples, n_batches, seed=0):
+    """Synthetic features x samples matrix with additive and multiplicative site effects"""
+    rng = np.random.default_rng(seed)
+    batch = np.array([f'SITE{i}' for i in np.arange(n_samples) % n_batches])
+    data = rng.normal(size=(n_features, n_samples)) * rng.uniform(0.5, 3, (n_features, 1)) + rng.normal(0, 5, (n_features, 1))
+    for i in range(n_batches):
+        in_batch = batch == f'SITE{i}'
+        data[:, in_batch] = data[:, in_batch] * rng.uniform(0.7, 1.5, (n_features, 1)) + rng.normal(0, 1, (n_features, 1))
+    return data, batch
+
+def time_call(func, repeats):
+    """Best wall time of several runs and the last result"""
+    best = np.inf
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def run_neurocombat(data, batch):
+    import pandas as pd
+    from neuroCombat import neuroCombat
+    # neuroCombat prints every step, keep the benchmark table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        return neuroCombat(data.copy(), pd.DataFrame({'batch': batch}), 'batch')['data']
+
+def run_benchmark(features, samples, batches, repeats=3, compare=True):
+    try:
+        import neuroCombat  # noqa: F401
+    except ImportError:
+        compare = False
+
+    results = []
+    for n_batches in batches:
+        for n_samples in samples:
+            for n_features in features:
+                data, batch = make_multisite_data(n_features, n_samples, n_batches)
+                harmonizer = ComBatHarmonizer()
+                native_time, native = time_call(lambda: harmonizer.fit_transform(data, batch), repeats)
+                row = {
+                    'features': n_features,
+                    'samples': n_samples,
+                    'batches': n_batches,
+                    'native_s': native_time,
+                    'eb_iterations': int(harmonizer.eb_iterations.max())
+                }
+                if compare:
+                    reference_time, reference = time_call(lambda: run_neurocombat(data, batch), repeats)
+                    row['neurocombat_s'] = reference_time
+                    row['speedup'] = reference_time / native_time
+                    row['max_abs_diff'] = float(np.max(np.abs(native - reference)))
+                results.append(row)
+                print(format_row(row))
+    return results
+
+def format_row(row):
+    line = f"F={row['features']:>6} N={row['samples']:>5} B={row['batches']:>3}  native {row['native_s'] * 1000:9.2f} ms"
+    if 'neurocombat_s' in row:
+        line += (f"  neuroCombat {row['neurocombat_s'] * 1000:9.2f} ms  x{row['speedup']:6.1f}"
+                 f"  max|diff| {row['max_abs_diff']:.2e}")
+    return line
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', type=int, nargs='+', default=[300, 1000, 3000])
+    parser.add_argument('--samples', type=int, nargs='+', default=[40, 200])
+    parser.add_argument('--batches', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-compare', action='store_true', help='Skip the neuroCombat reference run')
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.features, args.samples, args.batches, args.repeats, not args.no_compare)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved: {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Benchmark suite for the DCE-MRI pipeline stages and web routes
+
+Generates synthetic _0000/_0001/segment cases (benchmarks/synthetic_dce.py) for
+every volume size x ROI fraction, times the public stages, the main web_app
+routes and the cold start of the entry points, and stores the timings as benchmarks/results/<git commit>.json so runs
+from different commits can be compared.
+
+Usage:
+    python benchmarks/bench_pipeline.py --sizes 128x128x48 256x256x96 --roi-fractions 0.01 0.05
+    python benchmarks/bench_pipeline.py --compare <base commit or json> [<head commit or json>] --threshold 0.1
+"""
+import os
+import sys
+import io
+import json
+import glob
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+from synthetic_dce import parse_shape, make_synthetic_case, make_synthetic_cohort
+from bench_combat import make_multisite_data
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# web_app.get_available_cases lists all four dataset folders
+WEB_DATASETS = ('DUKE', 'ISPY1', 'ISPY2', 'NACT')
+
+# Imported only by the stages that use them; a startup entry that loads one is reported as failed
+LAZY_MODULES = ('radiomics', 'SimpleITK', 'matplotlib')
+
+# Cold-start entry points, each timed in a fresh interpreter ('python' is the interpreter alone)
+STARTUP_SNIPPETS = [
+    ('python', 'pass'),
+    ('import complete_pipeline', 'import complete_pipeline'),
+    ('pipeline_init', 'from complete_pipeline import CompleteDCEMRIPipeline; CompleteDCEMRIPipeline()'),
+    ('import pipeline_stages', 'import pipeline_stages'),
+    ('import web_app', 'import web_app'),
+]
+
+def git_commit():
+    """Short commit hash of the working tree, suffixed with -dirty when there are local changes"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if status else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def time_stage(func, repeats, check=None):
+    """
+    Run func repeats times with its output silenced
+
+    Returns:
+        dict with first/best/median wall time and a status ('ok', or 'failed' when check(result) is False)
+    """
+    times = []
+    result = None
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+    status = 'ok' if check is None or check(result) else 'failed'
+    return {'first_s': times[0], 'best_s': min(times), 'median_s': float(np.median(times)),
+            'repeats': repeats, 'status': status}
+
+def add_result(results, stage, params, timing):
+    key = f"{stage}[{params}]" if params else stage
+    results[key] = {'stage': stage, 'params': params, **timing}
+    print(f"{key:<60} best {timing['best_s'] * 1000:10.2f} ms  median {timing['median_s'] * 1000:10.2f} ms"
+          f"{'' if timing['status'] == 'ok' else '  [' + timing['status'] + ']'}")
+
+def bench_case_stages(pipeline, workdir, shape, roi_fraction, repeats, results, parallel_pipeline=None):
+    """Per-case stages on one synthetic case (and latency-mode radiomics when parallel_pipeline is given)"""
+    from chunked_kinetics import extract_kinetic_features_chunked
+    from dce_kinetics import extract_multiphase_kinetics
+    from rgb_nifti_converter import convert_to_rgb_nifti
+
+    params = f"{'x'.join(map(str, shape))},roi={roi_fraction}"
+    case = make_synthetic_case(workdir, 'BENCH_001', shape, roi_fraction, n_phases=3)
+    tp0_file, tp1_file = case['phases'][:2]
+    seg_file = case['segmentation']
+    img_0000, img_0001, mask = [nib.load(path).get_fdata() for path in (tp0_file, tp1_file, seg_file)]
+
+    add_result(results, 'extract_kinetic_features', params, time_stage(
+        lambda: pipeline.extract_kinetic_features(img_0000, img_0001, mask), repeats))
+    add_result(results, 'extract_kinetic_features_chunked', params, time_stage(
+        lambda: extract_kinetic_features_chunked(tp0_file, tp1_file, seg_file, memory_budget_mb=64), repeats))
+    add_result(results, 'extract_multiphase_kinetics', params, time_stage(
+        lambda: extract_multiphase_kinetics(case['phases'], mask), repeats))
+    add_result(results, 'extract_temporal_radiomics', params, time_stage(
+        lambda: pipeline.extract_temporal_radiomics(tp0_file, tp1_file, seg_file), repeats, check=bool))
+    if parallel_pipeline is not None:
+        serial = pipeline.extract_temporal_radiomics(tp0_file, tp1_file, seg_file)
+        add_result(results, 'extract_temporal_radiomics_parallel',
+                   f"{params},workers={parallel_pipeline.radiomics_workers}", time_stage(
+                       lambda: parallel_pipeline.extract_temporal_radiomics(tp0_file, tp1_file, seg_file), repeats,
+                       check=lambda features: list(features.items()) == list(serial.items())))
+
+    _, colormap = pipeline.extract_kinetic_features(img_0000, img_0001, mask)
+    out_path = os.path.join(case['case_path'], 'BENCH_001_colormap.nii.gz')
+    add_result(results, 'convert_to_rgb_nifti', params, time_stage(
+        lambda: convert_to_rgb_nifti(tp0_file, colormap, out_path), repeats))
+    shutil.rmtree(os.path.join(workdir, 'BENCH'))
+
+def bench_combat(pipeline, n_cases, n_features, repeats, results):
+    """ComBat harmonization of a synthetic cases x features table split across the four datasets"""
+    data, batch = make_multisite_data(n_features, n_cases, len(WEB_DATASETS))
+    dataset = np.array(WEB_DATASETS)[np.searchsorted([f'SITE{i}' for i in range(len(WEB_DATASETS))], batch)]
+    features_df = pd.DataFrame(data.T, columns=[f'feature_{i}' for i in range(n_features)])
+    features_df.insert(0, 'case_id', [f"{name}_{i:04d}" for i, name in enumerate(dataset)])
+    add_result(results, 'apply_combat_harmonization', f"cases={n_cases},features={n_features}", time_stage(
+        lambda: pipeline.apply_combat_harmonization(features_df.copy()), repeats))
+
+def bench_web_routes(pipeline, workdir, shape, roi_fraction, cases_per_dataset, repeats, results):
+    """Main web_app routes on a cohort processed end to end by the pipeline"""
+    web_dir = os.path.join(workdir, 'web')
+    cases = make_synthetic_cohort(web_dir, WEB_DATASETS, cases_per_dataset, shape, roi_fraction)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline.process_all_datasets(web_dir)
+
+    case_id = sorted(cases)[0]
+    mid_slice = shape[2] // 2
+    routes = [
+        ('index', '/', {}),
+        ('case_view', f'/case/{case_id}', {}),
+        ('case_slices', f'/api/case/{case_id}/slices', {}),
+        ('case_slice', f'/api/case/{case_id}/slice/{mid_slice}', {}),
+        ('case_pyramid_range', f'/api/case/{case_id}/pyramid', {'Range': 'bytes=0-65535'}),
+        ('export_csv', '/api/export/harmonized?format=csv', {}),
+        ('export_ndjson', '/api/export/harmonized?format=ndjson', {}),
+    ]
+
+    cwd = os.getcwd()
+    os.chdir(web_dir)
+    try:
+        import web_app
+        client = web_app.app.test_client()
+        params = f"{'x'.join(map(str, shape))},cases={len(cases)}"
+        for name, url, headers in routes:
+            def fetch():
+                response = client.get(url, headers=headers)
+                # Consume streamed bodies inside the timed call
+                response.get_data()
+                return response
+            add_result(results, f"web:{name}", params, time_stage(
+                fetch, repeats, check=lambda response: response.status_code < 400))
+    finally:
+        os.chdir(cwd)
+
+def bench_startup(repeats, results):
+    """Wall time of a new process importing each entry point, as paid by every short-lived job"""
+    for name, code in STARTUP_SNIPPETS:
+        script = f"import sys\n{code}\nprint(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+
+        def start():
+            return subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR, capture_output=True, text=True)
+        add_result(results, f"startup:{name}", None, time_stage(
+            start, repeats, check=lambda process: process.returncode == 0 and not process.stdout.strip()))
+
+def run_suite(args):
+    from complete_pipeline import CompleteDCEMRIPipeline
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline = CompleteDCEMRIPipeline()
+    parallel_pipeline = CompleteDCEMRIPipeline(radiomics_workers=args.radiomics_workers) if args.radiomics_workers else None
+
+    results = {}
+    if not args.no_startup:
+        bench_startup(args.repeats, results)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dce_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        for size in args.sizes:
+            for roi_fraction in args.roi_fractions:
+                bench_case_stages(pipeline, workdir, parse_shape(size), roi_fraction, args.repeats, results,
+                                  parallel_pipeline)
+        for n_cases in args.combat_cases:
+            bench_combat(pipeline, n_cases, args.combat_features, args.repeats, results)
+        if not args.no_web:
+            bench_web_routes(pipeline, workdir, parse_shape(args.sizes[0]), args.roi_fractions[0],
+                             args.web_cases, args.repeats, results)
+    finally:
+        if parallel_pipeline is not None:
+            parallel_pipeline.close()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'config': {
+            'sizes': args.sizes,
+            'roi_fractions': args.roi_fractions,
+            'combat_cases': args.combat_cases,
+            'combat_features': args.combat_features,
+            'web_cases': None if args.no_web else args.web_cases,
+            'startup': not args.no_startup,
+            'radiomics_workers': args.radiomics_workers,
+            'repeats': args.repeats
+        },
+        'results': results
+    }
+
+def resolve_results(token):
+    """A results JSON path, or a commit whose results are stored under benchmarks/results"""
+    if os.path.isfile(token):
+        return token
+    matches = sorted(glob.glob(os.path.join(RESULTS_DIR, f"{token}*.json")), key=os.path.getmtime)
+    if not matches:
+        raise FileNotFoundError(f"No benchmark results for '{token}' in {RESULTS_DIR}")
+    return matches[-1]
+
+def compare_results(base_path, head_path, threshold=0.1, metric='best_s'):
+    """
+    Print head vs base timings per stage
+
+    Returns:
+        list of keys that are slower than base by more than threshold (relative)
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(head_path) as f:
+        head = json.load(f)
+    print(f"Base {base['commit']} ({base['timestamp']})  vs  head {head['commit']} ({head['timestamp']})")
+    print(f"{'Stage':<60}{'Base ms':>11}{'Head ms':>11}{'Change':>9}")
+
+    regressions = []
+    for key in sorted(set(base['results']) | set(head['results'])):
+        before, after = base['results'].get(key), head['results'].get(key)
+        if before is None or after is None:
+            before_ms = '-' if before is None else f"{before[metric] * 1000:.2f}"
+            after_ms = '-' if after is None else f"{after[metric] * 1000:.2f}"
+            print(f"{key:<60}{before_ms:>11}{after_ms:>11}{'new' if before is None else 'removed':>9}")
+            continue
+        if before['status'] != 'ok' or after['status'] != 'ok':
+            # Timings of failed stages are not comparable
+            print(f"{key:<60}{before[metric] * 1000:>11.2f}{after[metric] * 1000:>11.2f}{'failed':>9}")
+            continue
+        change = after[metric] / before[metric] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f"{key:<60}{before[metric] * 1000:>11.2f}{after[metric] * 1000:>11.2f}{change * 100:>8.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['128x128x48', '256x256x96'], help='Volume sizes XxYxZ')
+    parser.add_argument('--roi-fractions', type=float, nargs='+', default=[0.01, 0.05])
+    parser.add_argument('--combat-cases', type=int, nargs='+', default=[40, 400])
+    parser.add_argument('--combat-features', type=int, default=200)
+    parser.add_argument('--web-cases', type=int, default=2, help='Synthetic cases per dataset for the web routes')
+    parser.add_argument('--no-web', action='store_true', help='Skip the web route benchmarks')
+    parser.add_argument('--radiomics-workers', type=int,
+                        help='Also time latency-mode radiomics with this many processes (checked against serial)')
+    parser.add_argument('--no-startup', action='store_true', help='Skip the cold-start benchmarks')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--workdir', help='Keep the synthetic data in this folder instead of a temporary one')
+    parser.add_argument('--output', help='Results JSON (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Compare base [head] results (commit or JSON path); head defaults to the current commit')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        base_path = resolve_results(args.compare[0])
+        head_path = resolve_results(args.compare[1] if len(args.compare) > 1 else git_commit())
+        regressions = compare_results(base_path, head_path, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold * 100:.0f}%")
+            sys.exit(1)
+        return
+
+    report = run_suite(args)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved: {output}")
+
+if __name__ == '__main__':
+    main()
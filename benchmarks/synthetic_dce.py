@@ -0,0 +1,100 @@
+"""
+Synthetic DCE-MRI cases for benchmarks
+
+Writes cases in the MAMA-MIA layout used by complete_pipeline.py:
+
+    <base_dir>/<DATASET>/<CASE>/<CASE>_0000.nii.gz ... _000N.nii.gz
+    <base_dir>/<DATASET>/segment/<CASE>.nii.gz
+
+The tumour is an ellipsoid covering roi_fraction of the volume, split into
+concentric shells whose _0000 -> _0001 change falls in the washout (core),
+plateau and uptake (rim) classes of extract_kinetic_features, so every kinetic
+class is represented. Output depends only on the seed.
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+# (change at _0001, further change per later phase) by shell, relative to baseline
+SHELL_KINETICS = {
+    'washout': (-0.15, -0.10),
+    'plateau': (0.05, 0.0),
+    'uptake': (0.40, 0.10)
+}
+
+def parse_shape(text):
+    """'256x256x96' -> (256, 256, 96)"""
+    shape = tuple(int(size) for size in text.lower().split('x'))
+    if len(shape) != 3:
+        raise ValueError(f"Volume shape must be XxYxZ, got '{text}'")
+    return shape
+
+def ellipsoid_radius(roi_fraction):
+    """
+    Normalized radius r (r=1 touches the volume faces) of the ellipsoid with the given volume fraction
+    """
+    if not 0 < roi_fraction <= np.pi / 6:
+        raise ValueError(f"roi_fraction must be in (0, {np.pi / 6:.3f}]")
+    return (6 * roi_fraction / np.pi) ** (1 / 3)
+
+def make_synthetic_case(base_dir, case_id, shape=(128, 128, 48), roi_fraction=0.02, n_phases=3,
+                        seed=0, spacing=(0.7, 0.7, 2.0)):
+    """
+    Write one synthetic case and return its file paths
+
+    Returns:
+        dict with 'case_path', 'segment_dir', 'phases' (list of paths) and 'segmentation'
+    """
+    rng = np.random.default_rng(seed)
+    dataset = case_id.split('_')[0]
+    case_path = os.path.join(base_dir, dataset, case_id)
+    segment_dir = os.path.join(base_dir, dataset, 'segment')
+    os.makedirs(case_path, exist_ok=True)
+    os.makedirs(segment_dir, exist_ok=True)
+
+    # Normalized distance from a (slightly jittered) centre
+    center = np.array(shape) / 2 + rng.uniform(-0.05, 0.05, 3) * np.array(shape)
+    axes = [(np.arange(size) - c) / (size / 2) for size, c in zip(shape, center)]
+    distance = np.sqrt(axes[0][:, None, None] ** 2 + axes[1][None, :, None] ** 2 + axes[2][None, None, :] ** 2)
+    radius = ellipsoid_radius(roi_fraction)
+    roi = distance <= radius
+
+    # Smooth background anatomy plus noise
+    baseline = 300 + 150 * np.cos(3 * axes[0])[:, None, None] * np.cos(2 * axes[1])[None, :, None]
+    baseline = np.broadcast_to(baseline, shape) + rng.normal(0, 10, shape)
+    baseline = np.clip(baseline, 20, None)
+
+    # Shell index: 0 core (washout), 1 middle (plateau), 2 rim (uptake)
+    shell = np.minimum((distance / radius * 3).astype(int), 2)
+    early = np.zeros(shape)
+    late = np.zeros(shape)
+    for index, name in enumerate(['washout', 'plateau', 'uptake']):
+        in_shell = roi & (shell == index)
+        early[in_shell], late[in_shell] = SHELL_KINETICS[name]
+
+    affine = np.diag(list(spacing) + [1.0])
+    phases = []
+    for t in range(n_phases):
+        if t == 0:
+            signal = baseline
+        else:
+            # Early change at phase 1, then the late trend per phase
+            signal = baseline * (1 + early) * (1 + late) ** (t - 1) + rng.normal(0, 5, shape)
+        path = os.path.join(case_path, f"{case_id}_{t:04d}.nii.gz")
+        nib.save(nib.Nifti1Image(np.clip(signal, 0, None).astype(np.int16), affine), path)
+        phases.append(path)
+
+    seg_path = os.path.join(segment_dir, f"{case_id}.nii.gz")
+    nib.save(nib.Nifti1Image(roi.astype(np.uint8), affine), seg_path)
+    return {'case_path': case_path, 'segment_dir': segment_dir, 'phases': phases, 'segmentation': seg_path}
+
+def make_synthetic_cohort(base_dir, datasets=('DUKE', 'NACT'), cases_per_dataset=3, shape=(128, 128, 48),
+                          roi_fraction=0.02, n_phases=3, seed=0):
+    """Write several synthetic cases per dataset; returns {case_id: make_synthetic_case result}"""
+    cases = {}
+    for d, dataset in enumerate(datasets):
+        for i in range(cases_per_dataset):
+            case_id = f"{dataset}_{i + 1:03d}"
+            cases[case_id] = make_synthetic_case(base_dir, case_id, shape, roi_fraction, n_phases,
+                                                 seed=seed + 1000 * d + i)
+    return cases
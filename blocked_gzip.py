@@ -0,0 +1,242 @@
+import os
+import io
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+# isal's igzip is a faster drop-in for gzip when installed
+try:
+    from isal import igzip as gzip_module
+except ImportError:
+    import gzip as gzip_module
+
+# BGZF layout (as in htslib): independent gzip members of at most 64 KiB, each
+# carrying its compressed size in a 'BC' extra field, so blocks can be located
+# without inflating and decompressed independently. Plain gzip readers (nibabel,
+# gunzip) read the file as ordinary multi-member gzip.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def default_workers():
+    return min(8, os.cpu_count() or 1)
+
+def _compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+def write_blocked_gzip(path, data, level=6, workers=None):
+    """Write data as BGZF, compressing blocks in parallel threads (zlib releases the GIL)"""
+    view = memoryview(data).cast('B')
+    blocks = [view[i:i + BGZF_BLOCK_SIZE] for i in range(0, len(view), BGZF_BLOCK_SIZE)]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool, open(tmp_path, 'wb') as f:
+        for block in pool.map(lambda b: _compress_block(b, level), blocks):
+            f.write(block)
+        f.write(BGZF_EOF)
+    os.replace(tmp_path, path)
+
+class BlockedGzipWriter:
+    """
+    Incremental BGZF writer with the output of write_blocked_gzip
+
+    Written bytes are buffered and compressed whenever enough full blocks are
+    pending, so data produced in pieces (e.g. one z-slab at a time) never has
+    to be held in memory as a whole.
+    """
+    BATCH_BLOCKS = 64
+
+    def __init__(self, path, level=6, workers=None):
+        self.path = path
+        self.level = level
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.pool = ThreadPoolExecutor(max_workers=workers or default_workers())
+        self.file = open(self.tmp_path, 'wb')
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += memoryview(data).cast('B')
+        if len(self.buffer) >= self.BATCH_BLOCKS * BGZF_BLOCK_SIZE:
+            self._flush(len(self.buffer) - len(self.buffer) % BGZF_BLOCK_SIZE)
+
+    def _flush(self, size):
+        view = memoryview(self.buffer)
+        blocks = [bytes(view[i:min(i + BGZF_BLOCK_SIZE, size)]) for i in range(0, size, BGZF_BLOCK_SIZE)]
+        view.release()
+        for block in self.pool.map(lambda b: _compress_block(b, self.level), blocks):
+            self.file.write(block)
+        del self.buffer[:size]
+
+    def close(self):
+        """Write the remaining blocks and the EOF marker, then move the file into place"""
+        try:
+            self._flush(len(self.buffer))
+            self.file.write(BGZF_EOF)
+        finally:
+            self.file.close()
+            self.pool.shutdown()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        self.pool.shutdown()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def is_blocked_gzip(path):
+    """True if the file starts with a BGZF block header"""
+    with open(path, 'rb') as f:
+        head = f.read(BGZF_HEADER.size)
+    if len(head) < BGZF_HEADER.size:
+        return False
+    fields = BGZF_HEADER.unpack(head)
+    return fields[:4] == (31, 139, 8, 4) and fields[7:11] == (6, 66, 67, 2)
+
+class BlockedGzipReader:
+    """
+    Random access to a BGZF file
+
+    The block index (compressed and uncompressed offsets) is built from the block
+    headers and trailers alone; read() inflates only the blocks that overlap the
+    requested byte range.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.coffsets, self.csizes, self.usizes = self._scan_blocks()
+        self.uoffsets = np.concatenate([[0], np.cumsum(self.usizes)]).astype(np.int64)
+        self.size = int(self.uoffsets[-1])
+
+    def _scan_blocks(self):
+        coffsets, csizes, usizes = [], [], []
+        file_size = os.fstat(self._file.fileno()).st_size
+        offset = 0
+        while offset < file_size:
+            self._file.seek(offset)
+            fields = BGZF_HEADER.unpack(self._file.read(BGZF_HEADER.size))
+            if fields[:4] != (31, 139, 8, 4) or fields[8:10] != (66, 67):
+                raise ValueError(f"{self.path} is not a BGZF file (bad block at offset {offset})")
+            block_size = fields[11] + 1
+            self._file.seek(offset + block_size - 4)
+            usize = struct.unpack('<I', self._file.read(4))[0]
+            if usize > 0:
+                coffsets.append(offset)
+                csizes.append(block_size)
+                usizes.append(usize)
+            offset += block_size
+        return np.array(coffsets, dtype=np.int64), np.array(csizes, dtype=np.int64), np.array(usizes, dtype=np.int64)
+
+    @staticmethod
+    def _inflate(block):
+        data = zlib.decompress(block[BGZF_HEADER.size:-8], -15)
+        crc, usize = struct.unpack('<II', block[-8:])
+        if zlib.crc32(data) != crc or len(data) != usize:
+            raise ValueError("BGZF block failed its CRC check")
+        return data
+
+    def _read_blocks(self, first, last):
+        self._file.seek(self.coffsets[first])
+        raw = self._file.read(int(self.coffsets[last] + self.csizes[last] - self.coffsets[first]))
+        starts = self.coffsets[first:last + 1] - self.coffsets[first]
+        return [raw[s:s + size] for s, size in zip(starts, self.csizes[first:last + 1])]
+
+    def read(self, offset, size):
+        """Uncompressed bytes [offset, offset + size)"""
+        if size <= 0:
+            return b''
+        first = int(np.searchsorted(self.uoffsets, offset, side='right') - 1)
+        last = int(np.searchsorted(self.uoffsets, offset + size, side='left') - 1)
+        data = b''.join(self._inflate(block) for block in self._read_blocks(first, last))
+        start = offset - int(self.uoffsets[first])
+        return data[start:start + size]
+
+    def read_all(self, workers=None):
+        """Whole uncompressed stream, inflating blocks in parallel threads"""
+        if len(self.coffsets) == 0:
+            return b''
+        blocks = self._read_blocks(0, len(self.coffsets) - 1)
+        with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+            return b''.join(pool.map(self._inflate, blocks))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_gzip_bytes(path, workers=None):
+    """Decompressed contents of a gzip file: parallel for BGZF, single stream (isal if available) otherwise"""
+    if is_blocked_gzip(path):
+        with BlockedGzipReader(path) as reader:
+            return reader.read_all(workers)
+    with gzip_module.open(path, 'rb') as f:
+        return f.read()
+
+def _image_class(data):
+    # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2
+    return nib.Nifti2Image if struct.unpack('<i', data[:4])[0] in (540, 0x1c020000) else nib.Nifti1Image
+
+def load_nifti_image(path, workers=None):
+    """
+    nibabel image of a NIfTI file, decompressed in memory by read_gzip_bytes
+
+    Uncompressed files are left to nib.load (memory-mapped).
+    """
+    if not path.endswith('.gz'):
+        return nib.load(path)
+    data = read_gzip_bytes(path, workers)
+    return _image_class(data).from_bytes(data)
+
+def load_nifti_images(paths, workers=None):
+    """Load several NIfTI files concurrently, one thread per file"""
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+        return list(pool.map(load_nifti_image, paths))
+
+def save_nifti_blocked(img, path, level=6, workers=None):
+    """Save a NIfTI image; .gz paths are written as BGZF instead of a single gzip stream"""
+    if not path.endswith('.gz'):
+        nib.save(img, path)
+        return
+    write_blocked_gzip(path, img.to_bytes(), level=level, workers=workers)
+
+def read_nifti_slice(path, z):
+    """
+    Axial slice z of a 3D NIfTI volume
+
+    For BGZF files only the header block and the blocks holding the slice are
+    inflated; other files go through nibabel's array proxy.
+    """
+    if not (path.endswith('.gz') and is_blocked_gzip(path)):
+        return np.asanyarray(nib.load(path).dataobj[:, :, z])
+    with BlockedGzipReader(path) as reader:
+        header_bytes = reader.read(0, 540)
+        header_class = _image_class(header_bytes).header_class
+        header = header_class.from_fileobj(io.BytesIO(header_bytes[:header_class.template_dtype.itemsize]))
+        shape = header.get_data_shape()
+        dtype = header.get_data_dtype()
+        slice_bytes = shape[0] * shape[1] * dtype.itemsize
+        raw = reader.read(int(header['vox_offset']) + z * slice_bytes, slice_bytes)
+    data = np.frombuffer(raw, dtype=dtype).reshape(shape[:2], order='F')
+    slope, inter = header.get_slope_inter()
+    if slope is not None and (slope != 1 or (inter or 0) != 0):
+        data = data * slope + (inter or 0)
+    return data
@@ -0,0 +1,125 @@
+import os
+import json
+import zlib
+import glob
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHARD_DIR = 'shards'
+
+def shard_of(case_id, shard_count):
+    """Shard index of a case; depends only on the case id, so every node agrees without coordination"""
+    return zlib.crc32(case_id.encode('utf-8')) % shard_count
+
+def read_case_list(path):
+    """Case ids from a text file, one per line ('#' starts a comment)"""
+    case_ids = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                case_ids.append(line)
+    return case_ids
+
+def select_cases(cases, shard_index=None, shard_count=None, case_ids=None):
+    """
+    The slice of cases one node processes
+
+    Args:
+        cases: (dataset, case_id, case_path, segment_dir) tuples as returned by find_cases
+        shard_index, shard_count: Keep the cases with shard_of(case_id, shard_count) == shard_index
+        case_ids: Keep only these cases (e.g. from read_case_list)
+    """
+    if shard_count is not None:
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index must be in [0, {shard_count}), got {shard_index}")
+        cases = [case for case in cases if shard_of(case[1], shard_count) == shard_index]
+    if case_ids is not None:
+        wanted = set(case_ids)
+        cases = [case for case in cases if case[1] in wanted]
+    return cases
+
+def partition_name(shard_index=None, shard_count=None, case_ids=None):
+    """File name of a shard's partition: by shard number, or by a hash of its case list"""
+    if shard_count is not None:
+        name = f"shard-{shard_index:04d}-of-{shard_count:04d}"
+    else:
+        name = 'shard-list'
+    if case_ids is not None:
+        name += '-' + hashlib.sha1('\n'.join(sorted(case_ids)).encode('utf-8')).hexdigest()[:12]
+    return name
+
+def partition_path(base_dir, name):
+    return os.path.join(base_dir, SHARD_DIR, f"features_{name}.jsonl")
+
+def json_value(value):
+    # numpy scalars -> Python numbers (floats round-trip exactly through JSON)
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def write_partition(path, results):
+    """
+    Atomically write one shard's results
+
+    Args:
+        path: Partition path (partition_path)
+        results: (case_id, features or None, error message) per processed case, in processing order
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for case_id, features, error in results:
+            if features:
+                row = {'case_id': case_id, 'status': 'ok', 'features': features}
+            else:
+                row = {'case_id': case_id, 'status': 'failed', 'error': error}
+            f.write(json.dumps(row, default=json_value) + '\n')
+    os.replace(tmp_path, path)
+
+def read_partitions(base_dir, require_complete=True):
+    """
+    Features and failures from every partition under base_dir/shards
+
+    Numbered partitions must all use the same shard count and, with
+    require_complete, every shard of that count must be present. A case found
+    in several partitions must have identical features in each.
+
+    Returns:
+        ({case_id: features}, {case_id: error})
+    """
+    paths = sorted(glob.glob(partition_path(base_dir, '*')))
+    if not paths:
+        raise FileNotFoundError(f"No feature partitions found in {os.path.join(base_dir, SHARD_DIR)}")
+
+    counts = {}
+    for path in paths:
+        name = os.path.basename(path)[len('features_'):-len('.jsonl')]
+        parts = name.split('-')
+        if len(parts) >= 4 and parts[0] == 'shard' and parts[2] == 'of':
+            counts.setdefault(int(parts[3]), set()).add(int(parts[1]))
+    if len(counts) > 1:
+        raise ValueError(f"Partitions from different shard counts {sorted(counts)}; remove the stale ones")
+    for shard_count, indices in counts.items():
+        missing = sorted(set(range(shard_count)) - indices)
+        if missing and require_complete:
+            raise RuntimeError(f"Missing shards {missing} of {shard_count}; wait for them or pass allow_partial")
+        if missing:
+            logger.warning("Merging without shards %s of %d", missing, shard_count)
+
+    features, failures = {}, {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                case_id = row['case_id']
+                if row['status'] != 'ok':
+                    failures.setdefault(case_id, row.get('error'))
+                    continue
+                # Compared as JSON so NaN features count as equal
+                if case_id in features and json.dumps(features[case_id]) != json.dumps(row['features']):
+                    raise ValueError(f"Case {case_id} has different features in two partitions")
+                features[case_id] = row['features']
+    # A case that failed on one node but succeeded on another is not a failure
+    failures = {case_id: error for case_id, error in failures.items() if case_id not in features}
+    return features, failures
@@ -0,0 +1,218 @@
+import logging
+import numpy as np
+import nibabel as nib
+from quantile_sketch import QuantileSketch
+
+# Working bytes per voxel of a slab: three float64 volumes plus ROI/class temporaries
+SLAB_BYTES_PER_VOXEL = 3 * 8 + 8
+
+# Working bytes per voxel of CompleteDCEMRIPipeline.extract_kinetic_features on whole volumes
+FULL_LOAD_BYTES_PER_VOXEL = 3 * 8 + 8 + 5
+
+logger = logging.getLogger(__name__)
+
+class RunningMoments:
+    """
+    Mergeable count/mean/central moments up to order 4 (Pebay's update formulas)
+
+    Batches are reduced to their own moments first and then merged, so the result
+    does not depend on how the values were split into chunks.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return self
+        batch = RunningMoments()
+        batch.n = len(values)
+        batch.mean = float(values.mean())
+        deviations = values - batch.mean
+        batch.m2 = float(np.sum(deviations ** 2))
+        batch.m3 = float(np.sum(deviations ** 3))
+        batch.m4 = float(np.sum(deviations ** 4))
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        return self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        n_a, n_b = self.n, other.n
+        n = n_a + n_b
+        delta = other.mean - self.mean
+        m2 = self.m2 + other.m2 + delta ** 2 * n_a * n_b / n
+        m3 = (self.m3 + other.m3 + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+              + 3 * delta * (n_a * other.m2 - n_b * self.m2) / n)
+        m4 = (self.m4 + other.m4
+              + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3
+              + 6 * delta ** 2 * (n_a ** 2 * other.m2 + n_b ** 2 * self.m2) / n ** 2
+              + 4 * delta * (n_a * other.m3 - n_b * self.m3) / n)
+        self.n = n
+        self.mean = self.mean + delta * n_b / n
+        self.m2, self.m3, self.m4 = m2, m3, m4
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def std(self):
+        """Population standard deviation, like np.std"""
+        return np.sqrt(self.m2 / self.n)
+
+    def skew(self):
+        """Bias-corrected skewness, like pandas Series.skew"""
+        n = self.n
+        if n < 3 or self.m2 == 0:
+            return np.nan if n < 3 else 0.0
+        g1 = np.sqrt(n) * self.m3 / self.m2 ** 1.5
+        return np.sqrt(n * (n - 1)) / (n - 2) * g1
+
+    def kurtosis(self):
+        """Bias-corrected excess kurtosis, like pandas Series.kurtosis"""
+        n = self.n
+        if n < 4 or self.m2 == 0:
+            return np.nan if n < 4 else 0.0
+        g2 = n * self.m4 / self.m2 ** 2 - 3
+        return (n - 1) / ((n - 2) * (n - 3)) * ((n + 1) * g2 + 6)
+
+def slab_depth_for_budget(shape, memory_budget_bytes, reserved_bytes=0):
+    """Number of z slices per slab that fit in the memory budget"""
+    slice_bytes = shape[0] * shape[1] * SLAB_BYTES_PER_VOXEL
+    return int(max(1, min(shape[2], (memory_budget_bytes - reserved_bytes) // slice_bytes)))
+
+def estimate_full_load_bytes(shape):
+    """Approximate peak working memory of the in-memory kinetic extraction"""
+    return int(np.prod(shape[:3])) * FULL_LOAD_BYTES_PER_VOXEL
+
+def iter_z_slabs(paths, slab_depth):
+    """
+    Yield (z0, z1, [float64 slab per path]) over the z axis
+
+    Each slab is read through nibabel's dataobj proxy, so only slab_depth slices of
+    every volume are decoded at a time. Uncompressed files are memory-mapped;
+    gzip files are kept open and read forward.
+    """
+    images = [nib.load(path, mmap=True, keep_file_open=True) for path in paths]
+    n_slices = images[0].shape[2]
+    for z0 in range(0, n_slices, slab_depth):
+        z1 = min(z0 + slab_depth, n_slices)
+        yield z0, z1, [np.asarray(img.dataobj[:, :, z0:z1], dtype=np.float64) for img in images]
+
+def extract_kinetic_features_chunked(tp0_file, tp1_file, seg_file, memory_budget_mb=512, sketch_size=2048):
+    """
+    Slab-streaming version of CompleteDCEMRIPipeline.extract_kinetic_features
+
+    Reads the two timepoints and the mask in z-slabs sized to the memory budget,
+    writes the colormap labels slab by slab and merges per-slab statistics:
+    exact moments/counts/extrema, and a quantile sketch for the median,
+    percentiles and the enhancement-entropy histogram.
+
+    Returns:
+        (features dict with the same keys as extract_kinetic_features, uint8 colormap)
+    """
+    shape = nib.load(tp0_file).shape[:3]
+    colormap = np.zeros(shape, dtype=np.uint8)
+    slab_depth = slab_depth_for_budget(shape, memory_budget_mb * 1024 ** 2, reserved_bytes=colormap.nbytes)
+
+    moments = {'t0': RunningMoments(), 't1': RunningMoments(), 'change': RunningMoments()}
+    sketches = {name: QuantileSketch(k=sketch_size) for name in ['t0', 't1', 'change']}
+    counts = {'uptake': 0, 'plateau': 0, 'washout': 0, 'positive': 0, 'negative': 0}
+    uptake_sum = 0.0
+    washout_sum = 0.0
+
+    for z0, z1, (slab_0000, slab_0001, slab_mask) in iter_z_slabs([tp0_file, tp1_file, seg_file], slab_depth):
+        roi = slab_mask > 0
+        if not np.any(roi):
+            continue
+        values_0000 = slab_0000[roi]
+        values_0001 = slab_0001[roi]
+        change_values = ((values_0001 - values_0000) / (values_0000 + 1e-10)) * 100
+
+        # Same classification as the in-memory path
+        labels = np.zeros(len(change_values), dtype=np.uint8)
+        labels[change_values > 15] = 1
+        labels[(change_values <= 15) & (change_values >= -5)] = 2
+        labels[change_values < -5] = 3
+        colormap_slab = colormap[:, :, z0:z1]
+        colormap_slab[roi] = labels
+
+        for name, values in [('t0', values_0000), ('t1', values_0001), ('change', change_values)]:
+            moments[name].update(values)
+            sketches[name].update(values)
+        counts['uptake'] += int(np.sum(labels == 1))
+        counts['plateau'] += int(np.sum(labels == 2))
+        counts['washout'] += int(np.sum(labels == 3))
+        counts['positive'] += int(np.sum(change_values > 0))
+        counts['negative'] += int(np.sum(change_values < 0))
+        uptake_sum += float(np.sum(change_values[change_values > 15]))
+        washout_sum += float(np.sum(change_values[change_values < -5]))
+
+    roi_pixels = moments['change'].n
+    if roi_pixels == 0:
+        logger.warning("Empty ROI mask")
+        return {}, colormap
+
+    features = {
+        'total_roi_pixels': roi_pixels,
+        'uptake_pixels': counts['uptake'],
+        'plateau_pixels': counts['plateau'],
+        'washout_pixels': counts['washout'],
+        'uptake_percentage': counts['uptake'] / roi_pixels * 100,
+        'plateau_percentage': counts['plateau'] / roi_pixels * 100,
+        'washout_percentage': counts['washout'] / roi_pixels * 100,
+    }
+
+    for timepoint in ['t0', 't1']:
+        stats, sketch = moments[timepoint], sketches[timepoint]
+        features.update({
+            f'{timepoint}_mean_intensity': stats.mean,
+            f'{timepoint}_median_intensity': float(sketch.quantile(0.5)),
+            f'{timepoint}_std_intensity': stats.std(),
+            f'{timepoint}_skewness': float(stats.skew()),
+            f'{timepoint}_kurtosis': float(stats.kurtosis()),
+            f'{timepoint}_intensity_range': stats.max - stats.min,
+            f'{timepoint}_q25': float(sketch.quantile(0.25)),
+            f'{timepoint}_q75': float(sketch.quantile(0.75)),
+        })
+
+    change, change_sketch = moments['change'], sketches['change']
+    features.update({
+        'mean_intensity_change': change.mean,
+        'median_intensity_change': float(change_sketch.quantile(0.5)),
+        'std_intensity_change': change.std(),
+        'max_intensity_change': change.max,
+        'min_intensity_change': change.min,
+        'change_range': change.max - change.min,
+        'positive_change_ratio': counts['positive'] / roi_pixels,
+        'negative_change_ratio': counts['negative'] / roi_pixels,
+    })
+
+    features.update({
+        'kinetic_heterogeneity': change.std(),
+        'enhancement_entropy': sketch_histogram_entropy(change_sketch),
+        'washout_severity': washout_sum / counts['washout'] if counts['washout'] else 0,
+        'uptake_intensity': uptake_sum / counts['uptake'] if counts['uptake'] else 0,
+    })
+
+    return features, colormap
+
+def sketch_histogram_entropy(sketch, bins=10):
+    """Entropy of the equal-width histogram (like calculate_entropy) estimated from a quantile sketch"""
+    if sketch.count == 0:
+        return 0
+    edges = np.linspace(sketch.min, sketch.max, bins + 1)
+    cumulative = np.concatenate([[0.0], sketch.cdf(edges[1:-1]), [1.0]])
+    hist = np.diff(cumulative)
+    hist = hist[hist > 0]
+    return -np.sum(hist * np.log2(hist))
@@ -0,0 +1,238 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class ComBatHarmonizer:
+    """
+    ComBat harmonization with separate fit and transform steps
+
+    Implements the parametric empirical-Bayes ComBat model (Johnson et al. 2007)
+    as used by neuroCombat. The fitted location/scale parameters are kept so new
+    cases from known batches can be harmonized without refitting the cohort.
+
+    Data is laid out as features x samples, like neuroCombat.
+    """
+
+    def __init__(self, ref_batch=None, eb=True, mean_only=False, conv=1e-4, max_iter=1000):
+        self.ref_batch = ref_batch
+        self.eb = eb
+        self.mean_only = mean_only
+        self.conv = conv
+        self.max_iter = max_iter
+
+        self.batches = None
+        self.feature_names = None
+        self.grand_mean = None
+        self.var_pooled = None
+        self.gamma_hat = None
+        self.delta_hat = None
+        self.gamma_bar = None
+        self.t2 = None
+        self.a_prior = None
+        self.b_prior = None
+        self.gamma_star = None
+        self.delta_star = None
+        self.eb_iterations = None
+        self.eb_converged = None
+
+    def fit(self, data, batch, feature_names=None):
+        """Estimate per-batch location/scale and empirical-Bayes priors"""
+        data = np.asarray(data, dtype=np.float64)
+        batch = np.asarray(batch).astype(str)
+        if data.shape[1] != len(batch):
+            raise ValueError(f"Batch has {len(batch)} labels but data has {data.shape[1]} samples")
+
+        self.batches = np.unique(batch)
+        if len(self.batches) < 2:
+            raise ValueError("ComBat harmonization requires at least 2 batches")
+        if self.ref_batch is not None and str(self.ref_batch) not in self.batches:
+            raise ValueError(f"Reference batch '{self.ref_batch}' not found in batches {list(self.batches)}")
+        self.feature_names = None if feature_names is None else np.asarray(feature_names).astype(str)
+
+        batch_idx = [np.where(batch == b)[0] for b in self.batches]
+        batch_means = np.stack([data[:, idx].mean(axis=1) for idx in batch_idx])
+        n_per_batch = np.array([len(idx) for idx in batch_idx])
+        # A single sample has no variance, so such a batch gets a location adjustment only
+        location_only = n_per_batch < 2
+        if location_only.any() and not self.mean_only:
+            logger.warning("ComBat batches %s have a single sample; only their location is adjusted",
+                           ', '.join(self.batches[location_only]))
+
+        # Standardize across features
+        if self.ref_batch is not None:
+            ref = self._ref_level()
+            self.grand_mean = batch_means[ref]
+            residuals = data[:, batch_idx[ref]] - batch_means[ref][:, None]
+        else:
+            self.grand_mean = (n_per_batch / float(data.shape[1])) @ batch_means
+            residuals = data - batch_means[np.searchsorted(self.batches, batch)].T
+        self.var_pooled = np.mean(residuals ** 2, axis=1)
+        # Constant features carry no batch effect, keep them unscaled
+        self.var_pooled[self.var_pooled == 0] = 1.0
+        s_data = (data - self.grand_mean[:, None]) / np.sqrt(self.var_pooled)[:, None]
+
+        # Location/scale model and priors
+        self.gamma_hat = np.stack([s_data[:, idx].mean(axis=1) for idx in batch_idx])
+        if self.mean_only:
+            self.delta_hat = np.ones_like(self.gamma_hat)
+        else:
+            self.delta_hat = np.stack([np.var(s_data[:, idx], axis=1, ddof=1) if len(idx) > 1
+                                       else np.ones(data.shape[0]) for idx in batch_idx])
+            self.delta_hat[self.delta_hat == 0] = 1
+        self.gamma_bar = self.gamma_hat.mean(axis=1)
+        self.t2 = np.var(self.gamma_hat, axis=1, ddof=1)
+        if self.mean_only:
+            self.a_prior = None
+            self.b_prior = None
+        else:
+            m = self.delta_hat.mean(axis=1)
+            s2 = np.var(self.delta_hat, axis=1, ddof=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.a_prior = (2 * s2 + m ** 2) / s2
+                self.b_prior = (m * s2 + m ** 3) / s2
+            # No scale prior for a location-only batch (its delta_hat is constant)
+            self.a_prior[location_only] = np.nan
+            self.b_prior[location_only] = np.nan
+
+        # Empirical-Bayes adjustments
+        if not self.eb:
+            self.gamma_star = self.gamma_hat.copy()
+            self.delta_star = self.delta_hat.copy()
+        elif self.mean_only:
+            self.gamma_star = postmean(self.gamma_hat, self.gamma_bar[:, None], 1, 1, self.t2[:, None])
+            self.delta_star = np.ones_like(self.gamma_hat)
+        else:
+            levels = np.searchsorted(self.batches, batch)
+            self.gamma_star, self.delta_star = self._solve_eb(s_data, levels, n_per_batch, location_only)
+            self.gamma_star[location_only] = postmean(self.gamma_hat[location_only],
+                                                      self.gamma_bar[location_only, None], 1, 1,
+                                                      self.t2[location_only, None])
+            self.delta_star[location_only] = 1
+
+        if self.ref_batch is not None:
+            self.gamma_star[self._ref_level()] = 0
+            self.delta_star[self._ref_level()] = 1
+
+        return self
+
+    def _solve_eb(self, s_data, levels, n_per_batch, location_only):
+        """
+        Fixed-point iterations for the posterior location/scale of all batches and features at once
+
+        The per-batch sums of the standardized data are computed once, so every
+        iteration costs O(batches x features) regardless of the sample count.
+        Convergence is tracked per (batch, feature) cell and converged cells are
+        dropped from later iterations. Batches in location_only are not
+        iterated; the caller sets their parameters.
+        """
+        onehot = (levels[None, :] == np.arange(len(self.batches))[:, None]).astype(np.float64)
+        shape = self.gamma_hat.shape
+
+        # Flattened (batch, feature) cells, priors broadcast to one value per cell
+        def cells(values):
+            return np.broadcast_to(values, shape).ravel()
+        s1 = cells(onehot @ s_data.T)
+        s2 = cells(onehot @ (s_data ** 2).T)
+        n = cells(n_per_batch[:, None].astype(np.float64))
+        g_hat = cells(self.gamma_hat)
+        g_bar = cells(self.gamma_bar[:, None])
+        t2 = cells(self.t2[:, None])
+        a = cells(self.a_prior[:, None])
+        b = cells(self.b_prior[:, None])
+
+        g_old = g_hat.copy()
+        d_old = cells(self.delta_hat).copy()
+        iterations = np.zeros(g_old.shape, dtype=np.int64)
+        active = np.flatnonzero(~cells(location_only[:, None]))
+        for _ in range(self.max_iter):
+            g_new = postmean(g_hat[active], g_bar[active], n[active], d_old[active], t2[active])
+            sum2 = s2[active] - 2 * g_new * s1[active] + n[active] * g_new ** 2
+            d_new = postvar(sum2, n[active], a[active], b[active])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change = np.maximum(np.abs(g_new - g_old[active]) / np.abs(g_old[active]),
+                                    np.abs(d_new - d_old[active]) / d_old[active])
+            g_old[active] = g_new
+            d_old[active] = d_new
+            iterations[active] += 1
+            # Only unconverged cells are iterated again; 0/0 (no change at zero) counts as converged
+            active = active[change > self.conv]
+            if len(active) == 0:
+                break
+
+        self.eb_iterations = iterations.reshape(shape)
+        self.eb_converged = np.ones(shape, dtype=bool)
+        self.eb_converged.flat[active] = False
+        return g_old.reshape(shape), d_old.reshape(shape)
+
+    def transform(self, data, batch):
+        """Harmonize samples (features x samples) from batches seen during fit"""
+        if self.gamma_star is None:
+            raise RuntimeError("ComBatHarmonizer must be fitted before transform")
+        data = np.asarray(data, dtype=np.float64)
+        batch = np.asarray(batch).astype(str)
+        unknown = np.setdiff1d(np.unique(batch), self.batches)
+        if len(unknown) > 0:
+            raise ValueError(f"Batches {list(unknown)} were not part of the fitted data")
+
+        levels = np.searchsorted(self.batches, batch)
+        sd = np.sqrt(self.var_pooled)[:, None]
+        s_data = (data - self.grand_mean[:, None]) / sd
+        adjusted = (s_data - self.gamma_star[levels].T) / np.sqrt(self.delta_star[levels].T)
+        adjusted = adjusted * sd + self.grand_mean[:, None]
+
+        # Reference batch samples are kept as they are
+        if self.ref_batch is not None:
+            is_ref = levels == self._ref_level()
+            adjusted[:, is_ref] = data[:, is_ref]
+        return adjusted
+
+    def fit_transform(self, data, batch, feature_names=None):
+        return self.fit(data, batch, feature_names).transform(data, batch)
+
+    def _ref_level(self):
+        return int(np.searchsorted(self.batches, str(self.ref_batch)))
+
+    def save(self, path):
+        """Persist the fitted parameters as a .npz file"""
+        params = {
+            'batches': self.batches,
+            'ref_batch': np.array('' if self.ref_batch is None else str(self.ref_batch)),
+            'options': np.array([self.eb, self.mean_only]),
+            'grand_mean': self.grand_mean,
+            'var_pooled': self.var_pooled,
+            'gamma_star': self.gamma_star,
+            'delta_star': self.delta_star,
+            'gamma_hat': self.gamma_hat,
+            'delta_hat': self.delta_hat,
+            'gamma_bar': self.gamma_bar,
+            't2': self.t2,
+        }
+        if self.feature_names is not None:
+            params['feature_names'] = self.feature_names
+        if self.a_prior is not None:
+            params['a_prior'] = self.a_prior
+            params['b_prior'] = self.b_prior
+        np.savez(path, **params)
+
+    @classmethod
+    def load(cls, path):
+        """Load parameters written by save()"""
+        with np.load(path, allow_pickle=False) as params:
+            ref_batch = str(params['ref_batch'])
+            eb, mean_only = params['options']
+            harmonizer = cls(ref_batch=ref_batch or None, eb=bool(eb), mean_only=bool(mean_only))
+            harmonizer.batches = params['batches']
+            harmonizer.feature_names = params['feature_names'] if 'feature_names' in params else None
+            for name in ['grand_mean', 'var_pooled', 'gamma_star', 'delta_star',
+                         'gamma_hat', 'delta_hat', 'gamma_bar', 't2']:
+                setattr(harmonizer, name, params[name])
+            harmonizer.a_prior = params['a_prior'] if 'a_prior' in params else None
+            harmonizer.b_prior = params['b_prior'] if 'b_prior' in params else None
+        return harmonizer
+
+def postmean(g_hat, g_bar, n, d_star, t2):
+    return (t2 * n * g_hat + d_star * g_bar) / (t2 * n + d_star)
+
+def postvar(sum2, n, a, b):
+    return (0.5 * sum2 + b) / (n / 2.0 + a - 1.0)
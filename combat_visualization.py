@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
+from kinetic_curves import divergence_index, synthesize_kinetic_curves, plot_kinetic_curves
 
 def create_combat_visualization(use_real_data=False, output_path=None):
     """
@@ -100,45 +101,18 @@ def create_reference_curves(ax):
     t = np.linspace(0.0, 3.0, 100)
     
     # Initial common curve parameters (early enhancement)
-    initial_slope = 150
     max_intensity = 75
     
-    # Create base curve (common initial part up to divergence point)
+    # Divergence point - all curves share the same values up to here
     t_diverge = 1.3
-    idx_diverge = np.argmin(np.abs(t - t_diverge))
+    idx_diverge = divergence_index(t, t_diverge)
     
-    base_curve = np.zeros_like(t)
-    # First part - common for all curves
-    base_curve[:idx_diverge+1] = max_intensity * (1 - np.exp(-initial_slope * t[:idx_diverge+1]/max_intensity))
-    
-    # Create the three curve types, all sharing the same values up to divergence
-    uptake_curve = np.copy(base_curve)
-    plateau_curve = np.copy(base_curve)
-    washout_curve = np.copy(base_curve)
-    
-    # Value at divergence point - all curves meet here
-    diverge_value = base_curve[idx_diverge]
-    
-    # After divergence point - exactly match the sample image curves
-    # Slope calculations
-    uptake_slope = 5
-    plateau_slope = -3
-    washout_slope = -10
-    
-    # Apply slopes after divergence
-    for i in range(idx_diverge+1, len(t)):
-        dt = t[i] - t[idx_diverge]
-        uptake_curve[i] = diverge_value + dt * uptake_slope
-        plateau_curve[i] = diverge_value + dt * plateau_slope
-        washout_curve[i] = diverge_value + dt * washout_slope
+    # Slopes after divergence (uptake, plateau, washout)
+    slopes = [5, -3, -10]
+    curves = synthesize_kinetic_curves(t, max_intensity, slopes, idx_diverge)[0]
     
     # Plot curves with consistent colors
-    ax.plot(t, uptake_curve, color='#3274A1', linewidth=2, label='Uptake')
-    ax.plot(t, plateau_curve, color='#3A923A', linewidth=2, label='Plateau')
-    ax.plot(t, washout_curve, color='#C03D3E', linewidth=2, label='Washout')
-    
-    # Add reference line at divergence point
-    ax.axvline(x=t_diverge, color='gray', linestyle='--', alpha=0.7)
+    plot_kinetic_curves(ax, t, curves, t_diverge)
     
     # Set labels and title
     ax.set_title('Reference Kinetic Curves', fontsize=12, fontweight='bold')
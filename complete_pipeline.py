@@ -2,17 +2,35 @@ import os
 import nibabel as nib
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-import SimpleITK as sitk
-from radiomics.featureextractor import RadiomicsFeatureExtractor
-from radiomics import imageoperations
-from sklearn.preprocessing import MinMaxScaler, StandardScaler, RobustScaler
-from neuroCombat import neuroCombat
+from feature_scaling import SCALERS, scaler_path, save_scaler, load_scaler
+from combat_harmonization import ComBatHarmonizer
+from dce_kinetics import find_phase_files, phase_numbers, extract_multiphase_kinetics
+from chunked_kinetics import extract_kinetic_features_chunked, estimate_full_load_bytes
+from volume_cache import VolumeCache
+from blocked_gzip import load_nifti_images, save_nifti_blocked
+from slice_pyramid import build_slice_pyramid
+from pipeline_metrics import PipelineMetrics
+from streaming_executor import StreamingExecutor
+from memory_scheduler import MemoryScheduler, previous_roi_sizes
+from preflight import run_preflight, failure_reason
+from radiomics_manifest import load_manifest
+from texture_cache import TextureCache
+from pipeline_logging import configure_logging, case_context, ProgressReporter
+from case_shards import SHARD_DIR, select_cases, read_case_list, partition_name, partition_path, write_partition, read_partitions
 import glob
+import logging
+import argparse
+import threading
+import contextvars
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
+# pyradiomics, SimpleITK and matplotlib are imported by the stages that use them,
+# so normalization/harmonization-only runs and short-lived jobs start quickly
+
+logger = logging.getLogger('pipeline')
+
 class CompleteDCEMRIPipeline:
     """
     Complete DCE-MRI Analysis Pipeline
@@ -28,8 +46,28 @@ class CompleteDCEMRIPipeline:
     Everything in one script for complete project workflow.
     """
     
-    def __init__(self, apply_normalization=True):
+    def __init__(self, apply_normalization=True, combat_ref_batch=None, normalization_method='minmax',
+                 memory_budget_mb=None, volume_cache_dir=None, volume_cache_mb=4096, metrics=None,
+                 radiomics_workers=None, radiomics_manifest=None):
+        # Constructor settings, so worker processes can build an identical pipeline
+        self.config = {
+            'apply_normalization': apply_normalization,
+            'combat_ref_batch': combat_ref_batch,
+            'normalization_method': normalization_method,
+            'memory_budget_mb': memory_budget_mb,
+            'volume_cache_dir': volume_cache_dir,
+            'volume_cache_mb': volume_cache_mb,
+            'radiomics_workers': radiomics_workers,
+            'radiomics_manifest': radiomics_manifest
+        }
         self.apply_normalization = apply_normalization
+        # Per-case/stage timing, CPU and peak RSS (pipeline_metrics.jsonl under base_dir by default)
+        self.metrics = metrics or PipelineMetrics()
+        self.memory_budget_mb = memory_budget_mb  # Stream kinetics in z-slabs above this working-set size
+        # Decompressed .nii copies shared by every stage (and by concurrent workers)
+        self.volume_cache = VolumeCache(volume_cache_dir, max_bytes=volume_cache_mb * 1024 ** 2) if volume_cache_dir else None
+        self.normalization_method = normalization_method  # 'minmax' or 'robust'
+        self.combat_ref_batch = combat_ref_batch  # Dataset kept fixed by ComBat (e.g. 'DUKE')
         self.radiomics_settings = {
             'interpolator': 'sitkBSpline',
             'level': 1,
@@ -39,11 +77,40 @@ class CompleteDCEMRIPipeline:
             'normalize': False,  # We'll handle normalization separately
             'resampledPixelSpacing': [1, 1, 1]
         }
-        
-        # Initialize radiomics extractor
-        self.radiomics_extractor = RadiomicsFeatureExtractor(**self.radiomics_settings)
-        print("Complete DCE-MRI Pipeline initialized")
-        print("Features: Enhanced kinetics + Radiomics + ComBat harmonization")
+        # Image types, feature classes and features to compute (radiomics_manifest.json by default)
+        self.radiomics_manifest = load_manifest(radiomics_manifest)
+        # Latency mode: t0/t1 radiomics run concurrently and their feature classes in this many processes
+        self.radiomics_workers = radiomics_workers
+        # Radiomics extractor, created on first use (see radiomics_extractor)
+        self._radiomics_extractor = None
+        self._radiomics_extractor_lock = threading.Lock()
+        logger.info("Complete DCE-MRI Pipeline initialized")
+        logger.info("Features: Enhanced kinetics + Radiomics + ComBat harmonization")
+
+    @property
+    def radiomics_extractor(self):
+        """pyradiomics feature extractor, created (and pyradiomics imported) on first use"""
+        if self._radiomics_extractor is None:
+            with self._radiomics_extractor_lock:
+                if self._radiomics_extractor is None and self.radiomics_workers:
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    from parallel_radiomics import ParallelFeatureExtractor
+                    # spawn: the pool starts while reader/writer threads are running, which fork does not survive
+                    pool = ProcessPoolExecutor(self.radiomics_workers, mp_context=multiprocessing.get_context('spawn'))
+                    self._radiomics_extractor = ParallelFeatureExtractor(
+                        pool, manifest=self.radiomics_manifest, metrics=self.metrics, **self.radiomics_settings)
+                elif self._radiomics_extractor is None:
+                    from parallel_radiomics import TimedFeatureExtractor
+                    self._radiomics_extractor = TimedFeatureExtractor(
+                        manifest=self.radiomics_manifest, metrics=self.metrics, **self.radiomics_settings)
+        return self._radiomics_extractor
+
+    def close(self):
+        """Shut down the latency-mode radiomics processes, if they were started"""
+        executor = getattr(self._radiomics_extractor, 'executor', None)
+        if executor is not None:
+            executor.shutdown()
 
     def extract_kinetic_features(self, img_0000, img_0001, mask):
         """Enhanced kinetic feature extraction"""
@@ -51,7 +118,7 @@ class CompleteDCEMRIPipeline:
         roi = mask > 0
         
         if not np.any(roi):
-            print("    Warning: Empty ROI mask")
+            logger.warning("Empty ROI mask")
             return {}, np.zeros_like(img_0000, dtype=np.uint8)
         
         # Calculate intensity changes
@@ -137,16 +204,24 @@ class CompleteDCEMRIPipeline:
 
     def extract_radiomics_features(self, image_path, mask_path, label=1):
         """Extract radiomics features using pyradiomics"""
+        import SimpleITK as sitk
         try:
-            # Load image and mask
-            image = sitk.ReadImage(image_path)
-            mask = sitk.ReadImage(mask_path)
+            # Load image and mask (unless already read by the streaming executor)
+            with self.metrics.stage('load'):
+                image = image_path if isinstance(image_path, sitk.Image) else sitk.ReadImage(image_path)
+                mask = mask_path if isinstance(mask_path, sitk.Image) else sitk.ReadImage(mask_path)
             
             # Resample mask to match image
-            mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor)
+            with self.metrics.stage('resample'):
+                mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor)
             
             # Extract features
-            features = self.radiomics_extractor.execute(image, mask, label)
+            with self.metrics.stage('extract'):
+                extractor = self.radiomics_extractor
+                if not self.radiomics_workers:
+                    # The texture classes of this image share one discretization; the cache ends with the call
+                    extractor = extractor.with_cache(TextureCache())
+                features = extractor.execute(image, mask, label)
             
             # Convert to regular Python types
             clean_features = {}
@@ -159,25 +234,47 @@ class CompleteDCEMRIPipeline:
             return clean_features
             
         except Exception as e:
-            print(f"Error extracting radiomics features: {e}")
+            logger.error("Error extracting radiomics features: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            self.metrics.record_error(e)
             return {}
     
     def extract_temporal_radiomics(self, img_0000_path, img_0001_path, mask_path):
         """Extract radiomics from both timepoints and calculate temporal features"""
         # Extract from both timepoints
-        features_t0 = self.extract_radiomics_features(img_0000_path, mask_path, label=1)
-        features_t1 = self.extract_radiomics_features(img_0001_path, mask_path, label=1)
+        if self.radiomics_workers:
+            # Latency mode: t1 is extracted in a second thread (same case record and log context)
+            record = self.metrics.current_case()
+            
+            def extract_t1():
+                with self.metrics.resume(record):
+                    with self.metrics.stage('radiomics_t1'):
+                        return self.extract_radiomics_features(img_0001_path, mask_path, label=1)
+            
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                future_t1 = pool.submit(contextvars.copy_context().run, extract_t1)
+                with self.metrics.stage('radiomics_t0'):
+                    features_t0 = self.extract_radiomics_features(img_0000_path, mask_path, label=1)
+                features_t1 = future_t1.result()
+        else:
+            with self.metrics.stage('radiomics_t0'):
+                features_t0 = self.extract_radiomics_features(img_0000_path, mask_path, label=1)
+            with self.metrics.stage('radiomics_t1'):
+                features_t1 = self.extract_radiomics_features(img_0001_path, mask_path, label=1)
         
         # Combine features with temporal prefixes
         combined_features = {}
         
-        # Add timepoint-specific features
+        # Add timepoint-specific features: every image type the manifest enables,
+        # plus the diagnostics of the original image
+        def keep(key):
+            return not key.startswith('diagnostics_') or 'original' in key.lower()
+        
         for key, value in features_t0.items():
-            if 'original' in key.lower():
+            if keep(key):
                 combined_features[f't0_{key}'] = value
                 
         for key, value in features_t1.items():
-            if 'original' in key.lower():
+            if keep(key):
                 combined_features[f't1_{key}'] = value
         
         # Calculate temporal changes for first-order features
@@ -195,249 +292,504 @@ class CompleteDCEMRIPipeline:
         return combined_features
     def save_colormap_files(self, case_id, case_path, img_0000, colormap, mask, tp0_file):
         """Save RGB NIfTI colormap and PNG visualization"""
+        from matplotlib.figure import Figure
+        from matplotlib.colors import ListedColormap
         
         # Import the convert_to_rgb_nifti function from rgb_nifti_converter
         from rgb_nifti_converter import convert_to_rgb_nifti
         
         # Save RGB-encoded NIfTI for visualization in Mango and other viewers
         rgb_nifti_out_path = os.path.join(case_path, f"{case_id}_colormap.nii.gz")  
-        convert_to_rgb_nifti(tp0_file, colormap, rgb_nifti_out_path)
+        with self.metrics.stage('rgb_nifti'):
+            convert_to_rgb_nifti(tp0_file, colormap, rgb_nifti_out_path, volume=img_0000)
         
         # 2. Create enhanced PNG visualization
-        colors = [
-            (0, 0, 0, 0),      # Transparent for background
-            (0, 0, 1, 0.7),    # Pure Blue with alpha for Uptake
-            (0, 1, 0, 0.7),    # Pure Green with alpha for Plateau
-            (1, 0, 0, 0.7)     # Pure Red with alpha for Washout
-        ]
-        custom_cmap = ListedColormap(colors)
-        
-        # Find central slice with ROI
-        roi_slices = [z for z in range(colormap.shape[2]) if np.any(mask[:,:,z])]
-        slice_idx = roi_slices[len(roi_slices) // 2] if roi_slices else colormap.shape[2] // 2
-        
-        fig, ax = plt.subplots(figsize=(12, 10))
-        ax.imshow(img_0000[:, :, slice_idx].T, cmap='gray', origin='lower', aspect='auto')
-        im = ax.imshow(colormap[:, :, slice_idx].T, cmap=custom_cmap, vmin=0, vmax=3, 
-                      origin='lower', aspect='auto', alpha=0.7)
-        
-        # Add colorbar
-        cbar = plt.colorbar(im, ax=ax, ticks=[0.375, 1.125, 1.875, 2.625], fraction=0.046, pad=0.04)
-        cbar.ax.set_yticklabels(['Background', 'Uptake', 'Plateau', 'Washout'])
-        cbar.ax.tick_params(labelsize=10)
-        
-        ax.set_title(f'Complete Pipeline Analysis - {case_id} - Slice {slice_idx}', fontsize=14)
-        ax.axis('off')
-        
-        plt.tight_layout()
-        png_out_path = os.path.join(case_path, f"{case_id}_complete_colormap.png")
-        plt.savefig(png_out_path, dpi=200, bbox_inches='tight')
-        plt.close()
-        print(f"    Saved PNG visualization: {png_out_path}")
-
-    def process_case(self, case_id, case_path, segment_dir):
-        """Process a single case with complete feature extraction"""
-        try:
-            # Find image files
-            tp0_file = None
-            tp1_file = None
-            
-            for file in os.listdir(case_path):
-                if file.endswith('.nii.gz'):
-                    if '_0000.nii.gz' in file:
-                        tp0_file = os.path.join(case_path, file)
-                    elif '_0001.nii.gz' in file:
-                        tp1_file = os.path.join(case_path, file)
-            
-            if not tp0_file or not tp1_file:
-                print(f"    Missing timepoint files for {case_id}")
-                return None
+        with self.metrics.stage('png'):
+            colors = [
+                (0, 0, 0, 0),      # Transparent for background
+                (0, 0, 1, 0.7),    # Pure Blue with alpha for Uptake
+                (0, 1, 0, 0.7),    # Pure Green with alpha for Plateau
+                (1, 0, 0, 0.7)     # Pure Red with alpha for Washout
+            ]
+            custom_cmap = ListedColormap(colors)
             
-            # Find segmentation file
-            seg_file = os.path.join(segment_dir, f"{case_id}.nii.gz")
-            if not os.path.exists(seg_file):
-                print(f"    Segmentation file not found: {seg_file}")
-                return None
-                
-            print(f"    Processing {case_id}...")
-            print(f"    Files - TP0: {os.path.basename(tp0_file)}, TP1: {os.path.basename(tp1_file)}, Seg: {os.path.basename(seg_file)}")
+            # Find central slice with ROI (labelled voxels when the mask was streamed)
+            roi = mask if mask is not None else colormap
+            roi_slices = np.flatnonzero(np.any(roi, axis=(0, 1)))
+            slice_idx = int(roi_slices[len(roi_slices) // 2]) if len(roi_slices) else colormap.shape[2] // 2
+            
+            # Without the full volume in memory, read just the displayed slice
+            if img_0000 is None:
+                background = np.asarray(nib.load(tp0_file).dataobj[:, :, slice_idx], dtype=np.float64)
+            else:
+                background = img_0000[:, :, slice_idx]
+            
+            # Figure without pyplot: no global state, so writer threads can save PNGs concurrently
+            fig = Figure(figsize=(12, 10))
+            ax = fig.subplots()
+            ax.imshow(background.T, cmap='gray', origin='lower', aspect='auto')
+            im = ax.imshow(colormap[:, :, slice_idx].T, cmap=custom_cmap, vmin=0, vmax=3, 
+                          origin='lower', aspect='auto', alpha=0.7)
+            
+            # Add colorbar
+            cbar = fig.colorbar(im, ax=ax, ticks=[0.375, 1.125, 1.875, 2.625], fraction=0.046, pad=0.04)
+            cbar.ax.set_yticklabels(['Background', 'Uptake', 'Plateau', 'Washout'])
+            cbar.ax.tick_params(labelsize=10)
+            
+            ax.set_title(f'Complete Pipeline Analysis - {case_id} - Slice {slice_idx}', fontsize=14)
+            ax.axis('off')
+            
+            fig.tight_layout()
+            png_out_path = os.path.join(case_path, f"{case_id}_complete_colormap.png")
+            fig.savefig(png_out_path, dpi=200, bbox_inches='tight')
+            logger.debug("Saved PNG visualization: %s", png_out_path)
+        
+        # 3. Multi-resolution slice pyramid for the web slice viewer
+        pyramid_out_path = os.path.join(case_path, f"{case_id}_slice_pyramid.bin")
+        with self.metrics.stage('slice_pyramid'):
+            build_slice_pyramid(pyramid_out_path, tp0_file, colormap, volume=img_0000)
+
+    def load_case(self, case_id, case_path, segment_dir, prefetch_images=False):
+        """
+        Locate a case's files and read its volumes
+        
+        Args:
+            prefetch_images: Also read every phase and the SimpleITK radiomics inputs
+                             now, so later steps do no file I/O (used by the streaming executor)
+        
+        Returns:
+            Dict of paths and loaded arrays, or None when input files are missing.
+            Pass it to release_case once the case's outputs are written.
+        """
+        # Find image files - all DCE phases (_0000, _0001, ... _000N)
+        phase_files = find_phase_files(case_path)
+        tp0_file = next((f for f in phase_files if f.endswith('_0000.nii.gz')), None)
+        tp1_file = next((f for f in phase_files if f.endswith('_0001.nii.gz')), None)
+        
+        if not tp0_file or not tp1_file:
+            logger.warning("Missing timepoint files")
+            self.metrics.mark_failed("Missing timepoint files")
+            return None
+        
+        # Find segmentation file
+        seg_file = os.path.join(segment_dir, f"{case_id}.nii.gz")
+        if not os.path.exists(seg_file):
+            logger.warning("Segmentation file not found: %s", seg_file)
+            self.metrics.mark_failed("Segmentation file not found")
+            return None
         
-            # Load images for kinetic analysis
-            img_0000 = nib.load(tp0_file).get_fdata()
-            img_0001 = nib.load(tp1_file).get_fdata()
-            mask = nib.load(seg_file).get_fdata()
+        logger.debug("Files - TP0: %s, TP1: %s, Seg: %s (%d phases)", os.path.basename(tp0_file),
+                     os.path.basename(tp1_file), os.path.basename(seg_file), len(phase_files))
+        
+        # Phase numbers from the file names, before cache paths replace them (a missing phase leaves a gap)
+        time_points = phase_numbers(phase_files)
+        
+        # Read every volume from its decompressed copy when the cache is enabled,
+        # pinned so that other workers cannot evict it until release_case
+        pins = []
+        if self.volume_cache is not None:
+            def cached(path):
+                cached_path, pin = self.volume_cache.pin(path)
+                pins.append(pin)
+                return cached_path
+            tp0_file, tp1_file, seg_file = [cached(f) for f in (tp0_file, tp1_file, seg_file)]
+            phase_files = [cached(f) for f in phase_files]
+        
+        inputs = {
+            'case_id': case_id,
+            'case_path': case_path,
+            'phase_files': phase_files,
+            'time_points': time_points,
+            'tp0_file': tp0_file,
+            'tp1_file': tp1_file,
+            'seg_file': seg_file,
+            'volumes': None,
+            'later_phases': {},
+            'images': None,
+            'pins': pins
+        }
+        try:
+            return self._read_case(inputs, prefetch_images)
+        except BaseException:
+            self.release_case(inputs)
+            raise
+    
+    def _read_case(self, inputs, prefetch_images):
+        tp0_file, tp1_file, seg_file, phase_files = (inputs[key] for key in ('tp0_file', 'tp1_file', 'seg_file', 'phase_files'))
+        volume_shape = nib.load(tp0_file).shape
+        inputs['chunked'] = bool(self.memory_budget_mb and
+                                 estimate_full_load_bytes(volume_shape) > self.memory_budget_mb * 1024 ** 2)
+        if inputs['chunked']:
+            # Volume too large for the budget - kinetics stream z-slabs instead of loading whole volumes
+            logger.info("Using slab streaming for %s volume (budget %s MB)", volume_shape, self.memory_budget_mb)
+            return inputs
+        
+        # Load images for kinetic analysis (decompressed concurrently)
+        with self.metrics.stage('load'):
+            paths = [tp0_file, tp1_file, seg_file] + (phase_files[2:] if prefetch_images else [])
+            images = load_nifti_images(paths)
+            inputs['volumes'] = tuple(img.get_fdata() for img in images[:3])
+            # Later phases keep their stored dtype, as when extract_multiphase_kinetics reads them
+            inputs['later_phases'] = {t: np.asarray(img.dataobj) for t, img in enumerate(images[3:], start=2)}
+        
+        if prefetch_images:
+            import SimpleITK as sitk
+            with self.metrics.stage('load_radiomics'):
+                inputs['images'] = tuple(sitk.ReadImage(path) for path in (tp0_file, tp1_file, seg_file))
+        return inputs
+    
+    def release_case(self, inputs):
+        """Unpin a loaded case's cached volumes once its outputs are written"""
+        if self.volume_cache is not None:
+            for pin in inputs.get('pins', ()):
+                self.volume_cache.unpin(pin)
+            inputs['pins'] = []
+
+    def compute_case(self, inputs):
+        """Kinetic, multi-phase and radiomics features of a loaded case; returns (features, colormap)"""
+        phase_files, tp0_file, tp1_file, seg_file = (inputs[key] for key in ('phase_files', 'tp0_file', 'tp1_file', 'seg_file'))
+        if inputs['chunked']:
+            with self.metrics.stage('kinetics_chunked'):
+                kinetic_features, colormap = extract_kinetic_features_chunked(
+                    tp0_file, tp1_file, seg_file, memory_budget_mb=self.memory_budget_mb)
+            with self.metrics.stage('multiphase_kinetics'):
+                multiphase_features, _ = extract_multiphase_kinetics(phase_files, colormap,
+                                                                     time_points=inputs['time_points'])
+        else:
+            img_0000, img_0001, mask = inputs['volumes']
             
             # Extract kinetic features
-            kinetic_features, colormap = self.extract_kinetic_features(img_0000, img_0001, mask)
+            with self.metrics.stage('kinetics'):
+                kinetic_features, colormap = self.extract_kinetic_features(img_0000, img_0001, mask)
             
-            # Extract radiomics features from both timepoints
-            radiomics_features = self.extract_temporal_radiomics(tp0_file, tp1_file, seg_file)
+            # Kinetic curve descriptors over all phases (phases 0 and 1 are already loaded)
+            with self.metrics.stage('multiphase_kinetics'):
+                multiphase_features, _ = extract_multiphase_kinetics(
+                    phase_files, mask, time_points=inputs['time_points'],
+                    loaded_phases={0: img_0000, 1: img_0001, **inputs['later_phases']})
+        
+        # Extract radiomics features from both timepoints
+        radiomics_sources = inputs['images'] or (tp0_file, tp1_file, seg_file)
+        radiomics_features = self.extract_temporal_radiomics(*radiomics_sources)
+        
+        # Combine all features
+        all_features = {
+            'case_id': inputs['case_id'],
+            **kinetic_features,
+            **multiphase_features,
+            **radiomics_features
+        }
+        return all_features, colormap
+
+    def write_case(self, inputs, colormap):
+        """Save the colormap files (NIfTI, PNG and slice pyramid) of a computed case"""
+        img_0000, mask = (inputs['volumes'][0], inputs['volumes'][2]) if inputs['volumes'] is not None else (None, None)
+        self.save_colormap_files(inputs['case_id'], inputs['case_path'], img_0000, colormap, mask, inputs['tp0_file'])
+
+    def process_case(self, case_id, case_path, segment_dir):
+        """Process a single case with complete feature extraction"""
+        inputs = None
+        try:
+            inputs = self.load_case(case_id, case_path, segment_dir)
+            if inputs is None:
+                return None
             
-            # Combine all features
-            all_features = {
-                'case_id': case_id,
-                **kinetic_features,
-                **radiomics_features
-            }
+            all_features, colormap = self.compute_case(inputs)
             
             # Save colormap files (both NIfTI and PNG)
-            self.save_colormap_files(case_id, case_path, img_0000, colormap, mask, tp0_file)
+            self.write_case(inputs, colormap)
             
             return all_features
             
         except Exception as e:
-            print(f"    Error processing {case_id}: {e}")
+            logger.error("Error processing case: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            self.metrics.record_error(e)
             return None
+        finally:
+            if inputs is not None:
+                self.release_case(inputs)
 
-    def apply_comprehensive_normalization(self, features_df):
-        """Apply multiple normalization techniques"""
+    def apply_comprehensive_normalization(self, features_df, scaler_dir=None, refit=False):
+        """
+        Apply feature normalization with persisted scaler parameters
+        
+        When scaler_dir holds a scaler for this feature table version (same numeric
+        columns), it is reused so new cases are transformed without changing the
+        values of previously normalized cases. Otherwise a new scaler is fitted and saved.
+        Min-max values of cases outside the fitted range are clipped to 0-1.
+        """
         numeric_columns = features_df.select_dtypes(include=[np.number]).columns
         numeric_columns = [col for col in numeric_columns if col != 'case_id']
         normalized_df = features_df.copy()
         
-        # Min-Max Scaling (0-1 range)
-        scaler_minmax = MinMaxScaler()
-        normalized_df[numeric_columns] = scaler_minmax.fit_transform(features_df[numeric_columns])
+        path = scaler_path(scaler_dir, self.normalization_method, numeric_columns) if scaler_dir else None
+        if path and os.path.exists(path) and not refit:
+            scaler = load_scaler(path)
+            logger.info("Using saved %s scaler: %s", self.normalization_method, path)
+        else:
+            # Min-Max Scaling (0-1 range) by default
+            scaler = SCALERS[self.normalization_method](columns=numeric_columns).fit(features_df)
+            if path:
+                save_scaler(scaler, path)
+                logger.info("Saved %s scaler: %s", self.normalization_method, path)
+        
+        normalized_df[numeric_columns] = scaler.transform(features_df)
         
         return normalized_df
 
-    def apply_combat_harmonization(self, features_df):
-        """Apply ComBat harmonization to features"""
+    def apply_combat_harmonization(self, features_df, params_path=None):
+        """Apply ComBat harmonization to features and optionally persist the fitted parameters"""
         try:
             # Extract dataset information from case_id
             features_df['dataset'] = features_df['case_id'].str.split('_').str[0]
             datasets = features_df['dataset'].unique()
             
             if len(datasets) < 2:
-                print("Warning: ComBat harmonization requires at least 2 datasets")
+                logger.warning("ComBat harmonization requires at least 2 datasets")
                 return features_df.drop('dataset', axis=1)
             
-            print(f"Applying ComBat harmonization across datasets: {datasets}")
+            logger.info("Applying ComBat harmonization across datasets: %s", list(datasets))
             
-            # Prepare data for neuroCombat
+            # Prepare data for ComBat
             numeric_columns = features_df.select_dtypes(include=[np.number]).columns
             numeric_columns = [col for col in numeric_columns if col not in ['case_id']]
             
             if len(numeric_columns) == 0:
-                print("Warning: No numeric features found for harmonization")
+                logger.warning("No numeric features found for harmonization")
                 return features_df.drop('dataset', axis=1)
             
             # Create batch variable (dataset indicator)
             batch = features_df['dataset'].values
             
-            # Apply neuroCombat
-            data_matrix = features_df[numeric_columns].T.values  # neuroCombat expects features x samples
-            
-            # Apply ComBat harmonization
-            harmonized_data = neuroCombat(
-                dat=data_matrix,
-                batch=batch,
-                mod=None,  # No additional covariates
-                par_prior=True,
-                prior_plots=False,
-                mean_only=False,
-                ref_batch=None,
-                eb=True
-            )["data"]
+            # ComBat expects features x samples
+            data_matrix = features_df[numeric_columns].T.values
+            
+            # Fit ComBat (location/scale + empirical-Bayes priors) and harmonize the cohort
+            harmonizer = ComBatHarmonizer(ref_batch=self.combat_ref_batch, eb=True, mean_only=False)
+            harmonized_data = harmonizer.fit_transform(data_matrix, batch, feature_names=numeric_columns)
+            
+            if params_path:
+                harmonizer.save(params_path)
+                logger.info("ComBat parameters saved: %s", params_path)
             
             # Create harmonized dataframe
             harmonized_df = features_df.copy()
             harmonized_df[numeric_columns] = harmonized_data.T
             
-            print(f"    ComBat harmonization completed for {len(numeric_columns)} features across {len(datasets)} datasets")
+            logger.info("ComBat harmonization completed for %d features across %d datasets", len(numeric_columns), len(datasets))
             return harmonized_df.drop('dataset', axis=1)
             
         except Exception as e:
-            print(f"Error in ComBat harmonization: {e}")
-            print("Returning original features without harmonization")
+            logger.error("Error in ComBat harmonization: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            logger.warning("Returning original features without harmonization")
             if 'dataset' in features_df.columns:
                 return features_df.drop('dataset', axis=1)
             return features_df
 
-    def process_all_datasets(self, base_dir):
-        """Process all datasets with complete pipeline"""
-        print("=== Complete DCE-MRI Analysis Pipeline ===")
-        print("Processing all datasets with:")
-        print("• Enhanced kinetic analysis")
-        print("• Comprehensive radiomics")
-        print("• NIfTI colormap creation")
-        print("• PNG visualizations")
-        print("• ComBat harmonization")
-        print("• Final CSV export")
-        print()
-        
-        all_features = []
-        
-        # Process each dataset
-        for dataset in ['DUKE', 'ISPY1', 'ISPY2', 'NACT']:
+    def harmonize_new_cases(self, features_df, params_path):
+        """Harmonize new cases from known datasets with previously fitted ComBat parameters"""
+        harmonizer = ComBatHarmonizer.load(params_path)
+        feature_columns = list(harmonizer.feature_names)
+        
+        missing_columns = [col for col in feature_columns if col not in features_df.columns]
+        if missing_columns:
+            raise ValueError(f"New cases are missing {len(missing_columns)} harmonized features, e.g. {missing_columns[:3]}")
+        
+        batch = features_df['case_id'].str.split('_').str[0].values
+        harmonized_data = harmonizer.transform(features_df[feature_columns].T.values.astype(np.float64), batch)
+        
+        harmonized_df = features_df.copy()
+        harmonized_df[feature_columns] = harmonized_data.T
+        return harmonized_df
+
+    def find_cases(self, base_dir, datasets=('DUKE', 'ISPY1', 'ISPY2', 'NACT')):
+        """All cases under base_dir as (dataset, case_id, case_path, segment_dir), sorted per dataset"""
+        cases = []
+        for dataset in datasets:
             dataset_dir = os.path.join(base_dir, dataset)
             segment_dir = os.path.join(dataset_dir, 'segment')
             
             if not os.path.exists(dataset_dir) or not os.path.exists(segment_dir):
-                print(f"Skipping {dataset} - directory not found")
+                logger.info("Skipping %s - directory not found", dataset)
                 continue
-                
-            print(f"\n--- Processing {dataset} dataset ---")
             
             # Find all case directories
             case_dirs = [d for d in os.listdir(dataset_dir) 
                         if os.path.isdir(os.path.join(dataset_dir, d)) and d != 'segment']
             
-            print(f"Found {len(case_dirs)} cases in {dataset}")
-            
-            for case_id in sorted(case_dirs):
-                case_path = os.path.join(dataset_dir, case_id)
-                features = self.process_case(case_id, case_path, segment_dir)
-                
-                if features:
-                    all_features.append(features)
-                    print(f"    ✓ {case_id} completed")
-                else:
-                    print(f"    ✗ {case_id} failed")
+            logger.info("Found %d cases in %s", len(case_dirs), dataset)
+            cases.extend((dataset, case_id, os.path.join(dataset_dir, case_id), segment_dir) for case_id in sorted(case_dirs))
+        return cases
+
+    def process_all_datasets(self, base_dir, progress_interval=10.0, shard_index=None, shard_count=None,
+                             case_list=None, prefetch_cases=0, ram_budget_mb=None, workers=None, preflight=False,
+                             preflight_gzip=False, refit_scaler=False):
+        """
+        Process all datasets with complete pipeline
+        
+        With shard_index/shard_count or a case_list file only that slice of the
+        cases is processed and its features are written to a partition under
+        base_dir/shards; merge_shards then builds the feature tables once.
         
+        With prefetch_cases > 0 cases run through a StreamingExecutor: the next
+        cases are read and decoded while the current one is computed, and
+        outputs are written in the background.
+        
+        With ram_budget_mb cases run in worker processes admitted by a
+        MemoryScheduler: largest estimated cases first, never more at once than
+        the estimated memory budget allows.
+        
+        With preflight every case's headers, geometry and mask are checked
+        first (preflight_report.csv), in `workers` threads; rejected cases are
+        recorded as failed without being processed. preflight_gzip also
+        streams every .nii.gz to validate its CRC, which inflates each input
+        once more before extraction.
+        
+        With refit_scaler the normalization scaler is fitted anew on this run's
+        cases instead of reusing the saved one.
+        
+        Returns:
+            Harmonized features, or the shard's raw features when sharded
+        """
+        logger.info("=== Complete DCE-MRI Analysis Pipeline ===")
+        logger.info("Steps: kinetics, radiomics, NIfTI colormaps, PNG visualizations, ComBat harmonization, CSV export")
+        
+        sharded = shard_count is not None or case_list is not None
+        case_ids = read_case_list(case_list) if case_list else None
+        shard_name = partition_name(shard_index, shard_count, case_ids) if sharded else None
+        if sharded:
+            # Nodes share base_dir, so each shard keeps its own metrics file
+            os.makedirs(os.path.join(base_dir, SHARD_DIR), exist_ok=True)
+            self.metrics.set_output(os.path.join(base_dir, SHARD_DIR, f"pipeline_metrics_{shard_name}.jsonl"))
+        else:
+            self.metrics.set_output(os.path.join(base_dir, 'pipeline_metrics.jsonl'))
+        
+        # Collect the cases of each dataset first so progress can report an ETA
+        cases = self.find_cases(base_dir)
+        if sharded:
+            cases = select_cases(cases, shard_index, shard_count, case_ids)
+            logger.info("Shard %s: %d cases", shard_name, len(cases))
+        
+        # Process each case
+        results = []
+        progress = ProgressReporter(len(cases), interval=progress_interval)
+        
+        def case_error(record):
+            return record['errors'][0]['message'] if record['errors'] else None
+        
+        if preflight:
+            report_path = (os.path.join(base_dir, SHARD_DIR, f"preflight_{shard_name}.csv") if sharded
+                           else os.path.join(base_dir, 'preflight_report.csv'))
+            with self.metrics.stage('preflight'):
+                checks = run_preflight(cases, workers=workers, check_gzip=preflight_gzip, report_path=report_path)
+            rejected = {check['case_id']: check for check in checks if check['status'] == 'error'}
+            for dataset, case_id, _, _ in cases:
+                if case_id in rejected:
+                    with case_context(case_id):
+                        with self.metrics.case(case_id, dataset) as record:
+                            self.metrics.mark_failed(failure_reason(rejected[case_id]))
+                    results.append((case_id, None, case_error(record)))
+                    progress.case_done(case_id, ok=False, stages=record['stages'], error=case_error(record))
+            cases = [case for case in cases if case[1] not in rejected]
+        
+        if ram_budget_mb:
+            scheduler = MemoryScheduler(self, ram_budget_mb, workers=workers)
+            scheduled = scheduler.run(cases, roi_sizes=previous_roi_sizes(base_dir), on_result=lambda case_id, features, record: progress.case_done(
+                case_id, ok=bool(features), stages=record['stages'], error=case_error(record)))
+            results += [(case_id, features, case_error(record)) for case_id, features, record in scheduled]
+        elif prefetch_cases:
+            executor = StreamingExecutor(self, prefetch=prefetch_cases)
+            streamed = executor.run(cases, on_result=lambda case_id, features, record: progress.case_done(
+                case_id, ok=bool(features), stages=record['stages'], error=case_error(record)))
+            results += [(case_id, features, case_error(record)) for case_id, features, record in streamed]
+        else:
+            for dataset, case_id, case_path, segment_dir in cases:
+                with case_context(case_id):
+                    with self.metrics.case(case_id, dataset) as record:
+                        features = self.process_case(case_id, case_path, segment_dir)
+                    
+                    if features:
+                        logger.debug("Case completed")
+                    results.append((case_id, features, case_error(record)))
+                    progress.case_done(case_id, ok=bool(features), stages=record['stages'], error=case_error(record))
+        progress.finish()
+        
+        if sharded:
+            shard_path = partition_path(base_dir, shard_name)
+            write_partition(shard_path, results)
+            logger.info("Shard features saved: %s", shard_path)
+            self.metrics.finish()
+            return pd.DataFrame([features for _, features, _ in results if features])
+        
+        all_features = [features for _, features, _ in results if features]
+        return self.build_feature_tables(base_dir, all_features, refit_scaler=refit_scaler)
+
+    def merge_shards(self, base_dir, allow_partial=False, refit_scaler=False):
+        """
+        Merge the shard partitions under base_dir/shards and build the feature tables
+        
+        Cases are put back in the order process_all_datasets uses, so the raw,
+        normalized and harmonized CSVs are identical to a single-node run.
+        """
+        features_by_case, failures = read_partitions(base_dir, require_complete=not allow_partial)
+        self.metrics.set_output(os.path.join(base_dir, 'pipeline_metrics.jsonl'))
+        
+        order = [case_id for _, case_id, _, _ in self.find_cases(base_dir)]
+        unlisted = sorted(set(features_by_case) - set(order))
+        if unlisted:
+            logger.warning("%d merged cases are no longer under %s: %s", len(unlisted), base_dir, ', '.join(unlisted))
+        all_features = [features_by_case[case_id] for case_id in order + unlisted if case_id in features_by_case]
+        
+        for case_id, error in sorted(failures.items()):
+            logger.warning("Failed in its shard: %s: %s", case_id, error)
+        missing = [case_id for case_id in order if case_id not in features_by_case and case_id not in failures]
+        if missing:
+            logger.warning("%d cases are in no shard: %s", len(missing), ', '.join(missing))
+        logger.info("Merged %d cases from %d partitions", len(all_features), len(glob.glob(partition_path(base_dir, '*'))))
+        return self.build_feature_tables(base_dir, all_features, refit_scaler=refit_scaler)
+
+    def build_feature_tables(self, base_dir, all_features, refit_scaler=False):
+        """Raw, normalized and harmonized feature CSVs from the per-case features"""
         if not all_features:
-            print("No features extracted. Check your data paths.")
+            logger.error("No features extracted. Check your data paths.")
+            self.metrics.finish()
             return None
         
         # Create features dataframe
         features_df = pd.DataFrame(all_features)
-        print(f"\n=== Feature Extraction Summary ===")
-        print(f"Total cases processed: {len(features_df)}")
-        print(f"Total features extracted: {len(features_df.columns) - 1}")  # Exclude case_id
+        logger.info("Feature extraction: %d cases, %d features", len(features_df), len(features_df.columns) - 1)  # Exclude case_id
         
         # Save raw features
         raw_csv_path = os.path.join(base_dir, 'complete_pipeline_raw_features.csv')
         features_df.to_csv(raw_csv_path, index=False)
-        print(f"Raw features saved: {raw_csv_path}")
+        logger.info("Raw features saved: %s", raw_csv_path)
         
         # Apply normalization
         if self.apply_normalization:
-            print("\n=== Applying Normalization ===")
-            normalized_df = self.apply_comprehensive_normalization(features_df)
+            scaler_dir = os.path.join(base_dir, 'scalers')
+            with self.metrics.stage('normalization'):
+                normalized_df = self.apply_comprehensive_normalization(features_df, scaler_dir=scaler_dir,
+                                                                       refit=refit_scaler)
             
             normalized_csv_path = os.path.join(base_dir, 'complete_pipeline_normalized_features.csv')
             normalized_df.to_csv(normalized_csv_path, index=False)
-            print(f"Normalized features saved: {normalized_csv_path}")
+            logger.info("Normalized features saved: %s", normalized_csv_path)
         else:
             normalized_df = features_df
         
         # Apply ComBat harmonization
-        print("\n=== Applying ComBat Harmonization ===")
-        harmonized_df = self.apply_combat_harmonization(normalized_df.copy())
+        combat_params_path = os.path.join(base_dir, 'complete_pipeline_combat_params.npz')
+        with self.metrics.stage('combat'):
+            harmonized_df = self.apply_combat_harmonization(normalized_df.copy(), params_path=combat_params_path)
         
         harmonized_csv_path = os.path.join(base_dir, 'complete_pipeline_harmonized_features.csv')
         harmonized_df.to_csv(harmonized_csv_path, index=False)
-        print(f"Harmonized features saved: {harmonized_csv_path}")
+        logger.info("Harmonized features saved: %s", harmonized_csv_path)
+        logger.info("Stage metrics: %s", self.metrics.output_path)
         
-        # Final summary
-        print(f"\n=== Complete Pipeline Summary ===")
-        print(f"✓ Raw features: {raw_csv_path}")
-        if self.apply_normalization:
-            print(f"✓ Normalized features: {normalized_csv_path}")
-        print(f"✓ Harmonized features: {harmonized_csv_path}")
-        print(f"✓ NIfTI colormaps: Created for each case (*_colormap.nii.gz)")
-        print(f"✓ PNG visualizations: Created for each case (*_complete_colormap.png)")
-        print("\nPipeline completed successfully!")
+        logger.info("Stage timing summary:\n%s", self.metrics.summary_table())
+        self.metrics.finish()
+        logger.info("Pipeline completed successfully!")
         
         return harmonized_df    
     def save_final_rgb_nifti(self, img_ref_path: str, class_arr: np.ndarray, out_path: str):
@@ -492,26 +844,66 @@ class CompleteDCEMRIPipeline:
         rgb_nii.header['datatype'] = 128  # RGB24
         rgb_nii.header['bitpix'] = 24     # 24-bit RGB
 
-        # Βήμα 11: Αποθήκευση
-        nib.save(rgb_nii, out_path)
-        print(f"    Saved RGB NIfTI colormap: {out_path}")
+        # Βήμα 11: Αποθήκευση σε BGZF μορφή
+        save_nifti_blocked(rgb_nii, out_path)
+        logger.debug("Saved RGB NIfTI colormap: %s", out_path)
 
-def main():
+def main(argv=None):
     """Main execution function"""
-    # Initialize complete pipeline
-    pipeline = CompleteDCEMRIPipeline(apply_normalization=True)
-    
+    parser = argparse.ArgumentParser(description="Complete DCE-MRI analysis pipeline")
     # Set base directory
-    base_dir = r"c:\Users\nickk\BiomedicalSignals"
+    parser.add_argument('base_dir', nargs='?', default=r"c:\Users\nickk\BiomedicalSignals")
+    parser.add_argument('--shard-index', type=int, help='Process only this shard of the cases (0-based)')
+    parser.add_argument('--shard-count', type=int, help='Number of shards the cases are split into')
+    parser.add_argument('--case-list', help='Process only the case ids listed in this file')
+    parser.add_argument('--merge', action='store_true', help='Merge the shard partitions and build the feature tables')
+    parser.add_argument('--allow-partial', action='store_true', help='Merge even if some shards are missing')
+    parser.add_argument('--prefetch', type=int, default=0, help='Cases read ahead while the current one is computed')
+    parser.add_argument('--memory-budget-mb', type=int, help='Stream kinetics in z-slabs above this working set')
+    parser.add_argument('--volume-cache-dir', help='Shared cache of decompressed volumes')
+    parser.add_argument('--ram-budget-mb', type=int, help='Run cases in worker processes within this memory budget')
+    parser.add_argument('--workers', type=int, help='Concurrent worker processes (with --ram-budget-mb; default: as many as the budget fits)')
+    parser.add_argument('--radiomics-workers', type=int,
+                        help='Latency mode: extract t0/t1 concurrently and feature classes in this many processes')
+    parser.add_argument('--radiomics-manifest', help='JSON/YAML manifest of the radiomics features to compute')
+    parser.add_argument('--preflight', action='store_true', help='Check headers, geometry and masks first and skip bad cases')
+    parser.add_argument('--preflight-gzip', action='store_true',
+                        help='With --preflight, also validate the gzip CRC of every input (inflates each file once more)')
+    parser.add_argument('--profile-case', action='append', default=[],
+                        help='Run this case under cProfile (repeatable); reports go next to pipeline_metrics.jsonl')
+    parser.add_argument('--trace-memory', action='store_true', help='Also record tracemalloc allocation sites of profiled cases')
+    parser.add_argument('--refit-scaler', action='store_true', help='Fit a new normalization scaler instead of reusing the saved one')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error("--shard-index and --shard-count must be given together")
+    
+    configure_logging(args.log_level)
     
-    # Process all datasets
-    final_features = pipeline.process_all_datasets(base_dir)
+    # Initialize complete pipeline
+    metrics = PipelineMetrics(profile_cases=args.profile_case, trace_memory=args.trace_memory)
+    pipeline = CompleteDCEMRIPipeline(apply_normalization=True, metrics=metrics, memory_budget_mb=args.memory_budget_mb,
+                                      volume_cache_dir=args.volume_cache_dir, radiomics_workers=args.radiomics_workers,
+                                      radiomics_manifest=args.radiomics_manifest)
+    
+    try:
+        if args.merge:
+            final_features = pipeline.merge_shards(args.base_dir, allow_partial=args.allow_partial,
+                                                   refit_scaler=args.refit_scaler)
+        else:
+            # Process all datasets (or this node's shard)
+            final_features = pipeline.process_all_datasets(args.base_dir, shard_index=args.shard_index,
+                                                           shard_count=args.shard_count, case_list=args.case_list,
+                                                           prefetch_cases=args.prefetch, ram_budget_mb=args.ram_budget_mb,
+                                                           workers=args.workers, preflight=args.preflight,
+                                                           preflight_gzip=args.preflight_gzip, refit_scaler=args.refit_scaler)
+    finally:
+        pipeline.close()
     
     if final_features is not None:
-        print(f"\nFinal dataset shape: {final_features.shape}")
-        print("Complete DCE-MRI analysis pipeline finished successfully!")
+        logger.info("Final dataset shape: %s", final_features.shape)
     else:
-        print("Pipeline failed. Please check your data and try again.")
+        logger.error("Pipeline failed. Please check your data and try again.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+import os
+import re
+import numpy as np
+import nibabel as nib
+
+# Same thresholds as CompleteDCEMRIPipeline.extract_kinetic_features (% signal change)
+UPTAKE_THRESHOLD = 15
+WASHOUT_THRESHOLD = -5
+
+PHASE_PATTERN = re.compile(r'_(\d{4})\.nii\.gz$')
+
+def find_phase_files(case_path):
+    """All DCE phases of a case (_0000, _0001, ... _000N) sorted by phase index"""
+    phases = []
+    for file in os.listdir(case_path):
+        match = PHASE_PATTERN.search(file)
+        if match:
+            phases.append((int(match.group(1)), os.path.join(case_path, file)))
+    return [path for _, path in sorted(phases)]
+
+def phase_numbers(phase_files):
+    """
+    Phase number (NNNN in _NNNN.nii.gz) of each phase file
+
+    Used as the default time points, so a missing phase leaves a gap instead of
+    shifting every later phase one time point earlier.
+
+    Returns:
+        List of ints, or None if a file name carries no phase number (e.g. a volume cache path)
+    """
+    numbers = []
+    for path in phase_files:
+        match = PHASE_PATTERN.search(os.path.basename(path))
+        if match is None:
+            return None
+        numbers.append(int(match.group(1)))
+    return numbers
+
+def roi_bounding_box(mask, margin=0):
+    """Slices of the smallest box containing the ROI (plus margin voxels)"""
+    coords = np.nonzero(mask)
+    return tuple(slice(max(int(c.min()) - margin, 0), min(int(c.max()) + margin + 1, size))
+                 for c, size in zip(coords, mask.shape))
+
+def load_roi_series(phase_files, bbox, dtype=np.float32):
+    """
+    Load all phases as one (X, Y, Z, T) array cropped to bbox
+
+    Only the cropped region of each phase is kept in memory.
+    """
+    crop_shape = tuple(s.stop - s.start for s in bbox)
+    series = np.empty(crop_shape + (len(phase_files),), dtype=dtype)
+    for t, path in enumerate(phase_files):
+        series[..., t] = np.asarray(nib.load(path).dataobj[bbox], dtype=dtype)
+    return series
+
+class KineticCurveAccumulator:
+    """
+    Voxelwise kinetic curve descriptors accumulated one phase at a time
+
+    Only running per-voxel state (baseline, early/last signal, peak) is kept, so
+    memory is O(ROI voxels) whatever the number of phases.
+    """
+
+    def __init__(self, time_points=None):
+        self.time_points = None if time_points is None else np.asarray(time_points, dtype=np.float64)
+        self.n_phases = 0
+        self.s0 = None
+        self.s1 = None
+        self.s_last = None
+        self.peak_enhancement = None
+        self.peak_time = None
+
+    def _time(self, t):
+        return float(self.time_points[t]) if self.time_points is not None else float(t)
+
+    def add_phase(self, roi_values):
+        """Add the ROI voxel values (1D) of the next phase"""
+        values = np.asarray(roi_values, dtype=np.float64)
+        t = self.n_phases
+        if t == 0:
+            self.s0 = values
+        else:
+            enhancement = (values - self.s0) / (self.s0 + 1e-10) * 100
+            if t == 1:
+                self.s1 = values
+                self.peak_enhancement = enhancement
+                self.peak_time = np.full(len(values), self._time(1))
+            else:
+                is_peak = enhancement > self.peak_enhancement
+                self.peak_enhancement = np.where(is_peak, enhancement, self.peak_enhancement)
+                self.peak_time = np.where(is_peak, self._time(t), self.peak_time)
+        self.s_last = values
+        self.n_phases += 1
+
+    def descriptors(self):
+        """Per-voxel descriptors and curve class (1: uptake, 2: plateau, 3: washout)"""
+        if self.n_phases < 2:
+            raise ValueError("Kinetic curve descriptors need at least 2 phases")
+        t0, t1, t_last = self._time(0), self._time(1), self._time(self.n_phases - 1)
+
+        initial_enhancement = (self.s1 - self.s0) / (self.s0 + 1e-10) * 100
+        last_enhancement = (self.s_last - self.s0) / (self.s0 + 1e-10) * 100
+        late_dt = t_last - self.peak_time
+        late_slope = np.divide(last_enhancement - self.peak_enhancement, late_dt,
+                               out=np.zeros_like(late_dt), where=late_dt > 0)
+        last_change = self.s_last - self.s0
+        ser = np.divide(self.s1 - self.s0, last_change, out=np.zeros_like(last_change), where=last_change != 0)
+
+        # Curve shape after the early phase; with two phases this is the change from baseline
+        if self.n_phases == 2:
+            late_change = initial_enhancement
+        else:
+            late_change = (self.s_last - self.s1) / (self.s1 + 1e-10) * 100
+        curve_class = np.full(len(self.s0), 2, dtype=np.uint8)
+        curve_class[late_change > UPTAKE_THRESHOLD] = 1
+        curve_class[late_change < WASHOUT_THRESHOLD] = 3
+
+        return {
+            'peak_enhancement': self.peak_enhancement,
+            'time_to_peak': self.peak_time - t0,
+            'initial_slope': initial_enhancement / (t1 - t0),
+            'late_slope': late_slope,
+            'signal_enhancement_ratio': ser,
+            'curve_class': curve_class
+        }
+
+def compute_curve_descriptors(series, roi, time_points=None):
+    """Voxelwise descriptors of an (X, Y, Z, T) series over the boolean ROI"""
+    accumulator = KineticCurveAccumulator(time_points)
+    for t in range(series.shape[-1]):
+        accumulator.add_phase(series[..., t][roi])
+    return accumulator.descriptors()
+
+def summarize_curve_descriptors(descriptors, n_phases, prefix='dce_'):
+    """Case-level features from voxelwise descriptors"""
+    features = {f'{prefix}n_phases': n_phases}
+    for name in ['peak_enhancement', 'time_to_peak', 'initial_slope', 'late_slope', 'signal_enhancement_ratio']:
+        values = descriptors[name]
+        features[f'{prefix}mean_{name}'] = float(np.mean(values))
+        features[f'{prefix}median_{name}'] = float(np.median(values))
+    curve_class = descriptors['curve_class']
+    for class_value, class_name in [(1, 'uptake'), (2, 'plateau'), (3, 'washout')]:
+        features[f'{prefix}{class_name}_curve_percentage'] = float(np.mean(curve_class == class_value) * 100)
+    return features
+
+def extract_multiphase_kinetics(phase_files, mask, time_points=None, loaded_phases=None):
+    """
+    Kinetic curve features from every DCE phase of a case
+
+    Each phase is read once, cropped to the ROI bounding box via nibabel's dataobj
+    proxy, and reduced to its ROI voxels before the next phase is read.
+
+    Args:
+        phase_files: Phase paths in acquisition order (see find_phase_files)
+        mask: Segmentation array; voxels > 0 form the ROI
+        time_points: Optional acquisition times, defaults to the phase numbers in
+                     the file names (see phase_numbers), else the position in phase_files
+        loaded_phases: Optional {position in phase_files: full array} of phases already in memory
+
+    Returns:
+        (features dict, descriptors dict with one value per ROI voxel)
+    """
+    roi = mask > 0
+    if not np.any(roi) or len(phase_files) < 2:
+        return {}, {}
+
+    bbox = roi_bounding_box(roi)
+    roi_crop = roi[bbox]
+    loaded_phases = loaded_phases or {}
+
+    if time_points is None:
+        time_points = phase_numbers(phase_files)
+    accumulator = KineticCurveAccumulator(time_points)
+    for t, path in enumerate(phase_files):
+        if t in loaded_phases:
+            crop = loaded_phases[t][bbox]
+        else:
+            crop = np.asarray(nib.load(path).dataobj[bbox])
+        accumulator.add_phase(crop[roi_crop])
+
+    descriptors = accumulator.descriptors()
+    return summarize_curve_descriptors(descriptors, len(phase_files)), descriptors
@@ -1,16 +1,19 @@
 import os
-import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
+from volume_cache import VolumeCache
 
 # Path to one of the NIfTI files
 nifti_path = "DUKE/DUKE_099/DUKE_099_0000.nii.gz"
 colormap_path = "DUKE/DUKE_099/DUKE_099_colormap.nii.gz"
 
+# Decompressed copies are reused on later runs instead of gunzipping again
+cache = VolumeCache(os.path.join("cache", "volumes"))
+
 # Load NIfTI files
 if os.path.exists(nifti_path):
     print(f"Loading {nifti_path}...")
-    img = nib.load(nifti_path)
+    img = cache.load(nifti_path)
     data = img.get_fdata()
     print(f"Image shape: {data.shape}")
     print(f"Data type: {data.dtype}")
@@ -21,7 +24,7 @@ else:
 
 if os.path.exists(colormap_path):
     print(f"\nLoading {colormap_path}...")
-    cmap_img = nib.load(colormap_path)
+    cmap_img = cache.load(colormap_path)
     cmap_data = cmap_img.get_fdata()
     print(f"Colormap shape: {cmap_data.shape}")
     print(f"Colormap data type: {cmap_data.dtype}")
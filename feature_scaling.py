@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from quantile_sketch import QuantileSketch
+
+def feature_table_version(columns):
+    """Short hash identifying a feature table by its (ordered) numeric columns"""
+    return hashlib.sha1('\n'.join(columns).encode('utf-8')).hexdigest()[:12]
+
+class MinMaxFeatureScaler:
+    """
+    Min-max scaling to the 0-1 range with persisted, incrementally updatable parameters
+
+    partial_fit() keeps a running per-feature minimum/maximum, so the scaler can be
+    fitted on chunks of a feature table that never fits in memory at once.
+    transform() matches sklearn's MinMaxScaler for the same data range. With clip
+    (the default, not persisted), values of new cases outside the fitted range
+    are clipped so every output stays within 0-1.
+    """
+    method = 'minmax'
+
+    def __init__(self, columns=None, clip=True):
+        self.columns = None if columns is None else list(columns)
+        self.clip = clip
+        self.data_min = None
+        self.data_max = None
+        self.n_samples = 0
+
+    def partial_fit(self, df):
+        """Update the running min/max with a chunk of rows"""
+        if self.columns is None:
+            self.columns = list(df.columns)
+        values = df[self.columns].to_numpy(dtype=np.float64)
+        if len(values) == 0:
+            return self
+        chunk_min = np.nanmin(values, axis=0)
+        chunk_max = np.nanmax(values, axis=0)
+        if self.data_min is None:
+            self.data_min, self.data_max = chunk_min, chunk_max
+        else:
+            self.data_min = np.fmin(self.data_min, chunk_min)
+            self.data_max = np.fmax(self.data_max, chunk_max)
+        self.n_samples += len(values)
+        return self
+
+    def fit(self, df):
+        self.data_min = None
+        self.data_max = None
+        self.n_samples = 0
+        return self.partial_fit(df)
+
+    def transform(self, df):
+        data_range = self.data_max - self.data_min
+        # Constant features map to 0, like sklearn
+        scale = 1.0 / np.where(data_range == 0, 1.0, data_range)
+        scaled = df[self.columns].to_numpy(dtype=np.float64) * scale - self.data_min * scale
+        if self.clip:
+            scaled = np.clip(scaled, 0.0, 1.0)
+        return pd.DataFrame(scaled, columns=self.columns, index=df.index)
+
+    def get_params(self):
+        return {
+            'data_min': self.data_min.tolist(),
+            'data_max': self.data_max.tolist()
+        }
+
+    def set_params(self, params):
+        self.data_min = np.asarray(params['data_min'], dtype=np.float64)
+        self.data_max = np.asarray(params['data_max'], dtype=np.float64)
+
+class RobustFeatureScaler:
+    """
+    Robust scaling (x - median) / IQR from per-feature quantile sketches
+
+    The sketches are mergeable and bounded in size, so the scaler can be fitted on
+    streamed chunks and updated with new cases without keeping the cohort in memory.
+    """
+    method = 'robust'
+
+    def __init__(self, columns=None, quantile_range=(25.0, 75.0), sketch_size=512):
+        self.columns = None if columns is None else list(columns)
+        self.quantile_range = tuple(quantile_range)
+        self.sketch_size = sketch_size
+        self.sketches = None
+        self.n_samples = 0
+
+    def partial_fit(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+        if self.sketches is None:
+            self.sketches = [QuantileSketch(k=self.sketch_size) for _ in self.columns]
+        values = df[self.columns].to_numpy(dtype=np.float64)
+        for sketch, column_values in zip(self.sketches, values.T):
+            sketch.update(column_values)
+        self.n_samples += len(values)
+        return self
+
+    def fit(self, df):
+        self.sketches = None
+        self.n_samples = 0
+        return self.partial_fit(df)
+
+    def transform(self, df):
+        q_low, q_high = self.quantile_range
+        center = np.array([sketch.percentile(50.0) for sketch in self.sketches])
+        iqr = np.array([sketch.percentile(q_high) - sketch.percentile(q_low) for sketch in self.sketches])
+        iqr = np.where(iqr == 0, 1.0, iqr)
+        scaled = (df[self.columns].to_numpy(dtype=np.float64) - center) / iqr
+        return pd.DataFrame(scaled, columns=self.columns, index=df.index)
+
+    def get_params(self):
+        return {
+            'quantile_range': list(self.quantile_range),
+            'sketch_size': self.sketch_size,
+            'sketches': [sketch.to_dict() for sketch in self.sketches]
+        }
+
+    def set_params(self, params):
+        self.quantile_range = tuple(params['quantile_range'])
+        self.sketch_size = params['sketch_size']
+        self.sketches = [QuantileSketch.from_dict(state) for state in params['sketches']]
+
+SCALERS = {
+    MinMaxFeatureScaler.method: MinMaxFeatureScaler,
+    RobustFeatureScaler.method: RobustFeatureScaler
+}
+
+def scaler_path(scaler_dir, method, columns):
+    """Where the scaler for this method and feature table version is stored"""
+    return os.path.join(scaler_dir, f"normalization_{method}_{feature_table_version(columns)}.json")
+
+def save_scaler(scaler, path):
+    state = {
+        'method': scaler.method,
+        'version': feature_table_version(scaler.columns),
+        'columns': scaler.columns,
+        'n_samples': scaler.n_samples,
+        'params': scaler.get_params()
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write then rename, so readers never see a half-written file
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def load_scaler(path):
+    with open(path) as f:
+        state = json.load(f)
+    scaler = SCALERS[state['method']](columns=state['columns'])
+    scaler.set_params(state['params'])
+    scaler.n_samples = state['n_samples']
+    return scaler
+
+def fit_scaler_from_csv(csv_path, columns, method='minmax', chunksize=1000):
+    """Fit a scaler by streaming a feature CSV in chunks"""
+    scaler = SCALERS[method](columns=columns)
+    for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunksize):
+        scaler.partial_fit(chunk)
+    return scaler
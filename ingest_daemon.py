@@ -0,0 +1,261 @@
+"""
+Watch-folder ingestion of newly arriving DCE-MRI cases
+
+Polls the dataset folders (DUKE/ISPY1/ISPY2/NACT and their segment/
+subfolders). A case is processed once its _0000 and _0001 phases and its
+segmentation exist and have not changed size or modification time for
+settle_seconds. It is then run through a warm CompleteDCEMRIPipeline and its
+raw, normalized and harmonized features are appended to the feature CSVs the
+dashboard reads. New rows are transformed with the saved normalization scaler
+and ComBat parameters, so existing rows never change. A full pipeline run must
+have produced these first.
+
+Usage:
+    python ingest_daemon.py BASE_DIR [--poll-interval 10] [--settle-seconds 30] [--once]
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from feature_scaling import scaler_path, load_scaler
+from pipeline_logging import configure_logging, case_context
+
+logger = logging.getLogger('pipeline.ingest')
+
+DATASETS = ('DUKE', 'ISPY1', 'ISPY2', 'NACT')
+
+def required_files(case_id, case_path, segment_dir):
+    """The three files a case needs before it can be processed"""
+    return [os.path.join(case_path, f"{case_id}_0000.nii.gz"),
+            os.path.join(case_path, f"{case_id}_0001.nii.gz"),
+            os.path.join(segment_dir, f"{case_id}.nii.gz")]
+
+def file_state(paths):
+    """(size, mtime_ns) of every path, or None while any is missing or empty"""
+    states = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size == 0:
+            return None
+        states.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(states)
+
+class FeatureStore:
+    """
+    Appends cases to the raw/normalized/harmonized feature CSVs
+
+    New rows are aligned to the existing columns, normalized with the scaler
+    saved for this feature table version and harmonized with the saved ComBat
+    parameters, exactly like harmonize_new_cases.
+    """
+
+    def __init__(self, base_dir, pipeline):
+        self.pipeline = pipeline
+        self.paths = {
+            'raw': os.path.join(base_dir, 'complete_pipeline_raw_features.csv'),
+            'normalized': os.path.join(base_dir, 'complete_pipeline_normalized_features.csv'),
+            'harmonized': os.path.join(base_dir, 'complete_pipeline_harmonized_features.csv')
+        }
+        self.combat_params_path = os.path.join(base_dir, 'complete_pipeline_combat_params.npz')
+        if not os.path.exists(self.paths['raw']) or not os.path.exists(self.combat_params_path):
+            raise FileNotFoundError("Run the complete pipeline once before ingesting new cases "
+                                    f"({self.paths['raw']} and {self.combat_params_path} are required)")
+
+        raw_df = pd.read_csv(self.paths['raw'])
+        self.columns = list(raw_df.columns)
+        self.case_ids = set(raw_df['case_id'].astype(str))
+        # Same numeric columns as apply_comprehensive_normalization saw for the full table
+        self.numeric_columns = [col for col in raw_df.select_dtypes(include=[np.number]).columns if col != 'case_id']
+        self.scaler = None
+        if pipeline.apply_normalization:
+            path = scaler_path(os.path.join(base_dir, 'scalers'), pipeline.normalization_method, self.numeric_columns)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No saved {pipeline.normalization_method} scaler for this feature table: {path}")
+            self.scaler = load_scaler(path)
+
+    def __contains__(self, case_id):
+        return case_id in self.case_ids
+
+    def append(self, features):
+        """Append one case's features to all tables"""
+        extra = [key for key in features if key not in self.columns]
+        if extra:
+            logger.warning("Dropping %d features not in the feature table, e.g. %s", len(extra), extra[:3])
+        raw_df = pd.DataFrame([features]).reindex(columns=self.columns)
+        raw_df[self.numeric_columns] = raw_df[self.numeric_columns].apply(pd.to_numeric, errors='coerce')
+
+        normalized_df = raw_df.copy()
+        if self.scaler is not None:
+            normalized_df[self.numeric_columns] = self.scaler.transform(raw_df)
+        harmonized_df = self.pipeline.harmonize_new_cases(normalized_df, self.combat_params_path)
+
+        # Each row goes out in a single write so readers never see half a row
+        tables = [('raw', raw_df), ('harmonized', harmonized_df)]
+        if self.scaler is not None:
+            tables.insert(1, ('normalized', normalized_df))
+        for name, df in tables:
+            with open(self.paths[name], 'a', encoding='utf-8', newline='') as f:
+                f.write(df.to_csv(index=False, header=False))
+        self.case_ids.add(str(features['case_id']))
+
+class IngestDaemon:
+    """
+    Polls base_dir for new complete cases and ingests them one at a time
+
+    Args:
+        base_dir: Project directory with the dataset folders and feature CSVs
+        pipeline: Warm CompleteDCEMRIPipeline (created once when None)
+        settle_seconds: How long a case's files must stay unchanged before processing
+        datasets: Dataset folders to watch
+    """
+
+    def __init__(self, base_dir, pipeline=None, settle_seconds=30.0, datasets=DATASETS):
+        if pipeline is None:
+            from complete_pipeline import CompleteDCEMRIPipeline
+            pipeline = CompleteDCEMRIPipeline()
+        self.base_dir = base_dir
+        self.pipeline = pipeline
+        self.settle_seconds = settle_seconds
+        self.datasets = datasets
+        self.store = FeatureStore(base_dir, pipeline)
+        self.pipeline.metrics.set_output(os.path.join(base_dir, 'pipeline_metrics.jsonl'))
+        self.state_path = os.path.join(base_dir, 'ingest_state.json')
+        # case_id -> file state of the attempt that failed; retried when the files change
+        self.failed = self._load_failed()
+        # case_id -> (file state, first seen with that state)
+        self.pending = {}
+        self._stop = False
+
+    def _load_failed(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                return {case_id: [tuple(item) for item in state] for case_id, state in json.load(f)['failed'].items()}
+        return {}
+
+    def _save_failed(self):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'failed': self.failed}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def scan(self):
+        """Cases whose files are complete and settled: [(dataset, case_id, case_path, segment_dir)]"""
+        now = time.monotonic()
+        ready = []
+        for dataset in self.datasets:
+            dataset_dir = os.path.join(self.base_dir, dataset)
+            segment_dir = os.path.join(dataset_dir, 'segment')
+            if not os.path.isdir(segment_dir):
+                continue
+            with os.scandir(dataset_dir) as entries:
+                case_ids = sorted(entry.name for entry in entries if entry.is_dir() and entry.name != 'segment')
+            for case_id in case_ids:
+                if case_id in self.store:
+                    continue
+                case_path = os.path.join(dataset_dir, case_id)
+                state = file_state(required_files(case_id, case_path, segment_dir))
+                if state is None or list(state) == self.failed.get(case_id):
+                    self.pending.pop(case_id, None)
+                    continue
+                previous = self.pending.get(case_id)
+                if previous is None or previous[0] != state:
+                    # New or still being written: restart the settle timer
+                    self.pending[case_id] = (state, now)
+                elif now - previous[1] >= self.settle_seconds:
+                    ready.append((dataset, case_id, case_path, segment_dir))
+        return ready
+
+    def ingest(self, dataset, case_id, case_path, segment_dir):
+        """Process one case and append it to the feature store; returns True on success"""
+        state = self.pending.pop(case_id)[0]
+        start = time.perf_counter()
+        with case_context(case_id):
+            with self.pipeline.metrics.case(case_id, dataset) as record:
+                features = self.pipeline.process_case(case_id, case_path, segment_dir)
+                if features:
+                    try:
+                        with self.pipeline.metrics.stage('append'):
+                            self.store.append(features)
+                    except Exception as e:
+                        logger.error("Could not append features: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+                        self.pipeline.metrics.record_error(e)
+                        features = None
+            if not features:
+                error = record['errors'][0]['message'] if record['errors'] else 'unknown error'
+                logger.warning("Ingestion failed (%s); will retry when its files change", error)
+                self.failed[case_id] = list(state)
+                self._save_failed()
+                return False
+            logger.info("Ingested in %.1f s", time.perf_counter() - start)
+            if self.failed.pop(case_id, None) is not None:
+                self._save_failed()
+            return True
+
+    def run_once(self):
+        """One scan; ingests every ready case and returns how many succeeded"""
+        ingested = 0
+        for case in self.scan():
+            if self._stop:
+                break
+            ingested += self.ingest(*case)
+        return ingested
+
+    def run(self, poll_interval=10.0):
+        """Poll until stop() (or SIGINT/SIGTERM)"""
+        logger.info("Watching %s (poll every %.0f s, settle %.0f s)", self.base_dir, poll_interval, self.settle_seconds)
+        while not self._stop:
+            self.run_once()
+            # Poll sooner while cases are waiting to settle
+            wait = min(poll_interval, self.settle_seconds) if self.pending else poll_interval
+            deadline = time.monotonic() + wait
+            while not self._stop and time.monotonic() < deadline:
+                time.sleep(min(0.5, wait))
+        self.pipeline.metrics.finish()
+        logger.info("Ingestion stopped")
+
+    def stop(self, *args):
+        self._stop = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_dir', help='Project directory with the dataset folders and feature CSVs')
+    parser.add_argument('--poll-interval', type=float, default=10.0, help='Seconds between scans')
+    parser.add_argument('--settle-seconds', type=float, default=30.0, help='Seconds a case must stay unchanged')
+    parser.add_argument('--once', action='store_true', help='Scan twice (settle-seconds apart), ingest and exit')
+    parser.add_argument('--normalization', choices=['minmax', 'robust', 'none'], default='minmax')
+    parser.add_argument('--memory-budget-mb', type=int, help='Stream kinetics in z-slabs above this working set')
+    parser.add_argument('--volume-cache-dir', help='Shared cache of decompressed volumes')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--log-file')
+    args = parser.parse_args(argv)
+
+    configure_logging(args.log_level, args.log_file)
+    from complete_pipeline import CompleteDCEMRIPipeline
+    pipeline = CompleteDCEMRIPipeline(apply_normalization=args.normalization != 'none',
+                                      normalization_method=args.normalization if args.normalization != 'none' else 'minmax',
+                                      memory_budget_mb=args.memory_budget_mb, volume_cache_dir=args.volume_cache_dir)
+    daemon = IngestDaemon(args.base_dir, pipeline, settle_seconds=args.settle_seconds)
+
+    if args.once:
+        daemon.scan()
+        time.sleep(args.settle_seconds)
+        ingested = daemon.run_once()
+        daemon.pipeline.metrics.finish()
+        logger.info("Ingested %d cases", ingested)
+        return 0
+
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    daemon.run(args.poll_interval)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
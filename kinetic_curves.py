@@ -0,0 +1,83 @@
+import numpy as np
+
+# Curve order used by every (cases x curves x time) array
+CURVE_LABELS = ['Uptake', 'Plateau', 'Washout']
+CURVE_COLORS = ['#3274A1', '#3A923A', '#C03D3E']
+
+# Early enhancement rate shared by all curves before the divergence point
+INITIAL_SLOPE = 150
+
+def divergence_index(time_points, t_diverge):
+    """Index of the time point closest to the divergence time"""
+    return int(np.argmin(np.abs(np.asarray(time_points) - t_diverge)))
+
+def case_curve_slopes(uptake_intensity, washout_severity,
+                      uptake_strength=1.0, plateau_strength=1.0, washout_strength=1.0):
+    """
+    Post-divergence slopes of the uptake, plateau and washout curves
+
+    All arguments may be scalars or 1D arrays with one value per case.
+
+    Returns:
+        Array of shape (cases, 3)
+    """
+    uptake_intensity, washout_severity, uptake_strength, plateau_strength, washout_strength = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(v, dtype=float)) for v in
+          (uptake_intensity, washout_severity, uptake_strength, plateau_strength, washout_strength)])
+    return np.stack([
+        uptake_intensity * 0.07 * uptake_strength,
+        -uptake_intensity * 0.03 * plateau_strength,
+        -uptake_intensity * 0.12 * washout_severity * washout_strength
+    ], axis=1)
+
+def synthesize_kinetic_curves(time_points, max_intensity, slopes, idx_diverge, initial_slope=INITIAL_SLOPE):
+    """
+    Vectorized kinetic curve model for many cases at once
+
+    All curves of a case share an exponential wash-in up to the divergence point
+    and continue linearly with their own slope afterwards.
+
+    Args:
+        time_points: 1D array with T time points
+        max_intensity: Scalar or array with one wash-in plateau per case
+        slopes: Array (cases, 3) or (3,) with the uptake/plateau/washout slopes
+        idx_diverge: Index of the divergence time point
+        initial_slope: Wash-in rate of the common curve segment
+
+    Returns:
+        Array of shape (cases, 3, T)
+    """
+    t = np.asarray(time_points, dtype=float)
+    max_intensity = np.atleast_1d(np.asarray(max_intensity, dtype=float))
+    slopes = np.asarray(slopes, dtype=float).reshape(-1, 3)
+    n_cases = max(len(max_intensity), len(slopes))
+    max_intensity = np.broadcast_to(max_intensity, (n_cases,))
+    slopes = np.broadcast_to(slopes, (n_cases, 3))
+
+    # Common wash-in segment up to (and including) the divergence point
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base = max_intensity[:, None] * (1 - np.exp(-initial_slope * t[None, :idx_diverge+1] / max_intensity[:, None]))
+
+    curves = np.empty((n_cases, 3, len(t)))
+    curves[:, :, :idx_diverge+1] = base[:, None, :]
+
+    # Linear continuation after the divergence point
+    dt = t[idx_diverge+1:] - t[idx_diverge]
+    curves[:, :, idx_diverge+1:] = base[:, None, -1:] + slopes[:, :, None] * dt[None, None, :]
+    return curves
+
+def kinetic_curves_from_features(features_df, time_points, idx_diverge):
+    """Curves for every case (row) of a feature table, shape (cases, 3, T)"""
+    uptake_intensity = features_df['uptake_intensity'].to_numpy(dtype=float)
+    slopes = case_curve_slopes(uptake_intensity, features_df['washout_severity'].to_numpy(dtype=float))
+    return synthesize_kinetic_curves(time_points, uptake_intensity, slopes, idx_diverge)
+
+def plot_kinetic_curves(ax, time_points, curves, t_diverge=None, **plot_kwargs):
+    """Plot the three curves of one case, curves has shape (3, T)"""
+    plot_kwargs.setdefault('linewidth', 2)
+    for curve, label, color in zip(curves, CURVE_LABELS, CURVE_COLORS):
+        ax.plot(time_points, curve, color=color, label=label, **plot_kwargs)
+
+    # Divergence point reference line
+    if t_diverge is not None:
+        ax.axvline(x=t_diverge, color='gray', linestyle='--', alpha=0.7)
@@ -0,0 +1,254 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from dce_kinetics import find_phase_files
+from chunked_kinetics import estimate_full_load_bytes
+from pipeline_logging import case_context, start_log_listener, init_worker_logging
+from pipeline_metrics import PipelineMetrics
+
+logger = logging.getLogger(__name__)
+
+# ROI fraction assumed when no earlier run recorded the case's ROI size
+DEFAULT_ROI_FRACTION = 0.05
+
+# Resident memory of a worker process after its first case, independent of volume size
+# (interpreter, numpy, SimpleITK, pyradiomics and matplotlib's PNG canvas; ~440 MB measured)
+WORKER_BASE_BYTES = 450 * 1024 ** 2
+
+# Bytes per ROI voxel: the ROI bounding box (~3x the ROI) of every phase as float64,
+# plus pyradiomics' resampled and discretized crops
+ROI_BYTES_PER_VOXEL_PER_PHASE = 3 * 8
+ROI_RADIOMICS_BYTES_PER_VOXEL = 64
+
+def read_volume_info(path):
+    """(shape, bytes per voxel) from the NIfTI header; gzip files only inflate the 348-byte header"""
+    header = nib.load(path).header
+    return header.get_data_shape()[:3], header.get_data_dtype().itemsize
+
+def estimate_case_bytes(case_path, case_id, segment_dir, roi_voxels=None, memory_budget_mb=None):
+    """
+    Approximate peak memory of CompleteDCEMRIPipeline.process_case for one case
+
+    Uses only NIfTI headers and the phase file list:
+      - kinetics on whole volumes (three float64 volumes plus temporaries), or
+        memory_budget_mb when the case would be streamed in z-slabs;
+      - compressed/decoded read buffers of the three inputs;
+      - SimpleITK copies of image and mask for radiomics (the RGB colormap is written per slab);
+      - ROI-sized crops of every phase and pyradiomics' working set.
+
+    Args:
+        roi_voxels: ROI size from an earlier run (e.g. total_roi_pixels); defaults to
+                    DEFAULT_ROI_FRACTION of the volume
+    """
+    phase_files = find_phase_files(case_path)
+    shape, itemsize = read_volume_info(phase_files[0] if phase_files else
+                                       os.path.join(case_path, f"{case_id}_0000.nii.gz"))
+    seg_file = os.path.join(segment_dir, f"{case_id}.nii.gz")
+    seg_itemsize = read_volume_info(seg_file)[1] if os.path.exists(seg_file) else 1
+    n_voxels = int(np.prod(shape))
+    if roi_voxels is None or not np.isfinite(roi_voxels):
+        roi_voxels = n_voxels * DEFAULT_ROI_FRACTION
+
+    full_load = estimate_full_load_bytes(shape)
+    if memory_budget_mb and full_load > memory_budget_mb * 1024 ** 2:
+        kinetics = memory_budget_mb * 1024 ** 2 + n_voxels  # slab budget plus the uint8 colormap
+    else:
+        kinetics = full_load + n_voxels * (2 * itemsize + seg_itemsize)  # read buffers of the inputs
+    radiomics = n_voxels * (itemsize + 2 * seg_itemsize)  # image, mask and resampled mask
+    roi = roi_voxels * (ROI_BYTES_PER_VOXEL_PER_PHASE * max(len(phase_files), 2) + ROI_RADIOMICS_BYTES_PER_VOXEL)
+    return int(kinetics + radiomics + roi)
+
+def previous_roi_sizes(base_dir):
+    """{case_id: total_roi_pixels} from an earlier run's raw feature table, if any"""
+    path = os.path.join(base_dir, 'complete_pipeline_raw_features.csv')
+    if not os.path.exists(path):
+        return {}
+    try:
+        table = pd.read_csv(path, usecols=['case_id', 'total_roi_pixels'])
+    except ValueError:
+        return {}
+    return dict(zip(table['case_id'].astype(str), table['total_roi_pixels']))
+
+_worker_pipeline = None
+
+def _init_worker(pipeline_config, log_queue, log_level, metrics_config=None):
+    global _worker_pipeline
+    if log_queue is not None:
+        init_worker_logging(log_queue, log_level)
+    from complete_pipeline import CompleteDCEMRIPipeline
+    # Profiled cases are profiled in the worker that runs them
+    _worker_pipeline = CompleteDCEMRIPipeline(metrics=PipelineMetrics(**(metrics_config or {})), **pipeline_config)
+
+def _run_case(case):
+    dataset, case_id, case_path, segment_dir = case
+    metrics = _worker_pipeline.metrics
+    with case_context(case_id):
+        with metrics.case(case_id, dataset) as record:
+            features = _worker_pipeline.process_case(case_id, case_path, segment_dir)
+    # The parent process keeps and writes the records
+    metrics.records.clear()
+    return features, record
+
+class MemoryScheduler:
+    """
+    Runs cases in worker processes, admitting them against a global RAM budget
+
+    Each case's peak memory is estimated from its NIfTI headers (and its ROI
+    size from an earlier run, when available). Cases are started largest
+    first and smaller cases fill the remaining budget. A case is admitted only
+    while the estimates of all running cases fit in the budget. A case larger
+    than the whole budget runs alone.
+
+    If a worker dies (e.g. killed for memory), the pool is rebuilt and each
+    case that was running is retried alone. Only a case that kills its worker
+    while running alone is recorded as failed.
+
+    Args:
+        pipeline: CompleteDCEMRIPipeline whose config the workers copy and whose metrics receive the records
+        ram_budget_mb: Memory available for the whole run; the idle footprint of the workers is reserved first
+        workers: Maximum concurrent cases. When None, run() picks as many as the budget holds
+                 next to the smallest case (at most the CPU count, at least 1)
+        mp_context: multiprocessing context for the workers (default: the platform's)
+    """
+
+    def __init__(self, pipeline, ram_budget_mb, workers=None, mp_context=None):
+        self.pipeline = pipeline
+        self.ram_budget_bytes = ram_budget_mb * 1024 ** 2
+        self.workers = workers
+        self.budget_bytes = None
+        self.auto_workers = workers is None
+        if workers is not None:
+            self.budget_bytes = self.ram_budget_bytes - workers * WORKER_BASE_BYTES
+            if self.budget_bytes <= 0:
+                raise ValueError(f"A {ram_budget_mb} MB budget does not cover the idle footprint of {workers} workers")
+        self.mp_context = mp_context or multiprocessing.get_context()
+
+    def fit_workers(self, estimates):
+        """Workers that fit in the budget, each with its idle footprint and the smallest case estimate"""
+        smallest = min(estimates, default=0)
+        fitting = self.ram_budget_bytes // (WORKER_BASE_BYTES + smallest)
+        return max(1, min(os.cpu_count() or 1, int(fitting)))
+
+    def plan(self, cases, roi_sizes=None):
+        """[(estimated bytes, case)] sorted largest first"""
+        roi_sizes = roi_sizes or {}
+        estimates = []
+        for case in cases:
+            _, case_id, case_path, segment_dir = case
+            try:
+                estimate = estimate_case_bytes(case_path, case_id, segment_dir, roi_sizes.get(case_id),
+                                               self.pipeline.memory_budget_mb)
+            except Exception as e:
+                # Unreadable headers fail fast in the worker; schedule the case as small
+                logger.warning("Cannot estimate memory of %s: %s", case_id, e)
+                estimate = 0
+            estimates.append((estimate, case))
+        return sorted(estimates, key=lambda item: -item[0])
+
+    def run(self, cases, roi_sizes=None, on_result=None):
+        """
+        Process cases and return [(case_id, features or None, metrics record)] in input order
+
+        Args:
+            cases: (dataset, case_id, case_path, segment_dir) tuples
+            roi_sizes: Optional {case_id: ROI voxels} (see previous_roi_sizes)
+            on_result: Called as on_result(case_id, features, record) in completion order
+        """
+        pending = self.plan(cases, roi_sizes)
+        order = {case[1]: index for index, case in enumerate(cases)}
+        results = [None] * len(cases)
+        if self.auto_workers:
+            self.workers = self.fit_workers([estimate for estimate, _ in pending])
+            # With a single worker, a budget below its footprint still runs cases one at a time
+            self.budget_bytes = max(self.ram_budget_bytes - self.workers * WORKER_BASE_BYTES, 0)
+            logger.info("Using %d workers for a %.0f MB budget", self.workers, self.ram_budget_bytes / 1024 ** 2)
+        logger.info("Scheduling %d cases on %d workers within %.0f MB (largest estimate %.0f MB)",
+                    len(cases), self.workers, self.budget_bytes / 1024 ** 2,
+                    pending[0][0] / 1024 ** 2 if pending else 0)
+
+        root_level = logging.getLogger().getEffectiveLevel()
+        log_queue, listener = start_log_listener(root_level, mp_context=self.mp_context)
+        running = {}
+        in_use = 0
+        # Cases that were running when a worker died; each is retried alone, so only the culprit fails
+        suspects = set()
+        pool = None
+
+        def finish(estimate, case, features, record):
+            record['estimated_peak_mb'] = estimate / 1024 ** 2
+            self.pipeline.metrics.add_record(record)
+            results[order[case[1]]] = (case[1], features, record)
+            if on_result is not None:
+                on_result(case[1], features, record)
+
+        try:
+            while pending or running:
+                if pool is None:
+                    pool = ProcessPoolExecutor(self.workers, mp_context=self.mp_context, initializer=_init_worker,
+                                               initargs=(self.pipeline.config, log_queue, root_level,
+                                                         self.pipeline.metrics.profile_config()))
+                # Admit the largest pending cases that fit next to the running ones (suspects only alone)
+                while pending and len(running) < self.workers:
+                    if any(case[1] in suspects for _, case in running.values()):
+                        break
+                    index = next((i for i, (estimate, case) in enumerate(pending)
+                                  if in_use + estimate <= self.budget_bytes
+                                  and (case[1] not in suspects or not running)), None)
+                    if index is None and not running:
+                        index = 0  # larger than the whole budget, or a suspect: run it alone
+                    if index is None:
+                        break
+                    estimate, case = pending.pop(index)
+                    running[pool.submit(_run_case, case)] = (estimate, case)
+                    in_use += estimate
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # A worker died (e.g. killed for memory) and took the pool down; collect every running case
+                    wait(running)
+                    done = set(running)
+                crashed = []
+                for future in done:
+                    estimate, case = running.pop(future)
+                    in_use -= estimate
+                    try:
+                        features, record = future.result()
+                    except BrokenProcessPool as e:
+                        crashed.append((estimate, case, e))
+                        continue
+                    except Exception as e:
+                        logger.error("Worker failed on %s: %s", case[1], e)
+                        record, features = self._failed_record(case, e), None
+                    finish(estimate, case, features, record)
+
+                if crashed:
+                    pool.shutdown(wait=True)
+                    pool = None
+                    if len(crashed) == 1:
+                        # It ran alone in the pool, so it is the case that killed the worker
+                        estimate, case, e = crashed[0]
+                        logger.error("Worker died on %s: %s", case[1], e)
+                        finish(estimate, case, None, self._failed_record(case, e))
+                    else:
+                        logger.warning("A worker died while %d cases were running; retrying each alone",
+                                       len(crashed))
+                        for estimate, case, _ in crashed:
+                            suspects.add(case[1])
+                            pending.insert(0, (estimate, case))
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+            listener.stop()
+        return results
+
+    def _failed_record(self, case, error):
+        """Metrics record of a case whose worker failed or died"""
+        return {'record': 'case', 'run_id': self.pipeline.metrics.run_id, 'case_id': case[1],
+                'dataset': case[0], 'status': 'failed', 'stages': {},
+                'errors': [{'stage': None, 'type': type(error).__name__, 'message': str(error),
+                            'traceback': None}]}
@@ -0,0 +1,139 @@
+"""
+pyradiomics extractors driven by a feature manifest, serial with per-class timing or parallel
+
+TimedFeatureExtractor enables only the manifest's image types and features
+(see radiomics_manifest) and computes them exactly as pyradiomics does, one
+class at a time, each timed as a metrics stage.
+
+ParallelFeatureExtractor is the latency-optimized single-case mode.
+pyradiomics resamples and crops the image to the ROI once per image type,
+then computes the enabled feature classes one after another. This extractor
+computes the classes of that shared cropped image concurrently in an
+executor. Each texture class still discretizes the crop itself (a
+texture_cache lives in one process), which is cheap next to its matrix
+computation. Results are merged in the serial class
+order, so the output is identical to the serial path, key order included.
+
+pyradiomics' C matrix code holds the GIL, so a process pool gives the real
+speed-up. The cropped image and mask are sent to the workers as arrays plus
+geometry and rebuilt there voxel for voxel.
+"""
+import copy
+import collections
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import SimpleITK as sitk
+from radiomics import getFeatureClasses
+from radiomics.featureextractor import RadiomicsFeatureExtractor
+from radiomics_manifest import apply_manifest
+
+def image_payload(image):
+    """Picklable (array, spacing, origin, direction) of a SimpleITK image"""
+    return sitk.GetArrayFromImage(image), image.GetSpacing(), image.GetOrigin(), image.GetDirection()
+
+def payload_image(payload):
+    array, spacing, origin, direction = payload
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetDirection(direction)
+    return image
+
+def compute_feature_class(class_name, feature_names, image, mask, image_type_name, settings, cache=None):
+    """
+    One feature class on a cropped image, as in RadiomicsFeatureExtractor.computeFeatures
+
+    image and mask are SimpleITK images, or image_payload tuples in worker processes.
+    With a texture_cache.TextureCache the class shares binned images and
+    matrices with earlier classes and parameter sets.
+
+    Returns:
+        [(prefixed feature name, value)] in the class's own order
+    """
+    if isinstance(image, tuple):
+        image, mask = payload_image(image), payload_image(mask)
+    feature_class = (cache.feature_class(class_name) if cache is not None
+                     else getFeatureClasses()[class_name])(image, mask, **settings)
+    if feature_names is not None:
+        for feature_name in feature_names:
+            feature_class.enableFeatureByName(feature_name)
+    return [(f"{image_type_name}_{class_name}_{feature_name}", value)
+            for feature_name, value in feature_class.execute().items()]
+
+class TimedFeatureExtractor(RadiomicsFeatureExtractor):
+    """
+    RadiomicsFeatureExtractor limited to a manifest, timing each feature class
+
+    Args:
+        manifest: radiomics_manifest.load_manifest result (pyradiomics defaults when None)
+        metrics: PipelineMetrics receiving an '<image type>_<class>' stage per class
+        cache: texture_cache.TextureCache shared by the feature classes (optional)
+        settings: RadiomicsFeatureExtractor settings
+    """
+
+    def __init__(self, manifest=None, metrics=None, cache=None, **settings):
+        super().__init__(**settings)
+        self.metrics = metrics
+        self.cache = cache
+        if manifest is not None:
+            apply_manifest(self, manifest)
+
+    def with_cache(self, cache):
+        """Copy of this extractor (settings shared) whose feature classes use cache"""
+        extractor = copy.copy(self)
+        extractor.cache = cache
+        return extractor
+
+    def _stage(self, name):
+        return self.metrics.stage(name) if self.metrics is not None else nullcontext()
+
+    def feature_class_jobs(self):
+        """(class, feature names) of the enabled non-shape classes, in pyradiomics' order"""
+        feature_classes = getFeatureClasses()
+        return [(class_name, feature_names) for class_name, feature_names in self.enabledFeatures.items()
+                if not class_name.startswith('shape') and class_name in feature_classes]
+
+    def computeShape(self, *args, **kwargs):
+        with self._stage('original_shape'):
+            return super().computeShape(*args, **kwargs)
+
+    def computeFeatures(self, image, mask, imageTypeName, **kwargs):
+        # Voxel-based maps are not used by the pipeline; keep pyradiomics' own path
+        if kwargs.get('voxelBased', False):
+            return super().computeFeatures(image, mask, imageTypeName, **kwargs)
+
+        feature_vector = collections.OrderedDict()
+        for class_name, feature_names in self.feature_class_jobs():
+            with self._stage(f"{imageTypeName}_{class_name}"):
+                feature_vector.update(compute_feature_class(class_name, feature_names, image, mask,
+                                                            imageTypeName, kwargs, cache=self.cache))
+        return feature_vector
+
+class ParallelFeatureExtractor(TimedFeatureExtractor):
+    """
+    TimedFeatureExtractor whose feature classes run concurrently (not timed per class)
+
+    Args:
+        executor: concurrent.futures executor for the feature classes (a
+                  ProcessPoolExecutor, or a thread pool when the classes release the GIL)
+        manifest, metrics, settings: As for TimedFeatureExtractor
+    """
+
+    def __init__(self, executor, manifest=None, metrics=None, **settings):
+        super().__init__(manifest=manifest, metrics=metrics, **settings)
+        self.executor = executor
+
+    def computeFeatures(self, image, mask, imageTypeName, **kwargs):
+        if kwargs.get('voxelBased', False):
+            return super().computeFeatures(image, mask, imageTypeName, **kwargs)
+
+        if isinstance(self.executor, ProcessPoolExecutor):
+            image, mask = image_payload(image), image_payload(mask)
+        futures = [self.executor.submit(compute_feature_class, class_name, feature_names, image, mask,
+                                        imageTypeName, kwargs)
+                   for class_name, feature_names in self.feature_class_jobs()]
+
+        feature_vector = collections.OrderedDict()
+        for future in futures:
+            feature_vector.update(future.result())
+        return feature_vector
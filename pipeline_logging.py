@@ -0,0 +1,169 @@
+import sys
+import time
+import logging
+import logging.handlers
+import multiprocessing
+import contextvars
+from contextlib import contextmanager
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(processName)s [%(case_id)s] %(name)s: %(message)s'
+LOG_DATE_FORMAT = '%H:%M:%S'
+
+# Case being processed by the current thread/task; '-' outside a case
+_case_id = contextvars.ContextVar('case_id', default='-')
+
+class CaseContextFilter(logging.Filter):
+    """Adds the current case id to every record (record.case_id)"""
+
+    def filter(self, record):
+        if not hasattr(record, 'case_id'):
+            record.case_id = _case_id.get()
+        return True
+
+@contextmanager
+def case_context(case_id):
+    """Tag every log record emitted inside the block with case_id"""
+    token = _case_id.set(case_id)
+    try:
+        yield
+    finally:
+        _case_id.reset(token)
+
+def _make_handler(stream=None, log_file=None):
+    handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    handler.addFilter(CaseContextFilter())
+    return handler
+
+def configure_logging(level='INFO', log_file=None, stream=None):
+    """
+    Send pipeline logs to stderr (and optionally a file) with case context
+
+    Safe to call more than once: handlers installed by a previous call are replaced.
+
+    Args:
+        level: Minimum level ('DEBUG' also logs every saved file and error tracebacks)
+        log_file: Optional file receiving the same records
+        stream: Console stream (defaults to stderr)
+    """
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if getattr(h, '_pipeline_handler', False)]:
+        root.removeHandler(handler)
+        handler.close()
+    handlers = [_make_handler(stream=stream)]
+    if log_file:
+        handlers.append(_make_handler(log_file=log_file))
+    for handler in handlers:
+        handler._pipeline_handler = True
+        root.addHandler(handler)
+    root.setLevel(level)
+    return root
+
+def start_log_listener(level='INFO', log_file=None, mp_context=None):
+    """
+    Collect records from worker processes in this (parent) process
+
+    Workers call init_worker_logging(queue, level) (e.g. as a Pool initializer);
+    their records are tagged with the worker's case id before being queued and
+    written here by a single listener, so lines never interleave. Pass the
+    multiprocessing context the workers are started with, if not the default.
+
+    Returns:
+        (queue, listener); call listener.stop() when the workers are done
+    """
+    queue = (mp_context or multiprocessing).Queue(-1)
+    handlers = [_make_handler()]
+    if log_file:
+        handlers.append(_make_handler(log_file=log_file))
+    for handler in handlers:
+        handler.setLevel(level)
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return queue, listener
+
+def init_worker_logging(queue, level='INFO'):
+    """Route this worker's records to the parent's listener"""
+    handler = logging.handlers.QueueHandler(queue)
+    handler.addFilter(CaseContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class ProgressReporter:
+    """
+    Periodic progress line (done/total, cases/s, ETA, stage breakdown) and failure summary
+
+    Lines are rate limited to one per interval seconds (plus the final case),
+    so reporting costs nothing measurable per case.
+
+    Args:
+        total: Number of cases expected
+        logger: Logger receiving the progress lines
+        interval: Minimum seconds between progress lines
+    """
+
+    def __init__(self, total, logger=None, interval=10.0):
+        self.total = total
+        self.logger = logger or logging.getLogger('pipeline.progress')
+        self.interval = interval
+        self.done = 0
+        self.failures = []
+        self.stage_seconds = {}
+        self.start_time = time.perf_counter()
+        self._last_report = self.start_time
+
+    def case_done(self, case_id, ok=True, stages=None, error=None):
+        """
+        Record one finished case
+
+        Args:
+            case_id: Case identifier
+            ok: False when the case failed
+            stages: {stage name: wall seconds or PipelineMetrics stage stats}; nested stages are ignored
+            error: Failure reason shown in the summary
+        """
+        self.done += 1
+        if not ok:
+            self.failures.append((case_id, error or 'unknown error'))
+        for name, value in (stages or {}).items():
+            if '.' not in name:
+                seconds = value['wall_s'] if isinstance(value, dict) else value
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+        now = time.perf_counter()
+        if self.done == self.total or now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.done, 0)
+        eta = _format_duration(remaining / rate) if rate > 0 else '?'
+        stage_total = sum(self.stage_seconds.values())
+        breakdown = ', '.join(f"{name} {seconds / stage_total:.0%}" for name, seconds in
+                              sorted(self.stage_seconds.items(), key=lambda item: -item[1])[:4]) if stage_total else ''
+        self.logger.info("Progress %d/%d cases (%d failed) | %.2f cases/s | elapsed %s | ETA %s%s",
+                         self.done, self.total, len(self.failures), rate, _format_duration(elapsed), eta,
+                         f" | {breakdown}" if breakdown else '')
+
+    def finish(self):
+        """Log the final rate and every failed case grouped by reason"""
+        elapsed = time.perf_counter() - self.start_time
+        self.logger.info("Finished %d cases in %s (%d failed)", self.done, _format_duration(elapsed), len(self.failures))
+        if not self.failures:
+            return
+        by_reason = {}
+        for case_id, reason in self.failures:
+            by_reason.setdefault(reason, []).append(case_id)
+        for reason, case_ids in sorted(by_reason.items(), key=lambda item: -len(item[1])):
+            self.logger.warning("Failed (%d): %s: %s", len(case_ids), reason, ', '.join(case_ids))
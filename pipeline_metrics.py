@@ -0,0 +1,346 @@
+import os
+import io
+import json
+import time
+import threading
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+# psutil gives the resident set size on every platform; /proc is used on Linux without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RSS_SAMPLE_INTERVAL = 0.01
+
+def current_rss_bytes():
+    """Resident set size of this process, or None when it cannot be read"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class RssSampler:
+    """Background thread tracking the peak RSS of every open stage"""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._peaks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is None and current_rss_bytes() is not None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss_bytes()
+        if rss is None:
+            return
+        with self._lock:
+            for key, peak in self._peaks.items():
+                if rss > peak:
+                    self._peaks[key] = rss
+
+    def open(self, key):
+        rss = current_rss_bytes()
+        with self._lock:
+            self._peaks[key] = rss or 0
+        return rss
+
+    def close(self, key):
+        # One last sample so short stages still see their end state
+        self.sample()
+        with self._lock:
+            peak = self._peaks.pop(key, 0)
+        return peak or None
+
+class PipelineMetrics:
+    """
+    Structured per-case, per-stage instrumentation for CompleteDCEMRIPipeline
+
+    case() and stage() are context managers. Every stage records wall time,
+    process CPU time and the peak RSS observed while it ran (sampled in a
+    background thread); nested stages are named parent.child. When a case
+    finishes, one JSON line is appended to output_path with its stages, totals
+    and any errors. Stages run outside a case (e.g. normalization) are written
+    with the run summary.
+
+    Args:
+        output_path: JSON lines file; None keeps records in memory only
+        profile_cases: Case ids to run under cProfile (and tracemalloc if trace_memory)
+        profile_dir: Where .prof / tracemalloc reports are written (defaults next to output_path)
+        trace_memory: Also record the top Python allocations of profiled cases
+    """
+
+    def __init__(self, output_path=None, profile_cases=None, profile_dir=None, trace_memory=False):
+        self.output_path = output_path
+        self.profile_cases = set(profile_cases or [])
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.run_id = time.strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        self.run_stages = {}
+        self.run_errors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sampler = RssSampler()
+
+    # The current case and stage stack are per thread, so the streaming executor
+    # can load, compute and write different cases concurrently
+    @property
+    def _current(self):
+        return getattr(self._local, 'current', None)
+
+    @_current.setter
+    def _current(self, record):
+        self._local.current = record
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @_stack.setter
+    def _stack(self, stack):
+        self._local.stack = stack
+
+    def set_output(self, output_path):
+        """Set the JSON lines path unless one was given explicitly"""
+        if self.output_path is None:
+            self.output_path = output_path
+
+    @contextmanager
+    def case(self, case_id, dataset=None):
+        """Instrument one case; errors raised inside are recorded and re-raised"""
+        record = self.start_case(case_id, dataset)
+
+        profiler = None
+        tracing = False
+        if case_id in self.profile_cases:
+            profiler = cProfile.Profile()
+            if self.trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                tracing = True
+            profiler.enable()
+
+        try:
+            with self.resume(record):
+                yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._write_profile(case_id, profiler, tracing)
+            self.end_case(record)
+
+    def start_case(self, case_id, dataset=None):
+        """
+        Open a case record without binding it to this thread
+
+        Used when a case moves between threads: every thread wraps its part in
+        resume(record) and end_case(record) is called once at the end. Wall time
+        then spans start to end, and CPU time is the process total over that span.
+        """
+        record = {
+            'record': 'case',
+            'run_id': self.run_id,
+            'case_id': case_id,
+            'dataset': dataset,
+            'status': 'ok',
+            'stages': {},
+            'errors': []
+        }
+        self._sampler.start()
+        self._sampler.open(('case', id(record)))
+        record['_start'] = (time.perf_counter(), time.process_time())
+        return record
+
+    @contextmanager
+    def resume(self, record):
+        """Make record the current case of this thread; errors raised inside are recorded and re-raised"""
+        previous, previous_stack = self._current, self._stack
+        self._current, self._stack = record, []
+        try:
+            yield record
+        except Exception as e:
+            self.record_error(e)
+            raise
+        finally:
+            self._current, self._stack = previous, previous_stack
+
+    def current_case(self):
+        """Record of the case this thread is processing (None outside a case), e.g. to resume it in a helper thread"""
+        return self._current
+
+    def end_case(self, record):
+        """Close a record opened by start_case and write it"""
+        wall_start, cpu_start = record.pop('_start')
+        record['wall_s'] = time.perf_counter() - wall_start
+        record['cpu_s'] = time.process_time() - cpu_start
+        record['peak_rss_mb'] = _to_mb(self._sampler.close(('case', id(record))))
+        self.add_record(record)
+
+    def add_record(self, record):
+        """Add a finished case record produced elsewhere (e.g. by a worker process) and write it"""
+        with self._lock:
+            self.records.append(record)
+            self._write(record)
+
+    @contextmanager
+    def stage(self, name):
+        """Instrument one stage of the current case (or of the run outside a case)"""
+        self._stack.append(name)
+        full_name = '.'.join(self._stack)
+        record = self._current
+        key = ('stage', id(record), full_name)
+        self._sampler.open(key)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e, stage=full_name)
+            raise
+        finally:
+            stats = {
+                'wall_s': time.perf_counter() - wall_start,
+                'cpu_s': time.process_time() - cpu_start,
+                'peak_rss_mb': _to_mb(self._sampler.close(key))
+            }
+            stages = record['stages'] if record is not None else self.run_stages
+            stages[full_name] = stats
+            self._stack.pop()
+
+    def record_error(self, error, stage=None):
+        """Attach an exception (with traceback) to the current case or run"""
+        errors = self._current['errors'] if self._current is not None else self.run_errors
+        # Outside any stage the error ends the case
+        case_level = stage is None and not self._stack
+        if stage is None and self._stack:
+            stage = '.'.join(self._stack)
+        # An exception propagating through nested stages is recorded once; only its
+        # text is kept so the traceback frames (and their arrays) can be freed
+        if not getattr(error, '_pipeline_metrics_recorded', False):
+            errors.append({
+                'stage': stage,
+                'type': type(error).__name__,
+                'message': str(error),
+                'traceback': ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            })
+            try:
+                error._pipeline_metrics_recorded = True
+            except AttributeError:
+                pass
+        if self._current is not None and case_level:
+            self._current['status'] = 'failed'
+
+    def mark_failed(self, reason=None):
+        """Mark the current case as failed (e.g. missing input files)"""
+        if self._current is not None:
+            self._current['status'] = 'failed'
+            if reason:
+                self._current['errors'].append({'stage': None, 'type': 'CaseSkipped', 'message': reason,
+                                                'traceback': None})
+
+    def summary(self):
+        """Per-stage aggregate over all recorded cases"""
+        per_stage = {}
+        for record in self.records:
+            for name, stats in record['stages'].items():
+                per_stage.setdefault(name, []).append(stats)
+        rows = []
+        for name, entries in per_stage.items():
+            wall = np.array([entry['wall_s'] for entry in entries])
+            cpu = np.array([entry['cpu_s'] for entry in entries])
+            peaks = [entry['peak_rss_mb'] for entry in entries if entry['peak_rss_mb'] is not None]
+            rows.append({
+                'stage': name,
+                'cases': len(entries),
+                'total_wall_s': float(wall.sum()),
+                'mean_wall_s': float(wall.mean()),
+                'p95_wall_s': float(np.percentile(wall, 95)),
+                'mean_cpu_s': float(cpu.mean()),
+                'max_peak_rss_mb': max(peaks) if peaks else None
+            })
+        return sorted(rows, key=lambda row: -row['total_wall_s'])
+
+    def summary_table(self):
+        """Summary as a fixed-width text table"""
+        rows = self.summary()
+        n_failed = sum(record['status'] != 'ok' for record in self.records)
+        lines = [f"Cases: {len(self.records)} ({n_failed} failed)",
+                 f"{'Stage':<28}{'Cases':>7}{'Total s':>11}{'Mean s':>10}{'P95 s':>10}{'CPU s':>10}{'Peak MB':>10}"]
+        for row in rows:
+            peak = f"{row['max_peak_rss_mb']:.0f}" if row['max_peak_rss_mb'] is not None else '-'
+            lines.append(f"{row['stage']:<28}{row['cases']:>7}{row['total_wall_s']:>11.2f}{row['mean_wall_s']:>10.3f}"
+                         f"{row['p95_wall_s']:>10.3f}{row['mean_cpu_s']:>10.3f}{peak:>10}")
+        for name, stats in self.run_stages.items():
+            lines.append(f"{name + ' (run)':<28}{'':>7}{stats['wall_s']:>11.2f}")
+        return '\n'.join(lines)
+
+    def finish(self):
+        """Stop sampling and append the run summary line"""
+        self._sampler.stop()
+        self._write({
+            'record': 'run',
+            'run_id': self.run_id,
+            'cases': len(self.records),
+            'failed': sum(record['status'] != 'ok' for record in self.records),
+            'stages': self.run_stages,
+            'errors': self.run_errors,
+            'summary': self.summary()
+        })
+
+    def _write(self, record):
+        if self.output_path is None:
+            return
+        with open(self.output_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=float) + '\n')
+
+    def profile_config(self):
+        """Profiling arguments for the PipelineMetrics of a worker process, writing reports where this one would"""
+        return {'profile_cases': sorted(self.profile_cases), 'profile_dir': self._profile_dir(),
+                'trace_memory': self.trace_memory}
+
+    def _profile_dir(self):
+        return self.profile_dir or os.path.dirname(os.path.abspath(self.output_path or 'pipeline_metrics.jsonl'))
+
+    def _write_profile(self, case_id, profiler, tracing):
+        profile_dir = self._profile_dir()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{case_id}.prof"))
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(30)
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report.write(f"\ntracemalloc: current {current / 1024 ** 2:.1f} MB, peak {peak / 1024 ** 2:.1f} MB\n")
+            for stat in snapshot.statistics('lineno')[:25]:
+                report.write(f"{stat}\n")
+        with open(os.path.join(profile_dir, f"{case_id}_profile.txt"), 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+
+def _to_mb(value):
+    return None if value is None else value / 1024 ** 2
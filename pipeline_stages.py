@@ -0,0 +1,369 @@
+"""
+Staged DCE-MRI pipeline with persisted artifacts
+
+Runs the steps of CompleteDCEMRIPipeline.process_all_datasets as separate
+stages with declared inputs and outputs:
+
+    extract    per case: DCE phases + segmentation -> artifacts/cases/<case>.json
+               (plus the colormap NIfTI, PNG and slice pyramid next to the case)
+    raw        case features -> complete_pipeline_raw_features.csv
+    normalize  raw CSV -> complete_pipeline_normalized_features.csv
+    combat     normalized (or raw) CSV -> complete_pipeline_harmonized_features.csv
+
+artifacts/manifest.json stores the fingerprint of every stage's inputs and
+settings and the digest of its outputs. A stage (or case) is re-run only when
+its fingerprint changed, an output is missing or it is forced, so e.g. changing
+the ComBat reference batch re-runs combat only, and re-extracting a case whose
+features came out identical does not touch the downstream CSVs.
+
+Usage:
+    python pipeline_stages.py BASE_DIR
+    python pipeline_stages.py BASE_DIR --status
+    python pipeline_stages.py BASE_DIR --stages extract --cases DUKE_001 DUKE_002 --force
+    python pipeline_stages.py BASE_DIR --stages combat --combat-ref-batch DUKE
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import pandas as pd
+from dce_kinetics import find_phase_files
+from pipeline_logging import configure_logging, case_context, ProgressReporter
+from case_shards import json_value
+
+logger = logging.getLogger('pipeline.stages')
+
+# Bump when feature extraction changes so stored case features are recomputed
+EXTRACT_VERSION = 1
+
+# Stage -> upstream stages whose outputs it reads (combat reads raw when normalization is off)
+STAGES = {
+    'extract': [],
+    'raw': ['extract'],
+    'normalize': ['raw'],
+    'combat': ['normalize']
+}
+
+def file_digest(path, block_size=1024 * 1024):
+    """SHA-1 of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_signature(path):
+    """Cheap identity of an input file: name, size and modification time"""
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+def fingerprint(value):
+    """Stable hash of a JSON-serializable value"""
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class StagedPipeline:
+    """
+    Stage runner around a CompleteDCEMRIPipeline
+
+    Args:
+        base_dir: Project directory with the dataset folders; CSVs are written here as before
+        pipeline: Configured CompleteDCEMRIPipeline (a default one is created when None)
+        artifact_dir: Where case features and the manifest are stored (base_dir/artifacts by default)
+    """
+
+    def __init__(self, base_dir, pipeline=None, artifact_dir=None):
+        if pipeline is None:
+            from complete_pipeline import CompleteDCEMRIPipeline
+            pipeline = CompleteDCEMRIPipeline()
+        self.base_dir = base_dir
+        self.pipeline = pipeline
+        self.artifact_dir = artifact_dir or os.path.join(base_dir, 'artifacts')
+        self.manifest_path = os.path.join(self.artifact_dir, 'manifest.json')
+        self.manifest = self._load_manifest()
+        self.paths = {
+            'raw': os.path.join(base_dir, 'complete_pipeline_raw_features.csv'),
+            'normalize': os.path.join(base_dir, 'complete_pipeline_normalized_features.csv'),
+            'combat': os.path.join(base_dir, 'complete_pipeline_harmonized_features.csv'),
+            'combat_params': os.path.join(base_dir, 'complete_pipeline_combat_params.npz'),
+            'scalers': os.path.join(base_dir, 'scalers')
+        }
+        self._cases = None
+
+    # ----- manifest -----
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        return {'version': 1, 'entries': {}}
+
+    def _save_manifest(self):
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _is_current(self, key, stage_fingerprint, outputs):
+        entry = self.manifest['entries'].get(key)
+        return (entry is not None and entry['fingerprint'] == stage_fingerprint
+                and all(os.path.exists(path) for path in outputs))
+
+    def _record(self, key, stage_fingerprint, outputs, digest_path):
+        self.manifest['entries'][key] = {
+            'fingerprint': stage_fingerprint,
+            'outputs': outputs,
+            'digest': file_digest(digest_path),
+            'completed': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        self._save_manifest()
+
+    def _digest(self, key):
+        entry = self.manifest['entries'].get(key)
+        return entry['digest'] if entry else None
+
+    # ----- stage declarations -----
+
+    def cases(self):
+        """(dataset, case_id, case_path, segment_dir) of every case under base_dir"""
+        if self._cases is None:
+            self._cases = self.pipeline.find_cases(self.base_dir)
+        return self._cases
+
+    def case_artifact_path(self, case_id):
+        return os.path.join(self.artifact_dir, 'cases', f"{case_id}.json")
+
+    def case_outputs(self, case_id, case_path):
+        """Outputs of the extract stage for one case (features first)"""
+        return [self.case_artifact_path(case_id),
+                os.path.join(case_path, f"{case_id}_colormap.nii.gz"),
+                os.path.join(case_path, f"{case_id}_complete_colormap.png"),
+                os.path.join(case_path, f"{case_id}_slice_pyramid.bin")]
+
+    def extract_fingerprint(self, case_id, case_path, segment_dir):
+        """Fingerprint of a case's input files and the extraction settings"""
+        inputs = list(find_phase_files(case_path))
+        seg_file = os.path.join(segment_dir, f"{case_id}.nii.gz")
+        if os.path.exists(seg_file):
+            inputs.append(seg_file)
+        return fingerprint({
+            'version': EXTRACT_VERSION,
+            'inputs': [file_signature(path) for path in inputs],
+            'radiomics_settings': self.pipeline.radiomics_settings,
+            'radiomics_manifest': self.pipeline.radiomics_manifest,
+            # Above the budget some statistics are sketched, so the budget changes the features
+            'memory_budget_mb': self.pipeline.memory_budget_mb
+        })
+
+    def extracted_cases(self):
+        """Cases whose features artifact is recorded, in case order"""
+        return [case_id for _, case_id, _, _ in self.cases()
+                if f"extract/{case_id}" in self.manifest['entries'] and os.path.exists(self.case_artifact_path(case_id))]
+
+    def combat_input(self):
+        return 'normalize' if self.pipeline.apply_normalization else 'raw'
+
+    def stage_fingerprint(self, name):
+        """Fingerprint of a cohort-level stage: upstream output digests plus its settings"""
+        if name == 'raw':
+            return fingerprint({case_id: self._digest(f"extract/{case_id}") for case_id in self.extracted_cases()})
+        if name == 'normalize':
+            return fingerprint({'raw': self._digest('raw'), 'method': self.pipeline.normalization_method})
+        if name == 'combat':
+            upstream = self.combat_input()
+            return fingerprint({upstream: self._digest(upstream), 'ref_batch': self.pipeline.combat_ref_batch})
+        raise ValueError(f"Unknown stage '{name}'")
+
+    def stage_outputs(self, name):
+        if name == 'combat':
+            return [self.paths['combat'], self.paths['combat_params']]
+        return [self.paths[name]]
+
+    def _require(self, name):
+        if not os.path.exists(self.paths[name]) or self._digest(name) is None:
+            raise RuntimeError(f"Stage '{name}' has no output yet; run it first (--stages {name})")
+
+    # ----- stages -----
+
+    def run_extract(self, case_ids=None, force=False, progress_interval=10.0):
+        """Extract features of the selected cases whose inputs or settings changed"""
+        selected = [case for case in self.cases() if case_ids is None or case[1] in case_ids]
+        if case_ids is not None:
+            unknown = set(case_ids) - {case[1] for case in selected}
+            if unknown:
+                logger.warning("Unknown cases ignored: %s", ', '.join(sorted(unknown)))
+
+        todo = []
+        for dataset, case_id, case_path, segment_dir in selected:
+            case_fingerprint = self.extract_fingerprint(case_id, case_path, segment_dir)
+            if force or not self._is_current(f"extract/{case_id}", case_fingerprint,
+                                             self.case_outputs(case_id, case_path)):
+                todo.append((dataset, case_id, case_path, segment_dir, case_fingerprint))
+        logger.info("extract: %d of %d cases to run", len(todo), len(selected))
+
+        progress = ProgressReporter(len(todo), interval=progress_interval)
+        for dataset, case_id, case_path, segment_dir, case_fingerprint in todo:
+            key = f"extract/{case_id}"
+            with case_context(case_id):
+                with self.pipeline.metrics.case(case_id, dataset) as record:
+                    features = self.pipeline.process_case(case_id, case_path, segment_dir)
+
+                artifact_path = self.case_artifact_path(case_id)
+                if features:
+                    os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+                    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(features, f, default=json_value)
+                    os.replace(tmp_path, artifact_path)
+                    self._record(key, case_fingerprint, self.case_outputs(case_id, case_path), artifact_path)
+                elif key in self.manifest['entries']:
+                    # Never feed stale features from earlier inputs downstream
+                    del self.manifest['entries'][key]
+                    if os.path.exists(artifact_path):
+                        os.remove(artifact_path)
+                    self._save_manifest()
+                error = record['errors'][0]['message'] if record['errors'] else None
+                progress.case_done(case_id, ok=bool(features), stages=record['stages'], error=error)
+        progress.finish()
+        return len(todo)
+
+    def run_raw(self, force=False):
+        """Raw feature CSV of every extracted case"""
+        stage_fingerprint = self.stage_fingerprint('raw')
+        if not force and self._is_current('raw', stage_fingerprint, self.stage_outputs('raw')):
+            logger.info("raw: up to date")
+            return False
+        case_ids = self.extracted_cases()
+        if not case_ids:
+            raise RuntimeError("No extracted cases; run the extract stage first")
+
+        all_features = []
+        for case_id in case_ids:
+            with open(self.case_artifact_path(case_id), encoding='utf-8') as f:
+                all_features.append(json.load(f))
+        features_df = pd.DataFrame(all_features)
+        features_df.to_csv(self.paths['raw'], index=False)
+        self._record('raw', stage_fingerprint, self.stage_outputs('raw'), self.paths['raw'])
+        logger.info("raw: %d cases, %d features -> %s", len(features_df), len(features_df.columns) - 1, self.paths['raw'])
+        return True
+
+    def run_normalize(self, force=False, refit=False):
+        """Normalized feature CSV (reusing the saved scaler unless refit)"""
+        if not self.pipeline.apply_normalization:
+            logger.info("normalize: disabled")
+            return False
+        self._require('raw')
+        stage_fingerprint = self.stage_fingerprint('normalize')
+        if not (force or refit) and self._is_current('normalize', stage_fingerprint, self.stage_outputs('normalize')):
+            logger.info("normalize: up to date")
+            return False
+
+        features_df = pd.read_csv(self.paths['raw'])
+        with self.pipeline.metrics.stage('normalization'):
+            normalized_df = self.pipeline.apply_comprehensive_normalization(
+                features_df, scaler_dir=self.paths['scalers'], refit=refit)
+        normalized_df.to_csv(self.paths['normalize'], index=False)
+        self._record('normalize', stage_fingerprint, self.stage_outputs('normalize'), self.paths['normalize'])
+        logger.info("normalize: %s -> %s", self.pipeline.normalization_method, self.paths['normalize'])
+        return True
+
+    def run_combat(self, force=False):
+        """Harmonized feature CSV and ComBat parameters"""
+        upstream = self.combat_input()
+        self._require(upstream)
+        stage_fingerprint = self.stage_fingerprint('combat')
+        if not force and self._is_current('combat', stage_fingerprint, self.stage_outputs('combat')):
+            logger.info("combat: up to date")
+            return False
+
+        features_df = pd.read_csv(self.paths[upstream])
+        with self.pipeline.metrics.stage('combat'):
+            harmonized_df = self.pipeline.apply_combat_harmonization(features_df, params_path=self.paths['combat_params'])
+        harmonized_df.to_csv(self.paths['combat'], index=False)
+        self._record('combat', stage_fingerprint, self.stage_outputs('combat'), self.paths['combat'])
+        logger.info("combat: ref batch %s -> %s", self.pipeline.combat_ref_batch, self.paths['combat'])
+        return True
+
+    def run(self, stages=None, case_ids=None, force=False, refit=False, progress_interval=10.0):
+        """
+        Run the selected stages in dependency order
+
+        Args:
+            stages: Stage names (all stages when None); unselected stages are not run
+            case_ids: Restrict extraction to these cases (others keep their stored features)
+            force: Re-run the selected stages even when they are up to date
+            refit: Fit a new normalization scaler instead of reusing the saved one
+        """
+        stages = list(STAGES) if stages is None else stages
+        unknown = [name for name in stages if name not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}; choose from {list(STAGES)}")
+        self.pipeline.metrics.set_output(os.path.join(self.base_dir, 'pipeline_metrics.jsonl'))
+        try:
+            for name in STAGES:
+                if name not in stages:
+                    continue
+                if name == 'extract':
+                    self.run_extract(case_ids, force=force, progress_interval=progress_interval)
+                elif name == 'normalize':
+                    self.run_normalize(force=force, refit=refit)
+                else:
+                    getattr(self, f"run_{name}")(force=force)
+        finally:
+            self.pipeline.metrics.finish()
+
+    def status(self, case_ids=None):
+        """(stage or extract/<case>, 'current' | 'stale') for every selected case and stage"""
+        rows = []
+        for _, case_id, case_path, segment_dir in self.cases():
+            if case_ids is None or case_id in case_ids:
+                current = self._is_current(f"extract/{case_id}", self.extract_fingerprint(case_id, case_path, segment_dir),
+                                           self.case_outputs(case_id, case_path))
+                rows.append((f"extract/{case_id}", 'current' if current else 'stale'))
+        for name in ['raw', 'normalize', 'combat']:
+            if name == 'normalize' and not self.pipeline.apply_normalization:
+                continue
+            current = self._is_current(name, self.stage_fingerprint(name), self.stage_outputs(name))
+            rows.append((name, 'current' if current else 'stale'))
+        return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_dir', help='Project directory with the DUKE/ISPY1/ISPY2/NACT folders')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='Stages to run (default: all)')
+    parser.add_argument('--cases', nargs='+', help='Only extract these case ids')
+    parser.add_argument('--force', action='store_true', help='Re-run the selected stages even if up to date')
+    parser.add_argument('--status', action='store_true', help='Show which stages are stale and exit')
+    parser.add_argument('--artifact-dir', help='Artifact directory (default: BASE_DIR/artifacts)')
+    parser.add_argument('--normalization', choices=['minmax', 'robust', 'none'], default='minmax')
+    parser.add_argument('--refit-scaler', action='store_true', help='Fit a new scaler instead of reusing the saved one')
+    parser.add_argument('--combat-ref-batch', help='Dataset kept fixed by ComBat (e.g. DUKE)')
+    parser.add_argument('--memory-budget-mb', type=int, help='Stream kinetics in z-slabs above this working set')
+    parser.add_argument('--volume-cache-dir', help='Shared cache of decompressed volumes')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress lines')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--log-file')
+    args = parser.parse_args(argv)
+
+    configure_logging(args.log_level, args.log_file)
+    from complete_pipeline import CompleteDCEMRIPipeline
+    pipeline = CompleteDCEMRIPipeline(apply_normalization=args.normalization != 'none',
+                                      normalization_method=args.normalization if args.normalization != 'none' else 'minmax',
+                                      combat_ref_batch=args.combat_ref_batch, memory_budget_mb=args.memory_budget_mb,
+                                      volume_cache_dir=args.volume_cache_dir)
+    staged = StagedPipeline(args.base_dir, pipeline, artifact_dir=args.artifact_dir)
+
+    if args.status:
+        for key, state in staged.status(args.cases):
+            print(f"{key:<40}{state}")
+        return 0
+
+    staged.run(args.stages, case_ids=args.cases, force=args.force, refit=args.refit_scaler,
+               progress_interval=args.progress_interval)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Fast integrity and geometry checks of every case before feature extraction
+
+For each case the checks read the NIfTI headers of its phases and
+segmentation and the segmentation's voxels (small and highly compressible).
+They also optionally stream every .nii.gz through gzip to validate its CRC
+and length. No image volume is decoded into memory. Cases with errors can be
+skipped before any kinetics or radiomics time is spent on them.
+
+Checks:
+    missing  _0000/_0001 phase or segmentation file absent
+    header   unreadable NIfTI header, non-3D volume or degenerate affine
+    gzip     truncated file or CRC/length mismatch
+    dims     phase or mask shape differs from _0000
+    affine   phase or mask affine differs from _0000 (voxel grids do not align)
+    mask     no ROI voxels, or no voxels with the radiomics label (error);
+             labels other than 0/1 (warning: kinetics use mask > 0, radiomics label 1)
+
+Usage:
+    python preflight.py BASE_DIR [--workers 8] [--no-gzip-check] [--report preflight_report.csv]
+"""
+import os
+import sys
+import zlib
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from blocked_gzip import gzip_module, default_workers
+from dce_kinetics import find_phase_files
+from pipeline_logging import configure_logging
+
+logger = logging.getLogger('pipeline.preflight')
+
+# Largest affine difference (mm, or direction cosine) still treated as the same grid
+AFFINE_TOLERANCE = 1e-3
+RADIOMICS_LABEL = 1
+GZIP_CHUNK_BYTES = 1 << 20
+
+# Failure reason per check, as recorded in the metrics and grouped in the progress summary
+CHECK_REASONS = {
+    'missing': 'Preflight: input files missing',
+    'header': 'Preflight: unreadable or invalid NIfTI header',
+    'gzip': 'Preflight: corrupt gzip file',
+    'dims': 'Preflight: volume dimensions differ',
+    'affine': 'Preflight: volume affines differ',
+    'mask': 'Preflight: empty or unlabeled segmentation'
+}
+
+def verify_gzip(path):
+    """Stream a gzip file to its end; raises on truncation or a CRC/length mismatch"""
+    with gzip_module.open(path, 'rb') as f:
+        while f.read(GZIP_CHUNK_BYTES):
+            pass
+
+def check_case(dataset, case_id, case_path, segment_dir, check_gzip=True):
+    """
+    Run every check on one case
+
+    Returns:
+        {'dataset', 'case_id', 'status': 'ok'|'warning'|'error', 'issues': [(severity, check, message)]}
+    """
+    issues = []
+
+    def issue(severity, check, message):
+        issues.append((severity, check, message))
+
+    phase_files = find_phase_files(case_path) if os.path.isdir(case_path) else []
+    seg_file = os.path.join(segment_dir, f"{case_id}.nii.gz")
+    names = [os.path.basename(path) for path in phase_files]
+    for required in (f"{case_id}_0000.nii.gz", f"{case_id}_0001.nii.gz"):
+        if required not in names:
+            issue('error', 'missing', f"{required} not found")
+    if not os.path.exists(seg_file):
+        issue('error', 'missing', f"segmentation {os.path.basename(seg_file)} not found")
+    if issues:
+        return _result(dataset, case_id, issues)
+
+    # Headers only; nibabel inflates just the first 348 bytes of a .nii.gz
+    images = {}
+    for path in phase_files + [seg_file]:
+        name = os.path.basename(path)
+        try:
+            image = nib.load(path)
+            shape = image.shape
+        except Exception as e:
+            issue('error', 'header', f"{name}: {e}")
+            continue
+        if len(shape) != 3 and not (len(shape) == 4 and shape[3] == 1):
+            issue('error', 'header', f"{name}: expected a 3D volume, got shape {shape}")
+            continue
+        affine = image.affine
+        if not np.all(np.isfinite(affine)) or abs(np.linalg.det(affine[:3, :3])) < 1e-12:
+            issue('error', 'header', f"{name}: degenerate affine")
+            continue
+        images[path] = image
+
+    corrupt = set()
+    if check_gzip:
+        for path in phase_files + [seg_file]:
+            if path.endswith('.gz'):
+                try:
+                    verify_gzip(path)
+                except (OSError, EOFError, zlib.error) as e:
+                    issue('error', 'gzip', f"{os.path.basename(path)}: {e}")
+                    corrupt.add(path)
+
+    reference = images.get(phase_files[0])
+    if reference is not None:
+        ref_shape = reference.shape[:3]
+        for path, image in images.items():
+            if path == phase_files[0]:
+                continue
+            name = os.path.basename(path)
+            if image.shape[:3] != ref_shape:
+                issue('error', 'dims', f"{name} shape {image.shape[:3]} differs from _0000 {ref_shape}")
+            elif not np.allclose(image.affine, reference.affine, atol=AFFINE_TOLERANCE):
+                difference = np.abs(image.affine - reference.affine).max()
+                issue('error', 'affine', f"{name} affine differs from _0000 by up to {difference:.4g}")
+
+    mask_image = images.get(seg_file)
+    if mask_image is not None and seg_file not in corrupt:
+        try:
+            mask = np.asarray(mask_image.dataobj)
+        except Exception as e:
+            issue('error', 'header', f"{os.path.basename(seg_file)}: cannot read voxels: {e}")
+        else:
+            labels, counts = np.unique(mask, return_counts=True)
+            roi_voxels = int(counts[labels > 0].sum())
+            if roi_voxels == 0:
+                issue('error', 'mask', "segmentation has no ROI voxels")
+            elif RADIOMICS_LABEL not in labels:
+                issue('error', 'mask', f"segmentation has no voxels with label {RADIOMICS_LABEL}")
+            elif np.any((labels != 0) & (labels != RADIOMICS_LABEL)):
+                extra = [label.item() for label in labels if label not in (0, RADIOMICS_LABEL)]
+                issue('warning', 'mask', f"labels {extra[:5]} are in the kinetic ROI but not in radiomics")
+    return _result(dataset, case_id, issues)
+
+def _result(dataset, case_id, issues):
+    severities = {severity for severity, _, _ in issues}
+    status = 'error' if 'error' in severities else 'warning' if severities else 'ok'
+    return {'dataset': dataset, 'case_id': case_id, 'status': status, 'issues': issues}
+
+def failure_reason(result):
+    """Grouping reason of a rejected case (its first error check)"""
+    check = next(check for severity, check, _ in result['issues'] if severity == 'error')
+    return CHECK_REASONS[check]
+
+def run_preflight(cases, workers=None, check_gzip=True, report_path=None):
+    """
+    Check cases in parallel threads (zlib and file reads release the GIL)
+
+    Args:
+        cases: (dataset, case_id, case_path, segment_dir) tuples as returned by find_cases
+        report_path: Also write the results as CSV (dataset, case_id, status, issues)
+
+    Returns:
+        Results of check_case, in the order of cases
+    """
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+        results = list(pool.map(lambda case: check_case(*case, check_gzip=check_gzip), cases))
+
+    counts = {status: sum(result['status'] == status for result in results) for status in ('ok', 'warning', 'error')}
+    logger.info("Preflight: %d cases ok, %d with warnings, %d rejected", counts['ok'], counts['warning'], counts['error'])
+    for result in results:
+        for severity, check, message in result['issues']:
+            log = logger.error if severity == 'error' else logger.warning
+            log("%s: %s check: %s", result['case_id'], check, message)
+
+    if report_path:
+        report = pd.DataFrame([{
+            'dataset': result['dataset'],
+            'case_id': result['case_id'],
+            'status': result['status'],
+            'issues': '; '.join(f"{severity} {check}: {message}" for severity, check, message in result['issues'])
+        } for result in results], columns=['dataset', 'case_id', 'status', 'issues'])
+        report.to_csv(report_path, index=False)
+        logger.info("Preflight report saved: %s", report_path)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_dir', help='Project directory with the dataset folders')
+    parser.add_argument('--workers', type=int, help='Parallel checking threads')
+    parser.add_argument('--no-gzip-check', action='store_true', help='Skip the full gzip CRC pass (headers and masks only)')
+    parser.add_argument('--report', help='Report CSV (default: BASE_DIR/preflight_report.csv)')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    configure_logging(args.log_level)
+    from complete_pipeline import CompleteDCEMRIPipeline
+    cases = CompleteDCEMRIPipeline(apply_normalization=False).find_cases(args.base_dir)
+    results = run_preflight(cases, workers=args.workers, check_gzip=not args.no_gzip_check,
+                            report_path=args.report or os.path.join(args.base_dir, 'preflight_report.csv'))
+    return 1 if any(result['status'] == 'error' for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import numpy as np
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with bounded memory (KLL-style compactors)
+
+    Values are added in batches to level 0. A level that grows past its capacity
+    is sorted and every other item is promoted to the next level with twice the
+    weight, so memory stays O(k log(n/k)) however many values are streamed in.
+    Sketches built on separate chunks can be merged. Until the first compaction
+    the sketch holds every value and quantiles are exact.
+    """
+
+    def __init__(self, k=512):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        # Alternating compaction offsets keep results deterministic
+        self._offsets = [0]
+
+    def update(self, values):
+        """Add a batch of values (NaNs are ignored)"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Merge another sketch into this one"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self._offsets.append(0)
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _capacity(self, h):
+        # Lower levels get geometrically smaller buffers
+        depth = len(self.levels) - 1 - h
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self._offsets.append(0)
+                items = np.sort(self.levels[h])
+                # An odd item out stays on this level
+                keep = items[len(items) - len(items) % 2:]
+                items = items[:len(items) - len(items) % 2]
+                offset = self._offsets[h]
+                self._offsets[h] ^= 1
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[offset::2]])
+                self.levels[h] = keep
+            h += 1
+
+    def _weighted_items(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        """Estimated quantile(s) for q in [0, 1]"""
+        if self.count == 0:
+            return np.nan if np.isscalar(q) else np.full(np.shape(q), np.nan)
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], q)
+        values, weights = self._weighted_items()
+        cumulative = np.cumsum(weights) - weights / 2
+        result = np.interp(np.asarray(q, dtype=np.float64) * weights.sum(), cumulative, values)
+        return np.clip(result, self.min, self.max)
+
+    def percentile(self, p):
+        return self.quantile(np.asarray(p, dtype=np.float64) / 100.0)
+
+    def cdf(self, x):
+        """Estimated fraction of values <= x"""
+        if self.count == 0:
+            return np.zeros(np.shape(x))
+        values, weights = self._weighted_items()
+        cumulative = np.concatenate([[0.0], np.cumsum(weights)])
+        return cumulative[np.searchsorted(values, x, side='right')] / cumulative[-1]
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'count': self.count,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'levels': [items.tolist() for items in self.levels],
+            'offsets': list(self._offsets)
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(k=state['k'])
+        sketch.count = state['count']
+        sketch.min = np.inf if state['min'] is None else state['min']
+        sketch.max = -np.inf if state['max'] is None else state['max']
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in state['levels']]
+        sketch._offsets = list(state['offsets'])
+        return sketch
@@ -0,0 +1,150 @@
+"""
+Declarative selection of the radiomics features the pipeline computes
+
+A manifest uses pyradiomics' parameter-file layout and may be JSON or YAML:
+
+    {"imageType": {"Original": {}},
+     "featureClass": {"shape": ["VoxelVolume", "Sphericity"], "firstorder": [], "glcm": []}}
+
+Only the listed image types and feature classes are enabled on the
+extractor. An empty list enables every feature of its class, and classes
+that are not listed never run. radiomics_manifest.json (the default)
+reproduces pyradiomics' default Original-image features.
+radiomics_manifest_minimal.json keeps the shape and first-order features the
+dashboard and temporal-change features need.
+
+Per-class extraction times are recorded as radiomics_t0.extract.<image type>_<class>
+stages in pipeline_metrics.jsonl. The report below uses them to estimate the
+time each disabled class saves per case.
+
+Usage:
+    python radiomics_manifest.py BASE_DIR [--manifest radiomics_manifest_minimal.json]
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'radiomics_manifest.json')
+
+# Per-class extraction stages written by parallel_radiomics.TimedFeatureExtractor
+CLASS_STAGE_PATTERN = re.compile(r'^radiomics_t[01]\.extract\.[^.]+?_([A-Za-z0-9]+)$')
+
+def load_manifest(path=None):
+    """
+    Read and validate a manifest (DEFAULT_MANIFEST_PATH when None)
+
+    Returns:
+        {'imageType': {name: settings}, 'featureClass': {class: [feature names]}}
+    """
+    path = path or DEFAULT_MANIFEST_PATH
+    with open(path, encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml  # installed with pyradiomics
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    unknown = set(manifest) - {'imageType', 'featureClass'}
+    if unknown:
+        raise ValueError(f"Unknown manifest sections in {path}: {sorted(unknown)}")
+    image_types = manifest.get('imageType') or {'Original': {}}
+    feature_classes = manifest.get('featureClass')
+    if not feature_classes:
+        raise ValueError(f"Manifest {path} enables no feature classes")
+    for name, settings in image_types.items():
+        if not isinstance(settings, dict):
+            raise ValueError(f"Image type {name} in {path} must map to a settings object")
+    for name, features in feature_classes.items():
+        if features is not None and not isinstance(features, list):
+            raise ValueError(f"Feature class {name} in {path} must map to a list of feature names")
+    return {
+        'imageType': {name: dict(settings) for name, settings in image_types.items()},
+        'featureClass': {name: list(features or []) for name, features in feature_classes.items()}
+    }
+
+def apply_manifest(extractor, manifest):
+    """
+    Enable exactly the manifest's image types and features on a RadiomicsFeatureExtractor
+
+    Classes are enabled in pyradiomics' getFeatureClasses() order, whatever
+    their order in the manifest. Feature columns then come out in the order of
+    pyradiomics' defaults, which keeps the feature table version of saved
+    scalers and ComBat parameters.
+    """
+    from radiomics import getFeatureClasses
+    class_order = list(getFeatureClasses())
+    feature_classes = sorted(manifest['featureClass'].items(),
+                             key=lambda item: class_order.index(item[0]) if item[0] in class_order else len(class_order))
+    extractor.disableAllImageTypes()
+    extractor.enableImageTypes(**manifest['imageType'])
+    extractor.disableAllFeatures()
+    extractor.enableFeaturesByName(**dict(feature_classes))
+
+def class_timings(metrics_path):
+    """
+    Mean extraction time per case and feature class (t0 + t1, all image types)
+
+    Every case record in the metrics file counts, across runs, so classes a
+    manifest has since disabled keep the timings of earlier runs.
+
+    Returns:
+        {class: {'cases': n, 'mean_s': seconds per case}}
+    """
+    per_class = {}
+    with open(metrics_path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('record') != 'case':
+                continue
+            case_times = {}
+            for stage, stats in record['stages'].items():
+                match = CLASS_STAGE_PATTERN.match(stage)
+                if match:
+                    case_times[match.group(1)] = case_times.get(match.group(1), 0.0) + stats['wall_s']
+            for name, seconds in case_times.items():
+                per_class.setdefault(name, []).append(seconds)
+    return {name: {'cases': len(times), 'mean_s': float(np.mean(times))} for name, times in per_class.items()}
+
+def savings_report(metrics_path, manifest):
+    """
+    Measured time per class and what the manifest saves per case
+
+    Returns:
+        (rows sorted by time, text table)
+    """
+    enabled = set(manifest['featureClass'])
+    rows = [{'class': name, 'cases': stats['cases'], 'mean_s': stats['mean_s'], 'enabled': name in enabled,
+             'saved_s': 0.0 if name in enabled else stats['mean_s']}
+            for name, stats in class_timings(metrics_path).items()]
+    rows.sort(key=lambda row: -row['mean_s'])
+
+    lines = [f"{'Class':<14}{'Cases':>7}{'s/case':>10}{'Status':>10}{'Saved s/case':>14}"]
+    for row in rows:
+        lines.append(f"{row['class']:<14}{row['cases']:>7}{row['mean_s']:>10.3f}"
+                     f"{'enabled' if row['enabled'] else 'skipped':>10}{row['saved_s']:>14.3f}")
+    total = sum(row['mean_s'] for row in rows)
+    saved = sum(row['saved_s'] for row in rows)
+    lines.append(f"Radiomics classes: {total:.3f} s/case measured, {saved:.3f} s/case saved"
+                 f" ({saved / total * 100 if total else 0:.0f}%)")
+    unmeasured = sorted(enabled - {row['class'] for row in rows})
+    if unmeasured:
+        lines.append(f"No timings yet for: {', '.join(unmeasured)}")
+    return rows, '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_dir', help='Project directory with pipeline_metrics.jsonl')
+    parser.add_argument('--manifest', help='Manifest to evaluate (default: radiomics_manifest.json)')
+    parser.add_argument('--metrics-file', help='Metrics JSON lines (default: BASE_DIR/pipeline_metrics.jsonl)')
+    args = parser.parse_args(argv)
+
+    metrics_path = args.metrics_file or os.path.join(args.base_dir, 'pipeline_metrics.jsonl')
+    _, table = savings_report(metrics_path, load_manifest(args.manifest))
+    print(table)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Radiomics parameter sweeps (binWidth, distances, ...) over the pipeline's settings
+
+Sweeping pyradiomics parameters with one extractor run per parameter set
+would repeat every step for each set. Here each case image is:
+    - read, aligned to its mask and resampled to 1 mm once per image;
+    - discretized once per binWidth/binCount, shared by all feature classes;
+    - turned into texture matrices once per (binning, class-specific settings),
+      so e.g. a distance sweep reuses the GLRLM and GLSZM matrices
+(see texture_cache). Only the features of each parameter set are then
+recomputed. Every other setting, and the features computed, come from the
+pipeline (its radiomics settings and manifest), so a parameter set equal to
+the pipeline's gives the pipeline's feature values.
+
+Output: one row per case, timepoint and parameter set, with the
+non-diagnostic features of the manifest's image types.
+
+Usage:
+    python radiomics_sweep.py BASE_DIR [--bin-widths 5 10 25] [--distances 1 2 3] [--output radiomics_sweep.csv]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import itertools
+import pandas as pd
+from dce_kinetics import find_phase_files
+from pipeline_logging import configure_logging, case_context
+from texture_cache import TextureCache
+
+logger = logging.getLogger('pipeline.sweep')
+
+# Settings a sweep may vary; the rest (resampling in particular) is shared by all parameter sets
+SWEEP_SETTINGS = ('binWidth', 'binCount', 'distances', 'symmetricalGLCM', 'weightingNorm', 'gldm_a')
+
+def settings_grid(**values):
+    """
+    Every combination of the given setting values
+
+    Example: settings_grid(binWidth=[5, 10], distances=[[1], [1, 2]]) gives 4 parameter sets
+    """
+    unknown = set(values) - set(SWEEP_SETTINGS)
+    if unknown:
+        raise ValueError(f"Settings {sorted(unknown)} cannot be swept (allowed: {', '.join(SWEEP_SETTINGS)})")
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*(values[name] for name in names))]
+
+class RadiomicsSweep:
+    """
+    Feature extraction for many parameter sets sharing discretization and texture matrices
+
+    Args:
+        pipeline: CompleteDCEMRIPipeline whose radiomics settings and manifest are swept
+        cache: TextureCache (a new one when None); keep one per sweep, it holds matrices of all cases seen
+    """
+
+    def __init__(self, pipeline, cache=None):
+        self.pipeline = pipeline
+        self.cache = cache or TextureCache()
+
+    def extract(self, image_path, mask_path, grid, label=1):
+        """
+        Features of one image for each parameter set
+
+        Args:
+            image_path, mask_path: NIfTI paths or SimpleITK images
+            grid: Parameter sets (dicts of SWEEP_SETTINGS), e.g. from settings_grid
+
+        Returns:
+            [(parameter set, {feature: value})] in the order of grid
+        """
+        import SimpleITK as sitk
+        from radiomics import imageoperations
+        from parallel_radiomics import TimedFeatureExtractor
+
+        for params in grid:
+            unknown = set(params) - set(SWEEP_SETTINGS)
+            if unknown:
+                raise ValueError(f"Settings {sorted(unknown)} cannot be swept")
+
+        image = image_path if isinstance(image_path, sitk.Image) else sitk.ReadImage(image_path)
+        mask = mask_path if isinstance(mask_path, sitk.Image) else sitk.ReadImage(mask_path)
+        mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor)
+
+        # Resample once, as pyradiomics would for each parameter set; the extractors below skip it
+        settings = dict(self.pipeline.radiomics_settings)
+        if settings.get('resampledPixelSpacing') is not None:
+            image, mask = imageoperations.resampleImage(image, mask, label=label, **settings)
+        settings['resampledPixelSpacing'] = None
+
+        results = []
+        for params in grid:
+            extractor = TimedFeatureExtractor(manifest=self.pipeline.radiomics_manifest, cache=self.cache,
+                                              **{**settings, **params})
+            features = extractor.execute(image, mask, label)
+            clean_features = {}
+            for key, value in features.items():
+                if key.startswith('diagnostics_'):
+                    continue
+                try:
+                    clean_features[key] = float(value)
+                except (ValueError, TypeError):
+                    clean_features[key] = str(value)
+            results.append((params, clean_features))
+        return results
+
+    def sweep_case(self, case_id, case_path, segment_dir, grid):
+        """
+        Sweep both timepoints of a case
+
+        Returns:
+            Rows of case_id, timepoint, the parameter set and its features ([] on error)
+        """
+        phase_files = find_phase_files(case_path)
+        mask_path = os.path.join(segment_dir, f"{case_id}.nii.gz")
+        rows = []
+        try:
+            for timepoint, image_path in (('t0', phase_files[0]), ('t1', phase_files[1])):
+                for params, features in self.extract(image_path, mask_path, grid):
+                    rows.append({'case_id': case_id, 'timepoint': timepoint,
+                                 **{name: str(value) if isinstance(value, list) else value
+                                    for name, value in params.items()},
+                                 **features})
+        except Exception as e:
+            logger.error("Sweep failed: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return []
+        return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_dir', help='Project directory with the dataset folders')
+    parser.add_argument('--bin-widths', type=float, nargs='+', help='binWidth values (default: the pipeline\'s)')
+    parser.add_argument('--distances', type=int, nargs='+',
+                        help='Texture distances, each swept on its own (default: the pipeline\'s)')
+    parser.add_argument('--case-list', help='Sweep only the case ids listed in this file')
+    parser.add_argument('--radiomics-manifest', help='JSON/YAML manifest of the radiomics features to compute')
+    parser.add_argument('--output', help='Output CSV (default: BASE_DIR/radiomics_sweep.csv)')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    configure_logging(args.log_level)
+    from complete_pipeline import CompleteDCEMRIPipeline
+    from case_shards import read_case_list
+    pipeline = CompleteDCEMRIPipeline(apply_normalization=False, radiomics_manifest=args.radiomics_manifest)
+    values = {}
+    if args.bin_widths:
+        values['binWidth'] = [int(width) if width.is_integer() else width for width in args.bin_widths]
+    if args.distances:
+        values['distances'] = [[distance] for distance in args.distances]
+    grid = settings_grid(**values) if values else [{}]
+
+    cases = pipeline.find_cases(args.base_dir)
+    if args.case_list:
+        wanted = set(read_case_list(args.case_list))
+        cases = [case for case in cases if case[1] in wanted]
+    logger.info("Sweeping %d cases over %d parameter sets", len(cases), len(grid))
+
+    sweep = RadiomicsSweep(pipeline)
+    rows = []
+    start = time.perf_counter()
+    for dataset, case_id, case_path, segment_dir in cases:
+        with case_context(case_id):
+            case_start = time.perf_counter()
+            case_rows = sweep.sweep_case(case_id, case_path, segment_dir, grid)
+            for row in case_rows:
+                row['dataset'] = dataset
+            rows += case_rows
+            logger.info("Swept in %.2f s", time.perf_counter() - case_start)
+    stats = sweep.cache.stats()
+    logger.info("Sweep done in %.1f s; binning %d computed / %d reused, matrices %d computed / %d reused",
+                time.perf_counter() - start, stats['binning_misses'], stats['binning_hits'],
+                stats['matrix_misses'], stats['matrix_hits'])
+
+    if not rows:
+        logger.error("No features extracted")
+        return 1
+    output = args.output or os.path.join(args.base_dir, 'radiomics_sweep.csv')
+    table = pd.DataFrame(rows)
+    leading = ['dataset', 'case_id', 'timepoint'] + [name for name in values if name in table.columns]
+    table = table[leading + [column for column in table.columns if column not in leading]]
+    table.to_csv(output, index=False)
+    logger.info("Sweep results saved: %s", output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
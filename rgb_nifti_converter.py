@@ -1,9 +1,33 @@
 import os
+import logging
 import nibabel as nib
 import numpy as np
-import SimpleITK as sitk
+from volume_cache import VolumeCache, load_nifti
+from blocked_gzip import BlockedGzipWriter
 
-def convert_to_rgb_nifti(img_ref_path, class_arr, out_path):
+logger = logging.getLogger(__name__)
+
+RGB_DTYPE = np.dtype([('R', np.uint8), ('G', np.uint8), ('B', np.uint8)])
+
+def rgb_nifti_header_bytes(nii_orig, shape):
+    """
+    Header (and padding up to vox_offset) of the RGB24 NIfTI of a reference image
+
+    Same bytes as nib.Nifti1Image(rgb, affine, header=nii_orig.header).to_bytes()
+    up to the voxel data, without building the full RGB volume.
+    """
+    probe = nib.Nifti1Image(np.zeros(shape[:2] + (1,), dtype=RGB_DTYPE), nii_orig.affine, header=nii_orig.header)
+    probe.header['datatype'] = 128  # RGB24
+    probe.header['bitpix'] = 24     # 24-bit RGB
+    probe_bytes = probe.to_bytes()
+    prefix = bytearray(probe_bytes[:len(probe_bytes) - shape[0] * shape[1] * RGB_DTYPE.itemsize])
+    # Header as written (vox_offset, scaling), with the full volume shape
+    header = nib.Nifti1Header(binaryblock=bytes(prefix[:348]))
+    header.set_data_shape(shape)
+    prefix[:348] = header.binaryblock
+    return bytes(prefix)
+
+def convert_to_rgb_nifti(img_ref_path, class_arr, out_path, slab_depth=16, volume=None):
     """
     Αποθηκεύει το colormap ως RGB NIfTI για συμβατότητα με προγράμματα απεικόνισης όπως το Mango
     
@@ -11,22 +35,27 @@ def convert_to_rgb_nifti(img_ref_path, class_arr, out_path):
         img_ref_path: Διαδρομή προς το αρχείο αναφοράς για affine και header
         class_arr: Πίνακας με τις κατηγορίες (1:Uptake, 2:Plateau, 3:Washout)
         out_path: Διαδρομή για την αποθήκευση του RGB NIfTI αρχείου
+        slab_depth: Αριθμός αξονικών τομών που επεξεργάζονται μαζί (φραγμένη μνήμη)
+        volume: Ο όγκος αναφοράς αν είναι ήδη στη μνήμη (αλλιώς διαβάζεται ανά slab, δύο φορές)
     """
-    # Φορτώνουμε την εικόνα αναφοράς με το ίδιο μέγεθος μέσω nibabel
-    # για να αποφύγουμε προβλήματα διαστάσεων
-    nii_orig = nib.load(img_ref_path)
-    mri_array = nii_orig.get_fdata()
+    # Φορτώνουμε την εικόνα αναφοράς μέσω nibabel (μόνο header/proxy, όχι ολόκληρο τον όγκο)
+    nii_orig = nib.load(img_ref_path, keep_file_open=True)
+    n_slices = class_arr.shape[2]
     
-    # Κανονικοποιούμε το υποκείμενο MRI ώστε να έχουμε grayscale background
-    # (μετατροπή σε 0-255 για απόχρωση του γκρι)
-    normalized_mri = ((mri_array - mri_array.min()) / (mri_array.max() - mri_array.min() + 1e-10) * 255).astype(np.uint8)
+    def iter_slabs():
+        for z0 in range(0, n_slices, slab_depth):
+            z1 = min(z0 + slab_depth, n_slices)
+            slab = volume[:, :, z0:z1] if volume is not None else nii_orig.dataobj[:, :, z0:z1]
+            yield z0, z1, np.asarray(slab, dtype=np.float64)
     
-    # Δημιουργούμε RGB volume με την υποκείμενη εικόνα ως grayscale background
-    rgb_volume = np.zeros((*class_arr.shape, 3), dtype=np.uint8)
-    
-    # Ορίζουμε το grayscale background (αντιγράφουμε την ίδια τιμή σε R,G,B κανάλια)
-    for i in range(3):
-        rgb_volume[:, :, :, i] = normalized_mri
+    # Πρώτο πέρασμα: ελάχιστη/μέγιστη τιμή του MRI για την κανονικοποίηση
+    if volume is not None:
+        mri_min, mri_max = volume.min(), volume.max()
+    else:
+        mri_min, mri_max = np.inf, -np.inf
+        for _, _, slab in iter_slabs():
+            mri_min = min(mri_min, slab.min())
+            mri_max = max(mri_max, slab.max())
     
     # Παράγουμε τον χρωματικό χάρτη - τώρα θα εφαρμόζει τα χρώματα μόνο στις περιοχές ενδιαφέροντος
     colors = {
@@ -34,39 +63,42 @@ def convert_to_rgb_nifti(img_ref_path, class_arr, out_path):
         2: [0, 255, 0],    # Plateau -> Πράσινο
         3: [255, 0, 0]     # Washout -> Κόκκινο
     }
-    for class_value, color_rgb in colors.items():
-        mask = (class_arr == class_value)
-        # Εφαρμόζουμε το κάθε χρώμα στα voxel της αντίστοιχης κλάσης
-        for i, c in enumerate(color_rgb):
-            rgb_volume[mask, i] = c
-    
-    # Μετατρέπουμε το array σε μορφή συμβατή με RGB NIfTI
-    rgb_dtype = np.dtype([('R', np.uint8), ('G', np.uint8), ('B', np.uint8)])
     
-    # Αναδιαμορφώνουμε το array για συμβατότητα με το nibabel
-    reshaped = np.zeros(class_arr.shape, dtype=rgb_dtype)
-    reshaped['R'] = rgb_volume[:, :, :, 0]
-    reshaped['G'] = rgb_volume[:, :, :, 1]
-    reshaped['B'] = rgb_volume[:, :, :, 2]
-    
-    # Δημιουργία του τελικού NIfTI object
-    rgb_nii = nib.Nifti1Image(reshaped, nii_orig.affine, header=nii_orig.header)
-    
-    # Ρύθμιση του header για το RGB NIfTI
-    rgb_nii.header['datatype'] = 128  # RGB24
-    rgb_nii.header['bitpix'] = 24     # 24-bit RGB
-    
-    # Αποθήκευση
-    nib.save(rgb_nii, out_path)
-    print(f"    Saved RGB NIfTI colormap: {out_path}")
+    # Δεύτερο πέρασμα: κάθε RGB slab γράφεται αμέσως (τα δεδομένα NIfTI είναι σε σειρά Fortran,
+    # άρα κάθε slab είναι συνεχές κομμάτι του αρχείου) - ο πλήρης RGB όγκος δεν υπάρχει ποτέ στη μνήμη
+    # Αποθήκευση σε BGZF μορφή (παράλληλη συμπίεση, ανάγνωση μεμονωμένων τομών)
+    writer = BlockedGzipWriter(out_path) if out_path.endswith('.gz') else open(out_path, 'wb')
+    with writer:
+        # Header για το RGB NIfTI (datatype 128 = RGB24, bitpix 24)
+        writer.write(rgb_nifti_header_bytes(nii_orig, class_arr.shape))
+        for z0, z1, slab in iter_slabs():
+            # Κανονικοποιούμε το υποκείμενο MRI ώστε να έχουμε grayscale background
+            # (μετατροπή σε 0-255 για απόχρωση του γκρι)
+            normalized_mri = ((slab - mri_min) / (mri_max - mri_min + 1e-10) * 255).astype(np.uint8)
+            
+            # Ορίζουμε το grayscale background (ίδια τιμή σε R,G,B κανάλια)
+            rgb_slab = np.repeat(normalized_mri[..., np.newaxis], 3, axis=-1)
+            
+            # Εφαρμόζουμε το κάθε χρώμα στα voxel της αντίστοιχης κλάσης
+            class_slab = np.asarray(class_arr[:, :, z0:z1])
+            for class_value, color_rgb in colors.items():
+                rgb_slab[class_slab == class_value] = color_rgb
+            
+            # Μετατρέπουμε το slab σε μορφή συμβατή με RGB NIfTI
+            reshaped = np.zeros(class_slab.shape, dtype=RGB_DTYPE)
+            reshaped['R'], reshaped['G'], reshaped['B'] = rgb_slab[..., 0], rgb_slab[..., 1], rgb_slab[..., 2]
+            writer.write(reshaped.tobytes(order='F'))
+    logger.debug("Saved RGB NIfTI colormap: %s", out_path)
 
-def batch_convert_colormaps(base_dir):
+def batch_convert_colormaps(base_dir, cache_dir=None):
     """
     Μετατροπή όλων των υφιστάμενων colormap.nii.gz σε RGB εκδόσεις
     
     Args:
         base_dir: Βασικός φάκελος του project
+        cache_dir: Προαιρετικός φάκελος cache με αποσυμπιεσμένους όγκους (volume_cache.VolumeCache)
     """
+    cache = VolumeCache(cache_dir) if cache_dir else None
     converted_count = 0
     datasets = ['DUKE', 'ISPY1', 'ISPY2', 'NACT']
     
@@ -75,7 +107,7 @@ def batch_convert_colormaps(base_dir):
         if not os.path.isdir(dataset_dir):
             continue
             
-        print(f"Processing {dataset} dataset...")
+        logger.info("Processing %s dataset...", dataset)
         
         # Βρίσκουμε όλους τους φακέλους περιπτώσεων
         case_dirs = [d for d in os.listdir(dataset_dir) 
@@ -96,19 +128,24 @@ def batch_convert_colormaps(base_dir):
             if tp0_file and colormap_file:
                 try:
                     # Φόρτωση του χάρτη κατηγοριών
-                    class_arr = nib.load(colormap_file).get_fdata()
+                    class_arr = load_nifti(colormap_file, cache).get_fdata()
+                    
+                    # Η εικόνα αναφοράς διαβάζεται δύο φορές, οπότε προτιμάμε το αποσυμπιεσμένο αντίγραφο
+                    ref_path = cache.cached_path(tp0_file) if cache is not None else tp0_file
                     
                     # Παράγουμε το RGB NIfTI
                     rgb_out_path = colormap_file  # Αντικαθιστούμε το παλιό colormap
-                    convert_to_rgb_nifti(tp0_file, class_arr, rgb_out_path)
+                    convert_to_rgb_nifti(ref_path, class_arr, rgb_out_path)
                     
                     converted_count += 1
-                    print(f"  ✓ Converted {case_id}")
+                    logger.info("Converted %s", case_id)
                 except Exception as e:
-                    print(f"  ✗ Error converting {case_id}: {e}")
+                    logger.error("Error converting %s: %s", case_id, e)
     
-    print(f"Completed! Converted {converted_count} colormap files to RGB format.")
+    logger.info("Completed! Converted %d colormap files to RGB format.", converted_count)
 
 if __name__ == "__main__":
+    from pipeline_logging import configure_logging
+    configure_logging('INFO')
     base_dir = r"c:\Users\nickk\BiomedicalSignals"
     batch_convert_colormaps(base_dir)
@@ -0,0 +1,126 @@
+import os
+import json
+import logging
+import struct
+import zlib
+import numpy as np
+import nibabel as nib
+
+PYRAMID_MAGIC = b'DCEPYR01'
+PYRAMID_PREAMBLE = struct.Struct('<8sI')
+
+# Class overlay colours (1: Uptake, 2: Plateau, 3: Washout), as in the colormap PNGs
+CLASS_COLORS = [[0, 0, 0], [0, 0, 255], [0, 255, 0], [255, 0, 0]]
+
+logger = logging.getLogger(__name__)
+
+def downsample_planes(grey, classes):
+    """Halve both in-plane axes: 2x2 mean for grey levels, top-left sample for classes"""
+    rows, cols = (grey.shape[0] // 2) * 2, (grey.shape[1] // 2) * 2
+    if rows == 0 or cols == 0:
+        return grey, classes
+    blocks = grey[:rows, :cols].astype(np.uint16).reshape(rows // 2, 2, cols // 2, 2)
+    return (blocks.sum(axis=(1, 3)) // 4).astype(np.uint8), classes[:rows:2, :cols:2]
+
+def display_plane(plane):
+    # Rows top to bottom as shown by the viewers (slice.T with origin='lower')
+    return np.ascontiguousarray(np.flipud(plane.T))
+
+def build_slice_pyramid(out_path, tp0_file, colormap, volume=None, min_size=128, slab_depth=16, level=6):
+    """
+    Write the per-case slice pyramid used by the web viewer
+
+    For every axial slice and resolution level (in-plane size halved per level
+    down to min_size) one chunk holds the uint8 grey plane followed by the uint8
+    class plane, in display orientation, zlib-compressed. The file starts with
+    a magic/length preamble and a JSON header whose index gives the byte offset
+    and length of every chunk, so a client can fetch single slices with HTTP
+    range requests.
+
+    Args:
+        out_path: Output path (<case>_slice_pyramid.bin)
+        tp0_file: Pre-contrast volume used as grey background
+        colormap: Class array (0: background, 1: Uptake, 2: Plateau, 3: Washout)
+        volume: tp0 data if already in memory; otherwise read in z-slabs
+    """
+    n_slices = colormap.shape[2]
+    proxy = None if volume is not None else nib.load(tp0_file, keep_file_open=True).dataobj
+
+    def iter_slabs():
+        for z0 in range(0, n_slices, slab_depth):
+            z1 = min(z0 + slab_depth, n_slices)
+            slab = volume[:, :, z0:z1] if volume is not None else proxy[:, :, z0:z1]
+            yield z0, np.asarray(slab, dtype=np.float64)
+
+    # Same min-max window as the RGB colormap background
+    vmin, vmax = np.inf, -np.inf
+    for _, slab in iter_slabs():
+        vmin, vmax = min(vmin, slab.min()), max(vmax, slab.max())
+
+    level_shapes = [colormap.shape[:2]]
+    while min(level_shapes[-1]) // 2 >= min_size:
+        level_shapes.append((level_shapes[-1][0] // 2, level_shapes[-1][1] // 2))
+
+    chunks = [[None] * n_slices for _ in level_shapes]
+    for z0, slab in iter_slabs():
+        grey_slab = ((slab - vmin) / (vmax - vmin + 1e-10) * 255).astype(np.uint8)
+        for dz in range(slab.shape[2]):
+            grey, classes = grey_slab[:, :, dz], np.asarray(colormap[:, :, z0 + dz], dtype=np.uint8)
+            for lvl in range(len(level_shapes)):
+                if lvl > 0:
+                    grey, classes = downsample_planes(grey, classes)
+                planes = np.concatenate([display_plane(grey).ravel(), display_plane(classes).ravel()])
+                chunks[lvl][z0 + dz] = zlib.compress(planes.tobytes(), level)
+
+    # Chunk offsets are relative to the end of the header
+    index, offset = [], 0
+    for level_chunks in chunks:
+        level_index = []
+        for chunk in level_chunks:
+            level_index.append([offset, len(chunk)])
+            offset += len(chunk)
+        index.append(level_index)
+
+    header = {
+        'version': 1,
+        'n_slices': n_slices,
+        'levels': [{'width': int(shape[0]), 'height': int(shape[1]), 'chunks': level_index}
+                   for shape, level_index in zip(level_shapes, index)],
+        'intensity_range': [float(vmin), float(vmax)],
+        'class_colors': CLASS_COLORS,
+        'roi_slices': np.flatnonzero(np.any(colormap > 0, axis=(0, 1))).tolist()
+    }
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PYRAMID_PREAMBLE.pack(PYRAMID_MAGIC, len(header_bytes)))
+        f.write(header_bytes)
+        for level_chunks in chunks:
+            for chunk in level_chunks:
+                f.write(chunk)
+    os.replace(tmp_path, out_path)
+    logger.debug("Saved slice pyramid: %s (%d levels)", out_path, len(level_shapes))
+
+class SlicePyramid:
+    """Reader for files written by build_slice_pyramid"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, header_length = PYRAMID_PREAMBLE.unpack(f.read(PYRAMID_PREAMBLE.size))
+            if magic != PYRAMID_MAGIC:
+                raise ValueError(f"{path} is not a slice pyramid")
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        self.data_offset = PYRAMID_PREAMBLE.size + header_length
+
+    def read_slice(self, level, z):
+        """(grey, classes) uint8 planes of slice z at a level, in display orientation"""
+        info = self.header['levels'][level]
+        offset, length = info['chunks'][z]
+        with open(self.path, 'rb') as f:
+            f.seek(self.data_offset + offset)
+            planes = np.frombuffer(zlib.decompress(f.read(length)), dtype=np.uint8)
+        shape = (info['height'], info['width'])
+        plane_size = shape[0] * shape[1]
+        return planes[:plane_size].reshape(shape), planes[plane_size:].reshape(shape)
@@ -130,7 +130,238 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Scroll through axial slices of the case with the kinetic overlay.
+    // Uses the precomputed slice pyramid (byte-range requests, decoded in the browser)
+    // and falls back to server-rendered PNG slices for cases without one.
+    function initializeSliceViewer() {
+        const viewer = document.getElementById('slice-viewer');
+        if (!viewer) {
+            return;
+        }
+        const caseId = viewer.dataset.caseId;
+        const slider = document.getElementById('slice-slider');
+        const label = document.getElementById('slice-label');
+        const overlay = document.getElementById('slice-overlay');
+        
+        function showViewer(nSlices, defaultSlice, roiSlices, onSlice) {
+            slider.max = nSlices - 1;
+            slider.value = defaultSlice;
+            viewer.classList.remove('d-none');
+            const update = () => {
+                const z = Number(slider.value);
+                label.textContent = `Slice ${z + 1} / ${nSlices}` + (roiSlices.includes(z) ? ' (tumour)' : '');
+                onSlice(z);
+            };
+            slider.addEventListener('input', update);
+            overlay.addEventListener('change', update);
+            update();
+        }
+        
+        initializePyramidViewer(caseId, showViewer).catch(() => initializePngViewer(caseId, showViewer));
+    }
+    
+    // Server-rendered PNG slices, requested one at a time while dragging the slider
+    function initializePngViewer(caseId, showViewer) {
+        const image = document.getElementById('slice-image');
+        const overlay = document.getElementById('slice-overlay');
+        let pending = null;
+        let loading = false;
+        
+        function requestSlice(z) {
+            pending = z;
+            if (loading) {
+                return;
+            }
+            loading = true;
+            image.src = `/api/case/${caseId}/slice/${pending}?overlay=${overlay.checked ? 1 : 0}`;
+            pending = null;
+        }
+        
+        function onSliceLoaded() {
+            loading = false;
+            if (pending !== null) {
+                requestSlice(pending);
+            }
+        }
+        image.addEventListener('load', onSliceLoaded);
+        image.addEventListener('error', onSliceLoaded);
+        
+        fetch(`/api/case/${caseId}/slices`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    return;
+                }
+                image.classList.remove('d-none');
+                showViewer(data.n_slices, data.default_slice, data.roi_slices, requestSlice);
+            })
+            .catch(error => console.error('Error:', error));
+    }
+    
+    // Fetch bytes [start, end] of a URL with an HTTP range request
+    async function fetchRange(url, start, end) {
+        const response = await fetch(url, { headers: { Range: `bytes=${start}-${end}` } });
+        if (!response.ok) {
+            throw new Error(`Range request failed: ${response.status}`);
+        }
+        const bytes = new Uint8Array(await response.arrayBuffer());
+        // A server without range support sends the whole file
+        return response.status === 206 ? bytes : bytes.slice(start, end + 1);
+    }
+    
+    // Inflate a zlib-compressed chunk with the browser's native decompressor
+    async function inflate(bytes) {
+        const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+    
+    // Canvas viewer over <case>_slice_pyramid.bin (see slice_pyramid.py for the layout)
+    async function initializePyramidViewer(caseId, showViewer) {
+        if (typeof DecompressionStream === 'undefined') {
+            throw new Error('DecompressionStream not supported');
+        }
+        const url = `/api/case/${caseId}/pyramid`;
+        const canvas = document.getElementById('slice-canvas');
+        const overlay = document.getElementById('slice-overlay');
+        const context = canvas.getContext('2d');
+        
+        // Preamble: 8-byte magic + uint32 header length, then the JSON header
+        const preamble = await fetchRange(url, 0, 11);
+        if (new TextDecoder().decode(preamble.slice(0, 8)) !== 'DCEPYR01') {
+            throw new Error('Not a slice pyramid');
+        }
+        const headerLength = new DataView(preamble.buffer).getUint32(8, true);
+        const headerBytes = await fetchRange(url, 12, 12 + headerLength - 1);
+        const header = JSON.parse(new TextDecoder().decode(headerBytes));
+        const dataOffset = 12 + headerLength;
+        const base = header.levels[0];
+        const colors = header.class_colors;
+        
+        const chunkCache = new Map();
+        const maxCachedChunks = 256;
+        let zoom = 1;
+        let panX = 0;
+        let panY = 0;
+        let currentSlice = 0;
+        let renderToken = 0;
+        
+        // Decoded planes of one slice at one level, kept in a small LRU
+        function loadChunk(level, z) {
+            const key = `${level}/${z}`;
+            if (!chunkCache.has(key)) {
+                const [offset, length] = header.levels[level].chunks[z];
+                const start = dataOffset + offset;
+                const request = fetchRange(url, start, start + length - 1).then(inflate);
+                request.catch(() => chunkCache.delete(key));
+                chunkCache.set(key, request);
+                if (chunkCache.size > maxCachedChunks) {
+                    chunkCache.delete(chunkCache.keys().next().value);
+                }
+            }
+            const chunk = chunkCache.get(key);
+            chunkCache.delete(key);
+            chunkCache.set(key, chunk);
+            return chunk;
+        }
+        
+        // Coarsest level that still has at least one voxel per screen pixel
+        function pickLevel() {
+            const screenPixelsPerVoxel = canvas.clientWidth * zoom / base.width;
+            let level = 0;
+            while (level + 1 < header.levels.length && screenPixelsPerVoxel * 2 ** (level + 1) <= 1) {
+                level += 1;
+            }
+            return level;
+        }
+        
+        async function render() {
+            const token = ++renderToken;
+            const level = pickLevel();
+            const info = header.levels[level];
+            const planes = await loadChunk(level, currentSlice);
+            if (token !== renderToken) {
+                return;
+            }
+            
+            const size = info.width * info.height;
+            const image = context.createImageData(info.width, info.height);
+            for (let i = 0; i < size; i++) {
+                const grey = planes[i];
+                const label = overlay.checked ? planes[size + i] : 0;
+                const color = colors[label];
+                const alpha = label > 0 ? 0.7 : 0;
+                image.data[4 * i] = (1 - alpha) * grey + alpha * color[0];
+                image.data[4 * i + 1] = (1 - alpha) * grey + alpha * color[1];
+                image.data[4 * i + 2] = (1 - alpha) * grey + alpha * color[2];
+                image.data[4 * i + 3] = 255;
+            }
+            const bitmap = await createImageBitmap(image);
+            if (token !== renderToken) {
+                return;
+            }
+            
+            context.setTransform(1, 0, 0, 1, 0, 0);
+            context.fillStyle = '#000';
+            context.fillRect(0, 0, canvas.width, canvas.height);
+            context.imageSmoothingEnabled = zoom < 2;
+            context.setTransform(zoom, 0, 0, zoom, panX, panY);
+            context.drawImage(bitmap, 0, 0, base.width, base.height);
+            
+            // Prefetch the neighbouring slices for smooth scrolling
+            [currentSlice - 1, currentSlice + 1]
+                .filter(z => z >= 0 && z < header.n_slices)
+                .forEach(z => loadChunk(level, z));
+        }
+        
+        canvas.width = base.width;
+        canvas.height = base.height;
+        canvas.classList.remove('d-none');
+        
+        // Wheel zooms around the cursor, drag pans, double-click resets
+        canvas.addEventListener('wheel', event => {
+            event.preventDefault();
+            const rect = canvas.getBoundingClientRect();
+            const x = (event.clientX - rect.left) * canvas.width / rect.width;
+            const y = (event.clientY - rect.top) * canvas.height / rect.height;
+            const factor = event.deltaY < 0 ? 1.25 : 0.8;
+            const newZoom = Math.min(16, Math.max(1, zoom * factor));
+            panX = x - (x - panX) * newZoom / zoom;
+            panY = y - (y - panY) * newZoom / zoom;
+            zoom = newZoom;
+            render();
+        }, { passive: false });
+        
+        let dragStart = null;
+        canvas.addEventListener('mousedown', event => {
+            dragStart = { x: event.clientX, y: event.clientY, panX: panX, panY: panY };
+        });
+        window.addEventListener('mouseup', () => { dragStart = null; });
+        canvas.addEventListener('mousemove', event => {
+            if (!dragStart) {
+                return;
+            }
+            const scale = canvas.width / canvas.getBoundingClientRect().width;
+            panX = dragStart.panX + (event.clientX - dragStart.x) * scale;
+            panY = dragStart.panY + (event.clientY - dragStart.y) * scale;
+            render();
+        });
+        canvas.addEventListener('dblclick', () => {
+            zoom = 1;
+            panX = 0;
+            panY = 0;
+            render();
+        });
+        
+        const roiSlices = header.roi_slices;
+        const defaultSlice = roiSlices.length ? roiSlices[Math.floor(roiSlices.length / 2)] : Math.floor(header.n_slices / 2);
+        showViewer(header.n_slices, defaultSlice, roiSlices, z => {
+            currentSlice = z;
+            render();
+        });
+    }
+    
     // Call initialization functions
     initializeCharts();
     highlightCurrentCase();
+    initializeSliceViewer();
 });
@@ -0,0 +1,149 @@
+import queue
+import logging
+import threading
+from pipeline_logging import case_context
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+class StreamingExecutor:
+    """
+    Overlaps case I/O and compute for CompleteDCEMRIPipeline
+
+    Reader threads run pipeline.load_case (gzip decoding of every phase, the
+    segmentation and the SimpleITK radiomics inputs) for the next cases and put
+    them on a bounded queue. Compute threads take loaded cases from the queue
+    and run pipeline.compute_case. A writer pool saves the NIfTI/PNG/pyramid
+    outputs with pipeline.write_case.
+
+    Memory stays bounded by back-pressure. Readers block while the queue is
+    full, and compute blocks while every writer slot is busy. At most
+    prefetch + readers + compute_workers + 2 * writers cases are in memory at
+    once. Results are returned in input order, so features match a serial run.
+
+    Args:
+        pipeline: CompleteDCEMRIPipeline
+        prefetch: Loaded cases allowed to wait for compute
+        readers: Reader threads
+        compute_workers: Compute threads (kinetics and radiomics are mostly CPU-bound, so 1 is usually enough)
+        writers: Writer threads
+    """
+
+    def __init__(self, pipeline, prefetch=2, readers=2, compute_workers=1, writers=2):
+        self.pipeline = pipeline
+        self.prefetch = prefetch
+        self.readers = readers
+        self.compute_workers = compute_workers
+        self.writers = writers
+
+    def run(self, cases, on_result=None):
+        """
+        Process cases and return [(case_id, features or None, metrics record)] in input order
+
+        Args:
+            cases: (dataset, case_id, case_path, segment_dir) tuples
+            on_result: Called as on_result(case_id, features, record) when a case finishes
+                       (serialized, in completion order)
+        """
+        metrics = self.pipeline.metrics
+        profiled = sorted(metrics.profile_cases & {case[1] for case in cases})
+        if profiled:
+            # cProfile follows one thread, while a streamed case moves between reader, compute and writer threads
+            logger.warning("Not profiling %s: profiling needs the serial path or worker processes (no --prefetch)",
+                           ', '.join(profiled))
+        results = [None] * len(cases)
+        result_lock = threading.Lock()
+        loaded = queue.Queue(maxsize=max(self.prefetch, 1))
+        write_slots = threading.BoundedSemaphore(2 * self.writers)
+        write_queue = queue.Queue()
+        next_case = iter(enumerate(cases))
+        next_lock = threading.Lock()
+
+        def finish(index, features, record):
+            # A case ends once, in the thread that completed (or abandoned) it
+            metrics.end_case(record)
+            with result_lock:
+                results[index] = (record['case_id'], features, record)
+                if on_result is not None:
+                    on_result(record['case_id'], features, record)
+
+        def read():
+            while True:
+                with next_lock:
+                    index, case = next(next_case, (None, None))
+                if case is None:
+                    break
+                dataset, case_id, case_path, segment_dir = case
+                record = metrics.start_case(case_id, dataset)
+                inputs = None
+                with case_context(case_id):
+                    try:
+                        with metrics.resume(record):
+                            inputs = self.pipeline.load_case(case_id, case_path, segment_dir, prefetch_images=True)
+                    except Exception as e:
+                        logger.error("Error loading case: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+                if inputs is None:
+                    finish(index, None, record)
+                    continue
+                loaded.put((index, record, inputs))
+
+        def compute():
+            while True:
+                item = loaded.get()
+                if item is _DONE:
+                    break
+                index, record, inputs = item
+                with case_context(record['case_id']):
+                    try:
+                        with metrics.resume(record):
+                            features, colormap = self.pipeline.compute_case(inputs)
+                    except Exception as e:
+                        logger.error("Error processing case: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+                        self.pipeline.release_case(inputs)
+                        finish(index, None, record)
+                        continue
+                write_slots.acquire()
+                write_queue.put((index, record, inputs, features, colormap))
+
+        def write():
+            while True:
+                item = write_queue.get()
+                if item is _DONE:
+                    break
+                index, record, inputs, features, colormap = item
+                try:
+                    with case_context(record['case_id']):
+                        try:
+                            with metrics.resume(record):
+                                self.pipeline.write_case(inputs, colormap)
+                        except Exception as e:
+                            logger.error("Error writing case outputs: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+                            features = None
+                    self.pipeline.release_case(inputs)
+                    del inputs, colormap
+                    finish(index, features, record)
+                finally:
+                    write_slots.release()
+
+        def start(target, count, name):
+            threads = [threading.Thread(target=target, name=f"{name}-{i}", daemon=True) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            return threads
+
+        reader_threads = start(read, self.readers, 'case-reader')
+        compute_threads = start(compute, self.compute_workers, 'case-compute')
+        writer_threads = start(write, self.writers, 'case-writer')
+
+        for thread in reader_threads:
+            thread.join()
+        for _ in compute_threads:
+            loaded.put(_DONE)
+        for thread in compute_threads:
+            thread.join()
+        for _ in writer_threads:
+            write_queue.put(_DONE)
+        for thread in writer_threads:
+            thread.join()
+        return results
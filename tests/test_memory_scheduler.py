@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import multiprocessing
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memory_scheduler
+from memory_scheduler import MemoryScheduler
+from pipeline_metrics import PipelineMetrics
+
+class StubPipeline:
+    config = {}
+    memory_budget_mb = None
+
+    def __init__(self):
+        self.metrics = PipelineMetrics()
+
+def _init_worker(pipeline_config, log_queue, log_level, metrics_config=None):
+    pass
+
+def _run_case(case):
+    if case[1] == 'A_1':
+        os._exit(9)  # as if killed for memory
+    time.sleep(0.5)  # still running when A_1's worker dies
+    return {'case_id': case[1]}, {'record': 'case', 'case_id': case[1], 'status': 'ok', 'stages': {}}
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_killed_worker_fails_only_its_case(monkeypatch):
+    # Forked workers inherit the patched module
+    monkeypatch.setattr(memory_scheduler, '_init_worker', _init_worker)
+    monkeypatch.setattr(memory_scheduler, '_run_case', _run_case)
+    cases = [('A', f"A_{index}", f"/missing/A_{index}", '/missing/segment') for index in range(6)]
+
+    scheduler = MemoryScheduler(StubPipeline(), ram_budget_mb=4096, workers=2,
+                                mp_context=multiprocessing.get_context('fork'))
+    results = scheduler.run(cases)
+
+    assert [case_id for case_id, _, _ in results] == [f"A_{index}" for index in range(6)]
+    for case_id, features, record in results:
+        if case_id == 'A_1':
+            assert features is None and record['status'] == 'failed'
+            assert record['errors'][0]['type'] == 'BrokenProcessPool'
+        else:
+            assert features == {'case_id': case_id} and record['status'] == 'ok'
+
+def test_workers_fit_the_budget(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 16)
+    scheduler = MemoryScheduler(StubPipeline(), ram_budget_mb=6000)
+    assert scheduler.fit_workers([200 * 1024 ** 2, 900 * 1024 ** 2]) == 9
+    assert scheduler.fit_workers([]) == 13
+    assert MemoryScheduler(StubPipeline(), ram_budget_mb=300).fit_workers([100 * 1024 ** 2]) == 1
+    with pytest.raises(ValueError):
+        MemoryScheduler(StubPipeline(), ram_budget_mb=6000, workers=16)
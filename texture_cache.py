@@ -0,0 +1,129 @@
+"""
+Shared discretization and texture-matrix cache for pyradiomics feature classes
+
+Every pyradiomics texture class bins the ROI image itself (_applyBinning) and
+then builds its matrix (_calculateMatrix). This cache hooks both methods on
+subclasses of the feature classes:
+    - binned images are keyed by (image, mask, binWidth/binCount), so the
+      classes of one image share a single discretization;
+    - matrices are keyed by (class, image, mask, binning, the settings that
+      class's matrix depends on), so a sweep over distances reuses the GLRLM
+      and GLSZM, and a repeated parameter set reuses everything.
+A hit replays the coefficients and attributes the original call set, and
+returns a copy of its result, so features are identical to uncached
+extraction. If a pyradiomics version lacks these hooks, the classes simply
+run uncached.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+BINNING_SETTINGS = ('binWidth', 'binCount')
+
+# Settings (besides binning) each texture matrix depends on
+MATRIX_SETTINGS = {
+    'glcm': ('distances', 'symmetricalGLCM', 'weightingNorm', 'force2D', 'force2Ddimension'),
+    'glrlm': ('weightingNorm', 'force2D', 'force2Ddimension'),
+    'glszm': ('force2D', 'force2Ddimension'),
+    'gldm': ('distances', 'gldm_a', 'force2D', 'force2Ddimension'),
+    'ngtdm': ('distances', 'force2D', 'force2Ddimension')
+}
+
+def array_digest(array):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((array.shape, array.dtype.str)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def _settings_key(settings, names):
+    return tuple((name, repr(settings.get(name))) for name in names)
+
+def _copy(value):
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+class TextureCache:
+    """
+    Thread-safe LRU cache of binned images and texture matrices
+
+    Args:
+        max_entries: Entries kept (binned images and matrices together)
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._classes = {}
+        self.counts = {'binning_hits': 0, 'binning_misses': 0, 'matrix_hits': 0, 'matrix_misses': 0}
+
+    def feature_class(self, class_name):
+        """pyradiomics feature class with its binning and matrix computation cached here"""
+        with self._lock:
+            if class_name not in self._classes:
+                from radiomics import getFeatureClasses
+                base = getFeatureClasses()[class_name]
+                self._classes[class_name] = type(f"Cached{base.__name__}", (_CachedFeatureClass, base),
+                                                 {'_texture_cache': self, '_cache_class_name': class_name})
+            return self._classes[class_name]
+
+    def lookup(self, key, kind):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self.counts[f"{kind}_{'hits' if entry is not None else 'misses'}"] += 1
+            return entry
+
+    def store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), **self.counts}
+
+class _CachedFeatureClass:
+    """Mixin placed before a pyradiomics feature class; see the module docstring"""
+    _texture_cache = None
+    _cache_class_name = None
+
+    def _cached_call(self, key, kind, compute):
+        entry = self._texture_cache.lookup(key, kind)
+        if entry is None:
+            attributes = dict(vars(self))
+            coefficients = dict(getattr(self, 'coefficients', {}))
+            result = compute()
+            changed_attributes = {name: value for name, value in vars(self).items()
+                                  if name != 'coefficients' and attributes.get(name, object()) is not value}
+            changed_coefficients = {name: value for name, value in getattr(self, 'coefficients', {}).items()
+                                    if coefficients.get(name, object()) is not value}
+            entry = (result, changed_attributes, changed_coefficients)
+            self._texture_cache.store(key, entry)
+        result, changed_attributes, changed_coefficients = entry
+        for name, value in changed_attributes.items():
+            setattr(self, name, _copy(value))
+        if changed_coefficients:
+            self.coefficients.update({name: _copy(value) for name, value in changed_coefficients.items()})
+        return _copy(result)
+
+    def _applyBinning(self, matrix, *args, **kwargs):
+        if args or kwargs or not isinstance(matrix, np.ndarray):
+            return super()._applyBinning(matrix, *args, **kwargs)
+        # Keys of the unbinned image; the matrix key below reuses them
+        self._cache_image_key = (array_digest(matrix), array_digest(self.maskArray))
+        self._cache_binning_key = _settings_key(self.settings, BINNING_SETTINGS)
+        key = ('binning',) + self._cache_image_key + self._cache_binning_key
+        return self._cached_call(key, 'binning', lambda: super(_CachedFeatureClass, self)._applyBinning(matrix))
+
+    def _calculateMatrix(self, voxelCoordinates=None, *args, **kwargs):
+        image_key = getattr(self, '_cache_image_key', None)
+        matrix_settings = MATRIX_SETTINGS.get(self._cache_class_name)
+        if voxelCoordinates is not None or args or kwargs or image_key is None or matrix_settings is None:
+            return super()._calculateMatrix(voxelCoordinates, *args, **kwargs)
+        key = (('matrix', self._cache_class_name) + image_key + self._cache_binning_key
+               + _settings_key(self.settings, matrix_settings))
+        return self._cached_call(key, 'matrix', lambda: super(_CachedFeatureClass, self)._calculateMatrix())
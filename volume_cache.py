@@ -0,0 +1,230 @@
+import os
+import gzip
+import time
+import shutil
+import hashlib
+import uuid
+import nibabel as nib
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+class VolumeCache:
+    """
+    Disk cache of decompressed NIfTI volumes
+
+    Each .nii.gz is unpacked once into an uncompressed .nii named after the SHA-1
+    of the compressed file, so it can be memory-mapped by nibabel (or read
+    directly by SimpleITK) in every later stage and process. Entries are written
+    to a temporary file and renamed into place, and a lock file keeps concurrent
+    workers from unpacking the same volume twice. The least recently used
+    entries are removed once the cache grows past max_bytes.
+
+    A reader that uses the copy for longer (e.g. a whole case) pins it: a pin
+    file next to the entry keeps evict() from removing it until unpin(). Pins
+    are created and entries removed under the entry's lock file, so an entry
+    is never removed between a reader pinning it and using it. Pins older than
+    pin_timeout (left by a crashed worker) are ignored and removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 * 1024 ** 3, lock_timeout=600, pin_timeout=6 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.pin_timeout = pin_timeout
+        self._keys = {}
+        os.makedirs(os.path.join(cache_dir, 'keys'), exist_ok=True)
+
+    def source_key(self, path):
+        """
+        SHA-1 of the source file contents
+
+        Hashes are remembered per (path, size, mtime), in memory and under
+        cache_dir/keys, so an unchanged file is only hashed once.
+        """
+        st = os.stat(path)
+        stat_id = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+        if stat_id in self._keys:
+            return self._keys[stat_id]
+
+        key_file = os.path.join(self.cache_dir, 'keys', hashlib.sha1(stat_id.encode()).hexdigest())
+        try:
+            with open(key_file) as f:
+                key = f.read().strip()
+        except OSError:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                    digest.update(block)
+            key = digest.hexdigest()
+            self._write_atomic(key_file, key.encode())
+
+        self._keys[stat_id] = key
+        return key
+
+    def cached_path(self, path):
+        """
+        Path of the uncompressed copy of path, unpacking it on first use
+
+        Uncompressed inputs are returned unchanged. If another worker holds the
+        lock for longer than lock_timeout the source path is returned instead.
+        """
+        return self._resolve(path, None)
+
+    def pin(self, path):
+        """
+        cached_path(path), protected from eviction until unpin(pin)
+
+        Returns:
+            (path to read, pin); pin is None when the source path is returned
+        """
+        if not path.endswith('.gz'):
+            return path, None
+        target = os.path.join(self.cache_dir, f"{self.source_key(path)}.nii")
+        pin_file = f"{target}.{os.getpid()}-{uuid.uuid4().hex}.pin"
+        open(pin_file, 'wb').close()
+        resolved = self._resolve(path, pin_file)
+        if resolved != target:
+            self.unpin(pin_file)
+            return resolved, None
+        return resolved, pin_file
+
+    def unpin(self, pin):
+        if pin is not None:
+            self._remove(pin)
+
+    def _resolve(self, path, pin_file):
+        if not path.endswith('.gz'):
+            return path
+
+        key = self.source_key(path)
+        target = os.path.join(self.cache_dir, f"{key}.nii")
+        lock_file = target + '.lock'
+        deadline = time.time() + self.lock_timeout
+
+        while True:
+            # Pinned readers check the entry under the lock, so evict() sees their pin or they see the removal
+            if pin_file is None and os.path.exists(target):
+                self._touch(target)
+                return target
+            try:
+                lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # Another worker is unpacking or evicting this volume
+                if self._is_stale(lock_file):
+                    self._remove(lock_file)
+                elif time.time() > deadline:
+                    return path
+                else:
+                    time.sleep(0.1)
+                continue
+
+            unpacked = False
+            try:
+                os.close(lock_fd)
+                if os.path.exists(target):
+                    self._touch(target)
+                else:
+                    tmp_path = f"{target}.{os.getpid()}.tmp"
+                    with gzip.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, HASH_CHUNK_BYTES)
+                    os.replace(tmp_path, target)
+                    unpacked = True
+            finally:
+                self._remove(lock_file)
+            if unpacked:
+                self.evict(keep=target)
+            return target
+
+    def load(self, path):
+        """nibabel image of path, memory-mapped from the cache"""
+        return nib.load(self.cached_path(path), mmap=True)
+
+    def evict(self, keep=None):
+        """Remove least recently used unpinned entries until the cache fits in max_bytes"""
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.nii') and entry.path != keep:
+                try:
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+
+        removed = 0
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._remove_entry(entry_path):
+                total -= size
+                removed += 1
+        return removed
+
+    def _remove_entry(self, entry_path):
+        """Remove an entry unless it is pinned or its lock is held"""
+        lock_file = entry_path + '.lock'
+        try:
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        try:
+            if self._is_pinned(entry_path):
+                return False
+            # Files still mapped by a reader cannot be removed on Windows; skip them
+            return self._remove(entry_path)
+        finally:
+            self._remove(lock_file)
+
+    def _is_pinned(self, entry_path):
+        directory, name = os.path.split(entry_path)
+        pinned = False
+        for entry in os.scandir(directory):
+            if entry.name.startswith(name + '.') and entry.name.endswith('.pin'):
+                try:
+                    stale = time.time() - entry.stat().st_mtime > self.pin_timeout
+                except OSError:
+                    continue
+                if stale:
+                    self._remove(entry.path)
+                else:
+                    pinned = True
+        return pinned
+
+    def _is_stale(self, lock_file):
+        try:
+            return time.time() - os.path.getmtime(lock_file) > self.lock_timeout
+        except OSError:
+            return False
+
+    @staticmethod
+    def _touch(path):
+        # Modification time doubles as the LRU timestamp
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+def load_nifti(path, cache=None):
+    """nib.load(path), going through the decompressed cache when one is given"""
+    if cache is None:
+        return nib.load(path)
+    return cache.load(path)
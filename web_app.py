@@ -3,24 +3,68 @@ import json
 import numpy as np
 import pandas as pd
 import nibabel as nib
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+from PIL import Image
 import io
+import csv
 import base64
-from flask import Flask, render_template, request, jsonify
+import threading
+from collections import OrderedDict
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file
+from kinetic_curves import (divergence_index, case_curve_slopes, synthesize_kinetic_curves,
+                            plot_kinetic_curves)
+from volume_cache import VolumeCache
+from slice_pyramid import SlicePyramid
 
 app = Flask(__name__)
 
+# Feature tables written by complete_pipeline.py
+FEATURE_TABLES = {
+    'raw': 'complete_pipeline_raw_features.csv',
+    'normalized': 'complete_pipeline_normalized_features.csv',
+    'harmonized': 'complete_pipeline_harmonized_features.csv'
+}
+
+# Rows read per chunk when streaming feature exports
+EXPORT_CHUNK_ROWS = 256
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+# Decompressed volumes for the slice viewer (shared with explore_nifti.py)
+VOLUME_CACHE_DIR = os.path.join('cache', 'volumes')
+
+# Axial slices decoded together, number of decoded slabs and of opened cases kept in memory
+SLICE_SLAB_DEPTH = 8
+SLICE_CACHE_SLABS = 64
+SLICE_CACHE_CASES = 32
+
+# Overlay colours of the kinetic classes, as in the colormap PNGs (1: Uptake, 2: Plateau, 3: Washout)
+OVERLAY_COLORS = np.array([[0, 0, 0], [0, 0, 255], [0, 255, 0], [255, 0, 0]], dtype=np.float32)
+OVERLAY_ALPHA = 0.7
+
+volume_cache = None
+case_volumes = OrderedDict()
+slab_cache = OrderedDict()
+slice_cache_lock = threading.Lock()
+
+def pyplot():
+    """matplotlib.pyplot with the Agg backend, imported on the first chart request (saves ~1 s at startup)"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 # Load the datasets
 def load_data():
     data = {}
     try:
         # Load dataset features
-        raw_features = pd.read_csv('complete_pipeline_raw_features.csv')
-        harmonized_features = pd.read_csv('complete_pipeline_harmonized_features.csv')
-        normalized_features = pd.read_csv('complete_pipeline_normalized_features.csv')
+        raw_features = pd.read_csv(FEATURE_TABLES['raw'])
+        harmonized_features = pd.read_csv(FEATURE_TABLES['harmonized'])
+        normalized_features = pd.read_csv(FEATURE_TABLES['normalized'])
         
         # Add dataset field
         raw_features['dataset'] = raw_features['case_id'].str.split('_').str[0]
@@ -80,51 +124,22 @@ def generate_kinetic_curves(case_id, data):
     case_data = data['raw'][data['raw']['case_id'] == case_id].iloc[0]
     
     # Create figure with kinetic curves
+    plt = pyplot()
     fig, ax = plt.subplots(figsize=(8, 6))
     
     # Time points - more precise for smoother curves
     time_points = np.linspace(0.0, 3.0, 100)
     
-    # Initial curve parameters (based on the reference image)
-    initial_slope = 150
-    max_intensity = case_data['uptake_intensity'] * 1.0  # Scale to real data
-    
-    # Create base curve (common initial part up to divergence point)
+    # Curve parameters scaled to the real data
+    max_intensity = case_data['uptake_intensity'] * 1.0
     t_diverge = 1.2  # Divergence time point (matches reference)
-    idx_diverge = int(t_diverge * len(time_points) / 3.0)
-    
-    base_curve = np.zeros_like(time_points)
-    # First part - common for all curves
-    base_curve[:idx_diverge+1] = max_intensity * (1 - np.exp(-initial_slope * time_points[:idx_diverge+1]/max_intensity))
-    
-    # Create the three curve types, all sharing the same values up to divergence
-    uptake_curve = np.copy(base_curve)
-    plateau_curve = np.copy(base_curve)
-    washout_curve = np.copy(base_curve)
-    
-    # Value at divergence point - all curves meet here
-    diverge_value = base_curve[idx_diverge]
-    
-    # After divergence point - exactly match the sample image curves
-    # Slope calculations
-    uptake_slope = case_data['uptake_intensity'] * 0.07
-    plateau_slope = -case_data['uptake_intensity'] * 0.03
-    washout_slope = -case_data['uptake_intensity'] * 0.12 * case_data['washout_severity']
+    idx_diverge = divergence_index(time_points, t_diverge)
     
-    # Apply slopes after divergence
-    for i in range(idx_diverge+1, len(time_points)):
-        dt = time_points[i] - time_points[idx_diverge]
-        uptake_curve[i] = diverge_value + dt * uptake_slope
-        plateau_curve[i] = diverge_value + dt * plateau_slope
-        washout_curve[i] = diverge_value + dt * washout_slope
+    slopes = case_curve_slopes(case_data['uptake_intensity'], case_data['washout_severity'])
+    curves = synthesize_kinetic_curves(time_points, max_intensity, slopes, idx_diverge)[0]
     
     # Plot curves with consistent colors matching the reference image
-    ax.plot(time_points, uptake_curve, color='#3274A1', linewidth=2, label='Uptake')
-    ax.plot(time_points, plateau_curve, color='#3A923A', linewidth=2, label='Plateau')
-    ax.plot(time_points, washout_curve, color='#C03D3E', linewidth=2, label='Washout')
-    
-    # Add divergence point reference line
-    ax.axvline(x=t_diverge, color='gray', linestyle='--', alpha=0.7)
+    plot_kinetic_curves(ax, time_points, curves, t_diverge)
     
     ax.set_title(f"Kinetic Curves for {case_id}")
     ax.set_xlabel("Time point")
@@ -152,6 +167,7 @@ def generate_pie_chart(case_id, data):
     harmonized_case_data = data['harmonized'][data['harmonized']['case_id'] == case_id].iloc[0]
     
     # Create figure with two pie charts side by side
+    plt = pyplot()
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 6))
     
     # Data for raw pie chart
@@ -162,6 +178,8 @@ def generate_pie_chart(case_id, data):
     # Data for harmonized pie chart
     harm_labels = ['Uptake', 'Plateau', 'Washout']
     harm_sizes = [harmonized_case_data['uptake_percentage'], harmonized_case_data['plateau_percentage'], harmonized_case_data['washout_percentage']]
+    # ComBat can shift a small percentage slightly below zero, which a pie cannot show
+    harm_sizes = [max(val, 0) if np.isfinite(val) else 0 for val in harm_sizes]
     
     # Check if harmonized data is normalized (0-1 range)
     is_normalized = all(0 <= val <= 1 for val in harm_sizes)
@@ -185,8 +203,11 @@ def generate_pie_chart(case_id, data):
     ax1.set_title(f"Raw Signal Distribution")
     
     # Harmonized data pie chart
-    ax2.pie(harm_sizes, labels=harm_labels, colors=colors, autopct='%1.1f%%',
-           shadow=True, startangle=90)
+    if sum(harm_sizes) > 0:
+        ax2.pie(harm_sizes, labels=harm_labels, colors=colors, autopct='%1.1f%%',
+               shadow=True, startangle=90)
+    else:
+        ax2.text(0.5, 0.5, 'No harmonized values', ha='center', va='center')
     ax2.axis('equal')
     
     if is_normalized:
@@ -217,6 +238,98 @@ def generate_colormap_preview(case_id):
             return encoded_string
     return None
 
+# Slice source of a case: its slice pyramid, or for cases processed before pyramids
+# existed, the _0000 volume and RGB colormap (memory-mapped from the volume cache)
+def get_case_volumes(case_id):
+    global volume_cache
+    with slice_cache_lock:
+        if case_id in case_volumes:
+            case_volumes.move_to_end(case_id)
+            return case_volumes[case_id]
+        if volume_cache is None:
+            volume_cache = VolumeCache(VOLUME_CACHE_DIR)
+    
+    dataset = case_id.split('_')[0]
+    case_dir = os.path.join(dataset, case_id)
+    pyramid_path = os.path.join(case_dir, f"{case_id}_slice_pyramid.bin")
+    tp0_path = os.path.join(case_dir, f"{case_id}_0000.nii.gz")
+    colormap_path = os.path.join(case_dir, f"{case_id}_colormap.nii.gz")
+    if os.path.exists(pyramid_path):
+        # Window and ROI slices were computed by the pipeline; slices are read one chunk at a time
+        pyramid = SlicePyramid(pyramid_path)
+        volumes = {
+            'pyramid': pyramid,
+            'n_slices': pyramid.header['n_slices'],
+            'roi_slices': pyramid.header['roi_slices']
+        }
+    elif os.path.exists(tp0_path) and os.path.exists(colormap_path):
+        image = volume_cache.load(tp0_path)
+        colormap = volume_cache.load(colormap_path)
+        intensity = np.asanyarray(image.dataobj)
+        classes = colormap_classes(np.asanyarray(colormap.dataobj))
+        volumes = {
+            'image': image,
+            'colormap': colormap,
+            'n_slices': image.shape[2],
+            # Same min-max window as the RGB colormap background
+            'range': (float(intensity.min()), float(intensity.max())),
+            'roi_slices': np.flatnonzero(np.any(classes > 0, axis=(0, 1))).tolist()
+        }
+    else:
+        return None
+    with slice_cache_lock:
+        case_volumes[case_id] = volumes
+        while len(case_volumes) > SLICE_CACHE_CASES:
+            case_volumes.popitem(last=False)
+    return volumes
+
+# Recover kinetic classes from the RGB colormap (grey background voxels are 0)
+def colormap_classes(rgb):
+    if rgb.dtype.names is None:
+        # Older colormaps store the class labels directly
+        return np.where(np.isin(rgb, [1, 2, 3]), rgb, 0).astype(np.uint8)
+    red, green, blue = rgb['R'], rgb['G'], rgb['B']
+    # Grey voxels have R == G == B; labelled voxels are pure blue, green or red
+    labelled = (red != green) | (green != blue)
+    return np.where(labelled, (blue >> 7) + 2 * (green >> 7) + 3 * (red >> 7), 0).astype(np.uint8)
+
+# Decoded grey levels and classes of one slab, kept in an LRU cache
+def get_slice_slab(case_id, volumes, slab_index):
+    key = (case_id, slab_index)
+    with slice_cache_lock:
+        if key in slab_cache:
+            slab_cache.move_to_end(key)
+            return slab_cache[key]
+    
+    z0 = slab_index * SLICE_SLAB_DEPTH
+    z1 = min(z0 + SLICE_SLAB_DEPTH, volumes['n_slices'])
+    vmin, vmax = volumes['range']
+    intensity = np.asarray(volumes['image'].dataobj[:, :, z0:z1], dtype=np.float64)
+    grey = ((intensity - vmin) / (vmax - vmin + 1e-10) * 255).astype(np.uint8)
+    classes = colormap_classes(np.asanyarray(volumes['colormap'].dataobj[:, :, z0:z1]))
+    
+    with slice_cache_lock:
+        slab_cache[key] = (grey, classes)
+        while len(slab_cache) > SLICE_CACHE_SLABS:
+            slab_cache.popitem(last=False)
+    return grey, classes
+
+# Render one axial slice with the kinetic overlay as PNG bytes
+# (planes in volume orientation, or already in display orientation as stored in slice pyramids)
+def render_slice_png(grey, classes, overlay=True, display_orientation=False):
+    rgb = np.repeat(grey[..., np.newaxis].astype(np.float32), 3, axis=-1)
+    if overlay:
+        labelled = classes > 0
+        rgb[labelled] = (1 - OVERLAY_ALPHA) * rgb[labelled] + OVERLAY_ALPHA * OVERLAY_COLORS[classes[labelled]]
+    if not display_orientation:
+        # Transpose and flip so the slice is shown like the colormap PNGs (origin='lower')
+        rgb = np.flipud(np.transpose(rgb, (1, 0, 2)))
+    image = np.ascontiguousarray(rgb).astype(np.uint8)
+    buffer = io.BytesIO()
+    # Fast zlib level - encoding dominates the response time
+    Image.fromarray(image, mode='RGB').save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
 # Get case metrics
 def get_case_metrics(case_id, data):
     if case_id not in data['raw']['case_id'].values:
@@ -286,6 +399,7 @@ def generate_harmonization_comparison(case_id, data):
     raw_case_data = data['raw'][data['raw']['case_id'] == case_id].iloc[0]
     harmonized_case_data = data['harmonized'][data['harmonized']['case_id'] == case_id].iloc[0]
       # Create figure with three subplots - 3 rows, 3 columns (increased height)
+    plt = pyplot()
     fig = plt.figure(figsize=(15, 16))
     gs = plt.GridSpec(3, 3, figure=fig)
     
@@ -477,43 +591,17 @@ def create_kinetic_curves_subplot(ax, case_id, case_data, title, is_harmonized=F
         washout_strength = 1.0
     
     # Initial curve parameters - keep them constant regardless of the data
-    initial_slope = 150
     max_intensity = uptake_intensity
-    
-    # Create base curve
     t_diverge = 1.2
-    idx_diverge = int(t_diverge * len(time_points) / 3.0)
-    
-    base_curve = np.zeros_like(time_points)
-    base_curve[:idx_diverge+1] = max_intensity * (1 - np.exp(-initial_slope * time_points[:idx_diverge+1]/max_intensity))
-    
-    # Create the three curve types
-    uptake_curve = np.copy(base_curve)
-    plateau_curve = np.copy(base_curve)
-    washout_curve = np.copy(base_curve)
-    
-    # Value at divergence point
-    diverge_value = base_curve[idx_diverge]
+    idx_diverge = divergence_index(time_points, t_diverge)
     
     # Slopes calculation with strength factors applied
-    uptake_slope = max_intensity * 0.07 * uptake_strength
-    plateau_slope = -max_intensity * 0.03 * plateau_strength
-    washout_slope = -max_intensity * 0.12 * washout_severity * washout_strength
-    
-    # Apply slopes after divergence
-    for i in range(idx_diverge+1, len(time_points)):
-        dt = time_points[i] - time_points[idx_diverge]
-        uptake_curve[i] = diverge_value + dt * uptake_slope
-        plateau_curve[i] = diverge_value + dt * plateau_slope
-        washout_curve[i] = diverge_value + dt * washout_slope
+    slopes = case_curve_slopes(max_intensity, washout_severity,
+                               uptake_strength, plateau_strength, washout_strength)
+    curves = synthesize_kinetic_curves(time_points, max_intensity, slopes, idx_diverge)[0]
     
     # Plot curves
-    ax.plot(time_points, uptake_curve, color='#3274A1', linewidth=2, label='Uptake')
-    ax.plot(time_points, plateau_curve, color='#3A923A', linewidth=2, label='Plateau')
-    ax.plot(time_points, washout_curve, color='#C03D3E', linewidth=2, label='Washout')
-    
-    # Add reference line
-    ax.axvline(x=t_diverge, color='gray', linestyle='--', alpha=0.7)
+    plot_kinetic_curves(ax, time_points, curves, t_diverge)
     
     # Set labels and title
     ax.set_title(title, fontsize=12, fontweight='bold')
@@ -524,6 +612,66 @@ def create_kinetic_curves_subplot(ax, case_id, case_data, title, is_harmonized=F
     ax.legend()
     ax.grid(True, alpha=0.3)
     
+# Read only the header row of a feature table
+def read_feature_columns(table_path):
+    with open(table_path, newline='') as f:
+        return next(csv.reader(f))
+
+# Split comma separated query values (?columns=a,b&columns=c)
+def parse_list_arg(name):
+    values = []
+    for raw_value in request.args.getlist(name):
+        values.extend(v.strip() for v in raw_value.split(',') if v.strip())
+    return values or None
+
+# Yield the selected rows/columns of a feature table chunk by chunk
+def iter_feature_chunks(table_path, columns=None, case_ids=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # read_csv ignores the order of usecols, so the projection is re-applied per chunk
+    reader = pd.read_csv(table_path, usecols=columns, chunksize=chunk_rows)
+    for chunk in reader:
+        if case_ids is not None:
+            chunk = chunk[chunk['case_id'].isin(case_ids)]
+        if columns is not None:
+            chunk = chunk[columns]
+        if len(chunk) > 0:
+            yield chunk
+
+# Stream chunks as CSV with a single header row
+def stream_csv(chunks, columns):
+    yield ','.join(columns) + '\n'
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=False)
+
+# Stream chunks as newline-delimited JSON records
+def stream_ndjson(chunks):
+    for chunk in chunks:
+        yield chunk.to_json(orient='records', lines=True, double_precision=15).rstrip('\n') + '\n'
+
+# Stream an Arrow IPC stream, decoding the CSV in record batches with pyarrow
+def stream_arrow(table_path, columns=None, case_ids=None):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    reader = pa_csv.open_csv(
+        table_path,
+        read_options=pa_csv.ReadOptions(block_size=1 << 20),
+        convert_options=pa_csv.ConvertOptions(include_columns=columns)
+    )
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, reader.schema)
+    for batch in reader:
+        if case_ids is not None:
+            batch = batch.filter(pc.is_in(batch.column('case_id'), value_set=pa.array(case_ids)))
+        if batch.num_rows > 0:
+            writer.write_batch(batch)
+        if sink.tell() > 0:
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
 @app.route('/')
 def index():
     cases = get_available_cases()
@@ -596,6 +744,7 @@ def combat_visualization():
         output_path = os.path.join(static_images_dir, output_filename)
         
         # Import the visualization module and generate the visualization
+        pyplot()  # selects the Agg backend before combat_visualization imports pyplot
         import combat_visualization as cv
         cv.create_combat_visualization(use_real_data=True, output_path=output_path)
         
@@ -634,5 +783,90 @@ def combat_visualization():
         print(f"Error generating ComBat visualization: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/case/<case_id>/slices')
+def case_slices(case_id):
+    volumes = get_case_volumes(case_id)
+    if volumes is None:
+        return jsonify({'success': False, 'error': f"No slice pyramid or _0000/_colormap volumes found for {case_id}"}), 404
+    roi_slices = volumes['roi_slices']
+    return jsonify({
+        'success': True,
+        'n_slices': volumes['n_slices'],
+        'roi_slices': roi_slices,
+        'default_slice': roi_slices[len(roi_slices) // 2] if roi_slices else volumes['n_slices'] // 2
+    })
+
+@app.route('/api/case/<case_id>/slice/<int:z>')
+def case_slice(case_id, z):
+    volumes = get_case_volumes(case_id)
+    if volumes is None:
+        return jsonify({'success': False, 'error': f"No slice pyramid or _0000/_colormap volumes found for {case_id}"}), 404
+    if not 0 <= z < volumes['n_slices']:
+        return jsonify({'success': False, 'error': f"Slice {z} out of range (0-{volumes['n_slices'] - 1})"}), 400
+    
+    overlay = request.args.get('overlay', '1') != '0'
+    if 'pyramid' in volumes:
+        grey, classes = volumes['pyramid'].read_slice(0, z)
+        png = render_slice_png(grey, classes, overlay, display_orientation=True)
+    else:
+        grey, classes = get_slice_slab(case_id, volumes, z // SLICE_SLAB_DEPTH)
+        offset = z % SLICE_SLAB_DEPTH
+        png = render_slice_png(grey[:, :, offset], classes[:, :, offset], overlay)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'max-age=300'})
+
+@app.route('/api/case/<case_id>/pyramid')
+def case_pyramid(case_id):
+    dataset = case_id.split('_')[0]
+    pyramid_path = os.path.join(dataset, case_id, f"{case_id}_slice_pyramid.bin")
+    if not os.path.exists(pyramid_path):
+        return jsonify({'success': False, 'error': f"No slice pyramid found for {case_id}"}), 404
+    # conditional=True answers HTTP Range requests with 206 partial content
+    return send_file(os.path.abspath(pyramid_path), mimetype='application/octet-stream', conditional=True)
+
+@app.route('/api/export/<table>')
+def export_features(table):
+    if table not in FEATURE_TABLES:
+        return jsonify({'success': False, 'error': f"Unknown feature table '{table}'. Use one of: {', '.join(FEATURE_TABLES)}"}), 404
+    
+    table_path = FEATURE_TABLES[table]
+    if not os.path.exists(table_path):
+        return jsonify({'success': False, 'error': f"Feature table not found: {table_path}"}), 404
+    
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'success': False, 'error': f"Unsupported format '{export_format}'. Use one of: {', '.join(EXPORT_MIMETYPES)}"}), 400
+    
+    # Column projection - case_id is always exported first
+    available_columns = read_feature_columns(table_path)
+    columns = parse_list_arg('columns')
+    if columns is not None:
+        unknown_columns = [col for col in columns if col not in available_columns]
+        if unknown_columns:
+            return jsonify({'success': False, 'error': f"Unknown columns: {', '.join(unknown_columns)}"}), 400
+        columns = ['case_id'] + [col for col in dict.fromkeys(columns) if col != 'case_id']
+    
+    case_ids = parse_list_arg('cases')
+    
+    if export_format == 'arrow':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return jsonify({'success': False, 'error': 'Arrow export requires pyarrow (pip install pyarrow)'}), 501
+        body = stream_arrow(table_path, columns, case_ids)
+    else:
+        chunks = iter_feature_chunks(table_path, columns, case_ids)
+        if export_format == 'csv':
+            body = stream_csv(chunks, columns or available_columns)
+        else:
+            body = stream_ndjson(chunks)
+    
+    extension = 'arrows' if export_format == 'arrow' else export_format
+    return Response(
+        stream_with_context(body),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename={table}_features.{extension}'}
+    )
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # threaded=True keeps long streaming exports from blocking other requests
+    app.run(debug=True, threaded=True)
@@ -0,0 +1,290 @@
+"""
+Local HTTP service that extracts single cases on warm pipelines
+
+Keeps CompleteDCEMRIPipeline instances (imports done, radiomics extractor
+built) in worker threads, so a case submitted from the clinical workflow pays
+only its own processing time. Requests queue up to --queue-size. At most
+--workers cases are processed at once, and further requests are refused with
+503 until the queue drains.
+
+Endpoints:
+    POST /cases          {"case_path": ..., "segment_dir": ..., "case_id": ..., "dataset": ...,
+                          "preflight": false, "wait": true, "timeout": 600}
+                         Only case_path is required. case_id defaults to its folder name,
+                         dataset to the parent folder, and segment_dir to <dataset>/segment.
+                         With wait the response holds the result (or 202 and the job when
+                         it is not done within timeout).
+    GET  /cases/<job_id> Job status, features, artifact paths and timing
+    GET  /metrics        Queue depth, counters, latency percentiles and per-stage times
+    GET  /health
+
+Usage:
+    python worker_service.py [--port 8765] [--workers 2] [--queue-size 16]
+"""
+import os
+import sys
+import math
+import time
+import uuid
+import queue
+import logging
+import argparse
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+from flask import Flask, request, jsonify
+from pipeline_logging import configure_logging, case_context
+from pipeline_metrics import PipelineMetrics
+from case_shards import json_value
+
+logger = logging.getLogger('pipeline.service')
+
+# Finished jobs kept for GET /cases/<job_id>, and jobs the latency metrics cover
+FINISHED_JOBS_KEPT = 1000
+TIMING_WINDOW = 1000
+
+def case_artifacts(case_id, case_path):
+    """Output files process_case writes next to the case, if present"""
+    artifacts = {
+        'colormap_nifti': os.path.join(case_path, f"{case_id}_colormap.nii.gz"),
+        'colormap_png': os.path.join(case_path, f"{case_id}_complete_colormap.png"),
+        'slice_pyramid': os.path.join(case_path, f"{case_id}_slice_pyramid.bin")
+    }
+    return {name: path for name, path in artifacts.items() if os.path.exists(path)}
+
+def json_features(features):
+    """Features as JSON-safe Python values (NaN/inf become null)"""
+    clean = {}
+    for key, value in features.items():
+        value = json_value(value) if not isinstance(value, (str, int, float)) else value
+        if isinstance(value, float) and not math.isfinite(value):
+            value = None
+        clean[key] = value
+    return clean
+
+class WorkerService:
+    """
+    Job queue served by worker threads, each owning a warm CompleteDCEMRIPipeline
+
+    Args:
+        pipeline_config: CompleteDCEMRIPipeline keyword arguments (see CompleteDCEMRIPipeline.config)
+        workers: Cases processed concurrently
+        queue_size: Jobs allowed to wait for a worker; submit() refuses more
+        metrics_path: JSON lines file for the per-case stage metrics (optional)
+    """
+
+    def __init__(self, pipeline_config=None, workers=1, queue_size=16, metrics_path=None):
+        from complete_pipeline import CompleteDCEMRIPipeline
+        self.metrics = PipelineMetrics(output_path=metrics_path)
+        self.pipelines = [CompleteDCEMRIPipeline(metrics=self.metrics, **(pipeline_config or {}))
+                          for _ in range(workers)]
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self.timings = deque(maxlen=TIMING_WINDOW)
+        self.running = 0
+        self.started = time.time()
+        self.threads = []
+
+    def warm_up(self):
+        """Import every stage's libraries, render a PNG and build the radiomics extractors before the first request"""
+        start = time.perf_counter()
+        import io
+        import SimpleITK  # noqa: F401
+        import rgb_nifti_converter  # noqa: F401
+        from matplotlib.figure import Figure
+        # The first PNG also loads fonts and the Agg renderer
+        figure = Figure(figsize=(1, 1))
+        figure.subplots().set_title('warm-up')
+        figure.savefig(io.BytesIO(), format='png')
+        for pipeline in self.pipelines:
+            pipeline.radiomics_extractor
+        logger.info("%d pipelines warmed up in %.1f s", len(self.pipelines), time.perf_counter() - start)
+
+    def start(self):
+        self.warm_up()
+        for index, pipeline in enumerate(self.pipelines):
+            thread = threading.Thread(target=self._work, args=(pipeline,), name=f"case-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, case_path, segment_dir=None, case_id=None, dataset=None, preflight=False):
+        """Queue a case; returns the job, or None when the queue is full"""
+        case_path = os.path.abspath(case_path)
+        dataset_dir = os.path.dirname(case_path)
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'case_id': case_id or os.path.basename(case_path),
+            'dataset': dataset or os.path.basename(dataset_dir),
+            'case_path': case_path,
+            'segment_dir': segment_dir or os.path.join(dataset_dir, 'segment'),
+            'preflight': preflight,
+            'status': 'queued',
+            'submitted_at': time.time(),
+            'features': None,
+            'artifacts': {},
+            'error': None,
+            'timing': {},
+            '_done': threading.Event()
+        }
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.counters['rejected'] += 1
+            return None
+        with self.lock:
+            self.counters['submitted'] += 1
+            self.jobs[job['job_id']] = job
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _work(self, pipeline):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.running += 1
+            try:
+                self._process(pipeline, job)
+            except Exception as e:
+                logger.error("Job %s failed: %s", job['job_id'], e, exc_info=logger.isEnabledFor(logging.DEBUG))
+                job['status'], job['error'] = 'failed', str(e)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.counters['completed' if job['status'] == 'done' else 'failed'] += 1
+                    self.timings.append((job['timing'], job.get('_stages', {})))
+                    # Keep only the most recent finished jobs
+                    finished = [job_id for job_id, other in self.jobs.items() if other['status'] in ('done', 'failed')]
+                    for job_id in finished[:max(len(finished) - FINISHED_JOBS_KEPT, 0)]:
+                        del self.jobs[job_id]
+                job['_done'].set()
+
+    def _process(self, pipeline, job):
+        started = time.perf_counter()
+        job['status'] = 'running'
+        job['timing']['queue_wait_s'] = time.time() - job['submitted_at']
+        case_id = job['case_id']
+        with case_context(case_id):
+            with self.metrics.case(case_id, job['dataset']) as record:
+                features = None
+                rejected = None
+                if job['preflight']:
+                    from preflight import check_case, failure_reason
+                    with self.metrics.stage('preflight'):
+                        check = check_case(job['dataset'], case_id, job['case_path'], job['segment_dir'])
+                    if check['status'] == 'error':
+                        rejected = '; '.join(message for severity, _, message in check['issues'] if severity == 'error')
+                        self.metrics.mark_failed(failure_reason(check))
+                if rejected is None:
+                    features = pipeline.process_case(case_id, job['case_path'], job['segment_dir'])
+            # Records are summarized by the service; the metrics object keeps none
+            self.metrics.records.remove(record)
+
+            job['timing']['processing_s'] = time.perf_counter() - started
+            job['timing']['total_s'] = time.time() - job['submitted_at']
+            job['_stages'] = {name: stats['wall_s'] for name, stats in record['stages'].items()}
+            if features:
+                job['features'] = json_features(features)
+                job['artifacts'] = case_artifacts(case_id, job['case_path'])
+                job['status'] = 'done'
+                logger.info("Case done in %.2f s (waited %.2f s)", job['timing']['processing_s'], job['timing']['queue_wait_s'])
+            else:
+                job['status'] = 'failed'
+                job['error'] = rejected or (record['errors'][0]['message'] if record['errors'] else 'no features extracted')
+                logger.warning("Case failed: %s", job['error'])
+
+    def stats(self):
+        """Counters, queue state, latency percentiles and mean stage times over the recent jobs"""
+        with self.lock:
+            timings = list(self.timings)
+            stats = {
+                'uptime_s': time.time() - self.started,
+                'workers': len(self.pipelines),
+                'running': self.running,
+                'queued': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                **self.counters
+            }
+        latency = {}
+        for name in ('queue_wait_s', 'processing_s', 'total_s'):
+            values = np.array([timing[name] for timing, _ in timings if name in timing])
+            if len(values):
+                latency[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                                 'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+        stages = {}
+        for _, job_stages in timings:
+            for name, wall in job_stages.items():
+                stages.setdefault(name, []).append(wall)
+        stats['latency'] = latency
+        stats['stages_mean_s'] = {name: float(np.mean(values)) for name, values in stages.items()}
+        return stats
+
+def job_response(job):
+    return {key: value for key, value in job.items() if not key.startswith('_')}
+
+def create_app(service):
+    app = Flask(__name__)
+
+    @app.route('/cases', methods=['POST'])
+    def submit_case():
+        body = request.get_json(silent=True) or {}
+        if not body.get('case_path'):
+            return jsonify({'error': 'case_path is required'}), 400
+        if not os.path.isdir(body['case_path']):
+            return jsonify({'error': f"case_path is not a directory: {body['case_path']}"}), 400
+        job = service.submit(body['case_path'], segment_dir=body.get('segment_dir'), case_id=body.get('case_id'),
+                             dataset=body.get('dataset'), preflight=bool(body.get('preflight', False)))
+        if job is None:
+            return jsonify({'error': 'queue full, retry later'}), 503
+        if body.get('wait', True) and job['_done'].wait(float(body.get('timeout', 600))):
+            return jsonify(job_response(job)), 200 if job['status'] == 'done' else 422
+        return jsonify(job_response(job)), 202
+
+    @app.route('/cases/<job_id>')
+    def case_status(job_id):
+        job = service.get(job_id)
+        if job is None:
+            return jsonify({'error': 'unknown job'}), 404
+        return jsonify(job_response(job))
+
+    @app.route('/metrics')
+    def metrics():
+        return jsonify(service.stats())
+
+    @app.route('/health')
+    def health():
+        return jsonify({'status': 'ok', 'workers': len(service.pipelines)})
+
+    return app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to bind (local only by default)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1, help='Cases processed concurrently')
+    parser.add_argument('--queue-size', type=int, default=16, help='Waiting cases before requests are refused')
+    parser.add_argument('--memory-budget-mb', type=int, help='Stream kinetics in z-slabs above this working set')
+    parser.add_argument('--volume-cache-dir', help='Shared cache of decompressed volumes')
+    parser.add_argument('--radiomics-workers', type=int,
+                        help='Per-case radiomics processes (t0/t1 and feature classes run concurrently)')
+    parser.add_argument('--metrics-file', help='Append per-case stage metrics to this JSON lines file')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--log-file')
+    args = parser.parse_args(argv)
+
+    configure_logging(args.log_level, args.log_file)
+    service = WorkerService({'memory_budget_mb': args.memory_budget_mb, 'volume_cache_dir': args.volume_cache_dir,
+                             'radiomics_workers': args.radiomics_workers},
+                            workers=args.workers, queue_size=args.queue_size, metrics_path=args.metrics_file)
+    service.start()
+    logger.info("Serving on http://%s:%d (%d workers, queue %d)", args.host, args.port, args.workers, args.queue_size)
+    create_app(service).run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())